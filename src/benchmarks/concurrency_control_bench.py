@@ -0,0 +1,152 @@
+"""
+Benchmark acquire/release latency of ConcurrencyControl with many distinct
+client ids already holding a connection.
+
+The redis backend requires a running redis server (REDIS_HOST/REDIS_PORT),
+run from the src folder:
+python benchmarks/concurrency_control_bench.py --sizes 10000 100000 1000000
+python benchmarks/concurrency_control_bench.py --backend memory
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+from typing import List
+
+from chatserver.concurrency_control import (
+    IConcurrencyControl,
+    create_concurrency_control,
+)
+from chatserver.redis_concurrency_control import RedisConcurrencyControl
+
+# The admission script used before the total counter was introduced, kept to
+# show how its cost grows with the number of connected clients
+LEGACY_ACQUIRE_CONNECTION_SCRIPT = """
+local key = KEYS[1]
+local client_id = ARGV[1]
+local max_connections = tonumber(ARGV[2])
+local max_connection_per_client = tonumber(ARGV[3])
+
+local hash_map = redis.call('HGETALL', key)
+local total_connections = 0
+local client_connections = 0
+
+for i = 1, #hash_map, 2 do
+    total_connections = total_connections + tonumber(hash_map[i + 1])
+    if hash_map[i] == client_id then
+        client_connections = tonumber(hash_map[i + 1])
+    end
+end
+
+if total_connections >= max_connections then
+    return 0
+end
+
+if client_connections >= max_connection_per_client then
+    return 0
+end
+
+redis.call('HINCRBY', key, client_id, 1)
+return 1
+"""
+
+BENCH_REDIS_KEY = "concurrency_control_bench"
+FILL_BATCH_SIZE = 10000
+
+
+async def fill_clients(concurrency_control: IConcurrencyControl, size: int) -> None:
+    await concurrency_control.clean_all_sessions()
+    if not isinstance(concurrency_control, RedisConcurrencyControl):
+        for i in range(size):
+            await concurrency_control.acquire_connection(f"client-{i}")
+        return
+
+    for start in range(0, size, FILL_BATCH_SIZE):
+        end = min(start + FILL_BATCH_SIZE, size)
+        await concurrency_control.redis_client.hset(
+            concurrency_control.redis_key,
+            mapping={f"client-{i}": 1 for i in range(start, end)},
+        )
+    await concurrency_control.redis_client.set(concurrency_control.total_key, size)
+
+
+def summarize(samples: List[float]) -> str:
+    samples = sorted(samples)
+    p50 = samples[len(samples) // 2] * 1e6
+    p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1e6
+    mean = statistics.fmean(samples) * 1e6
+    return f"mean {mean:9.1f}us  p50 {p50:9.1f}us  p99 {p99:9.1f}us"
+
+
+async def bench_size(
+    backend: str, size: int, iterations: int, legacy_iterations: int
+) -> None:
+    concurrency_control = create_concurrency_control(
+        max_connections=size + iterations + 1,
+        max_connection_per_client=1,
+        redis_key=BENCH_REDIS_KEY,
+        backend=backend,
+    )
+    await fill_clients(concurrency_control, size)
+
+    acquire_samples = []
+    release_samples = []
+    for i in range(iterations):
+        client_id = f"bench-{i}"
+        start = time.perf_counter()
+        ok = await concurrency_control.acquire_connection(client_id)
+        acquire_samples.append(time.perf_counter() - start)
+        assert ok
+
+        start = time.perf_counter()
+        await concurrency_control.release_connection(client_id)
+        release_samples.append(time.perf_counter() - start)
+
+    print(f"[{size} clients] acquire: {summarize(acquire_samples)}")
+    print(f"[{size} clients] release: {summarize(release_samples)}")
+
+    if not isinstance(concurrency_control, RedisConcurrencyControl):
+        return
+
+    if legacy_iterations:
+        legacy_acquire = concurrency_control.redis_client.register_script(
+            LEGACY_ACQUIRE_CONNECTION_SCRIPT
+        )
+        legacy_samples = []
+        for i in range(legacy_iterations):
+            start = time.perf_counter()
+            await legacy_acquire(
+                keys=[concurrency_control.redis_key],
+                args=[f"legacy-{i}", size + legacy_iterations + 1, 1],
+            )
+            legacy_samples.append(time.perf_counter() - start)
+        print(f"[{size} clients] legacy acquire: {summarize(legacy_samples)}")
+
+    await concurrency_control.clean_all_sessions()
+    await concurrency_control.redis_client.aclose()
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[10000, 100000, 1000000]
+    )
+    parser.add_argument("--backend", choices=["redis", "memory"], default="redis")
+    parser.add_argument("--iterations", type=int, default=1000)
+    parser.add_argument(
+        "--legacy-iterations",
+        type=int,
+        default=10,
+        help="number of acquires with the old HGETALL script, 0 to skip",
+    )
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        await bench_size(
+            args.backend, size, args.iterations, args.legacy_iterations
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
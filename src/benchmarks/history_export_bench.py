@@ -0,0 +1,122 @@
+"""
+Throughput of the NDJSON export of the history service on a large synthetic
+history, and the memory the process gains while exporting it.
+
+Run from the src folder:
+python benchmarks/history_export_bench.py --messages 1000000
+python benchmarks/history_export_bench.py --backend sqlite --messages 200000
+"""
+
+import argparse
+import asyncio
+import http.client
+import os
+import resource
+import tempfile
+import threading
+import time
+import uuid
+
+from chat_history.chat_history import (
+    ChatHistory,
+    ChatHistoryMessage,
+    ChatHistoryMessageType,
+    IChatHistory,
+)
+from chat_history.history_service import HistoryServer
+from chat_history.sqlite_chat_history import SqliteChatHistory
+
+
+def synthetic_messages(messages: int, clients: int):
+    for i in range(messages):
+        client_id = f"client-{i % clients}"
+        user = i % 2 == 0
+        yield client_id, ChatHistoryMessage(
+            id=uuid.uuid4(),
+            client_id=client_id,
+            text=f"message {i}" if user else "Hello, how can I help you?",
+            audio_url=None if user else f"https://files.example/audio/{i}.mp3",
+            image_url=None if user or i % 3 else f"https://files.example/image/{i}.png",
+            video_url=None,
+            type=ChatHistoryMessageType.USER if user else ChatHistoryMessageType.BOT,
+            time=f"2024-01-01 {i // 3600 % 24:02}:{i // 60 % 60:02}:{i % 60:02}",
+        )
+
+
+def memory_history(messages: int, clients: int) -> ChatHistory:
+    chat_history = ChatHistory(
+        max_messages_per_client=messages // clients + 1, max_bytes=2**40
+    )
+    for client_id, message in synthetic_messages(messages, clients):
+        chat_history.add_chat_message(client_id, message)
+    return chat_history
+
+
+def sqlite_history(path: str, messages: int, clients: int) -> SqliteChatHistory:
+    async def fill() -> None:
+        chat_history = SqliteChatHistory(
+            path, durability="off", batch_size=10000, max_queue=messages
+        )
+        for client_id, message in synthetic_messages(messages, clients):
+            chat_history.add_chat_message(client_id, message)
+        await chat_history.close()
+
+    asyncio.run(fill())
+    return SqliteChatHistory(path)
+
+
+def max_rss_mib() -> float:
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def export(chat_history: IChatHistory) -> None:
+    server = HistoryServer(("localhost", 0), chat_history)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+
+    rss_before = max_rss_mib()
+    connection = http.client.HTTPConnection("localhost", server.server_address[1])
+    start = time.perf_counter()
+    connection.request("GET", "/export")
+    response = connection.getresponse()
+    size = 0
+    lines = 0
+    while chunk := response.read(2**16):
+        size += len(chunk)
+        lines += chunk.count(b"\n")
+    elapsed = time.perf_counter() - start
+    connection.close()
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+    print(
+        f"{lines} messages, {size / 2**20:.1f} MiB in {elapsed:.2f}s: "
+        f"{lines / elapsed:.0f} messages/s, {size / 2**20 / elapsed:.1f} MiB/s"
+    )
+    print(f"max RSS {rss_before:.0f} MiB before the export, {max_rss_mib():.0f} MiB after")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=1_000_000)
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--backend", choices=["memory", "sqlite"], default="memory")
+    args = parser.parse_args()
+
+    if args.backend == "memory":
+        export(memory_history(args.messages, args.clients))
+        return
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory() as directory:
+        chat_history = sqlite_history(
+            os.path.join(directory, "history.db"), args.messages, args.clients
+        )
+        print(f"history written in {time.perf_counter() - start:.1f}s")
+        export(chat_history)
+        asyncio.run(chat_history.close())
+
+
+if __name__ == "__main__":
+    main()
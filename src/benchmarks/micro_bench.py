@@ -0,0 +1,271 @@
+"""
+Microbenchmarks of the hot paths: request and response encoding/decoding,
+chat history and connection admission.
+
+Every case reports the best time per operation out of --repeats runs and is
+compared with the baseline saved in benchmarks/baselines.json, a case slower
+than its baseline by more than --threshold is a regression and the script
+exits with status 1. Baselines depend on the machine, save them again with
+--save after changing the machine or an intended slowdown.
+
+Run from the src folder:
+python benchmarks/micro_bench.py
+python benchmarks/micro_bench.py --filter request --save
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import sys
+import time
+from typing import Callable, Dict, List, Optional
+import uuid
+
+from chat_history.chat_history import (
+    ChatHistory,
+    ChatHistoryMessage,
+    ChatHistoryMessageType,
+)
+from chatserver.concurrency_control import create_concurrency_control
+from request import RequestPayload, RequestType
+from response import ResponsePayload, ResponseType
+
+BASELINES_PATH = os.path.join(os.path.dirname(__file__), "baselines.json")
+PAYLOAD_SIZES = {"1KiB": 1024, "64KiB": 64 * 1024, "1MiB": 1024 * 1024}
+HISTORY_SIZES = [10_000, 100_000, 1_000_000]
+CONCURRENCY_LEVELS = [1, 100, 1000]
+
+# name -> function returning the seconds per operation of one run
+Case = Callable[[], float]
+
+
+def payload_bytes(size: int) -> bytes:
+    return random.Random(size).randbytes(size)
+
+
+def time_per_op(operation: Callable[[], object], min_time: float = 0.05) -> float:
+    """
+    Seconds per call of operation, calling it as many times as fit in min_time
+    """
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            operation()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return elapsed / number
+        number *= 2 if elapsed == 0 else max(2, int(min_time / elapsed * 1.2))
+
+
+def request_cases() -> Dict[str, Case]:
+    cases = {}
+    for size_name, size in PAYLOAD_SIZES.items():
+        body = payload_bytes(size)
+        requests = {
+            "text": RequestPayload(uuid.uuid4(), RequestType.TEXT, "a" * size, None, None),
+            "audio": RequestPayload(uuid.uuid4(), RequestType.AUDIO, None, body, None),
+            "video": RequestPayload(uuid.uuid4(), RequestType.VIDEO, None, None, body),
+        }
+        for type_name, request in requests.items():
+            encoded = request.encode()
+            cases[f"request.encode[{type_name},{size_name}]"] = (
+                lambda request=request: time_per_op(request.encode)
+            )
+            cases[f"request.decode[{type_name},{size_name}]"] = (
+                lambda encoded=encoded: time_per_op(
+                    lambda: RequestPayload.decode(encoded)
+                )
+            )
+    return cases
+
+
+def response_cases() -> Dict[str, Case]:
+    cases = {}
+    for size_name, size in PAYLOAD_SIZES.items():
+        media = payload_bytes(size)
+        text = "a" * size
+        responses = {
+            "text": ResponsePayload(uuid.uuid4(), ResponseType.TEXT, text, None, None),
+            "text_audio": ResponsePayload(
+                uuid.uuid4(), ResponseType.TEXT_AUDIO, text, media, None
+            ),
+            "text_audio_image": ResponsePayload(
+                uuid.uuid4(), ResponseType.TEXT_AUDIO_IMAGE, text, media, media
+            ),
+        }
+        for type_name, response in responses.items():
+            encoded = response.encode()
+            cases[f"response.encode[{type_name},{size_name}]"] = (
+                lambda response=response: time_per_op(response.encode)
+            )
+            cases[f"response.decode[{type_name},{size_name}]"] = (
+                lambda encoded=encoded: time_per_op(
+                    lambda: ResponsePayload.decode(encoded)
+                )
+            )
+    return cases
+
+
+def new_history_message(client_id: str) -> ChatHistoryMessage:
+    return ChatHistoryMessage(
+        id=uuid.uuid4(),
+        client_id=client_id,
+        text="Hello",
+        audio_url=None,
+        image_url=None,
+        video_url=None,
+        type=ChatHistoryMessageType.USER,
+        time="2024-01-01 00:00:00",
+    )
+
+
+def history_cases() -> Dict[str, Case]:
+    def filled_history(size: int) -> ChatHistory:
+        # half of the messages belong to client-0, as a long running conversation
+        chat_history = ChatHistory()
+        message = new_history_message("client-0")
+        for i in range(size):
+            client_id = "client-0" if i % 2 else f"client-{i % 1000}"
+            chat_history.add_chat_message(client_id, message)
+        return chat_history
+
+    def add(size: int) -> float:
+        chat_history = filled_history(size)
+        message = new_history_message("client-0")
+        return time_per_op(lambda: chat_history.add_chat_message("client-0", message))
+
+    def get_all(size: int) -> float:
+        chat_history = filled_history(size)
+        return time_per_op(lambda: chat_history.get_all_chat_history("client-0"))
+
+    def get_page(size: int) -> float:
+        chat_history = filled_history(size)
+        return time_per_op(
+            lambda: chat_history.get_chat_history_page("client-0", limit=50)
+        )
+
+    cases = {}
+    for size in HISTORY_SIZES:
+        cases[f"history.add_chat_message[{size}]"] = lambda size=size: add(size)
+        cases[f"history.get_all_chat_history[{size}]"] = lambda size=size: get_all(size)
+        cases[f"history.get_chat_history_page[{size}]"] = lambda size=size: get_page(size)
+    return cases
+
+
+async def acquire_release(backend: str, concurrency: int, rounds: int) -> float:
+    concurrency_control = create_concurrency_control(
+        max_connections=concurrency,
+        max_connection_per_client=1,
+        redis_key="micro_bench",
+        backend=backend,
+    )
+    await concurrency_control.clean_all_sessions()
+
+    async def client(i: int) -> None:
+        client_id = f"client-{i}"
+        for _ in range(rounds):
+            assert await concurrency_control.acquire_connection(client_id)
+            await concurrency_control.release_connection(client_id)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client(i) for i in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    await concurrency_control.stop()
+    return elapsed / (concurrency * rounds)
+
+
+def concurrency_control_cases(backend: str) -> Dict[str, Case]:
+    return {
+        f"{backend}.acquire_release[{concurrency}]": (
+            lambda concurrency=concurrency: asyncio.run(
+                acquire_release(backend, concurrency, max(10, 10_000 // concurrency))
+            )
+        )
+        for concurrency in CONCURRENCY_LEVELS
+    }
+
+
+def format_time(seconds: float) -> str:
+    for unit, scale in [("s", 1), ("ms", 1e-3), ("us", 1e-6)]:
+        if seconds >= scale:
+            return f"{seconds / scale:8.2f}{unit}"
+    return f"{seconds / 1e-9:8.1f}ns"
+
+
+def load_baselines() -> dict:
+    if not os.path.exists(BASELINES_PATH):
+        return {"machine": None, "cases": {}}
+    with open(BASELINES_PATH) as f:
+        return json.load(f)
+
+
+def machine() -> str:
+    return f"{platform.python_implementation()} {platform.python_version()} {platform.machine()}"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--filter", help="only run the cases containing this string")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.25,
+        help="relative slowdown from the baseline reported as a regression",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=["memory", "redis"],
+        default="memory",
+        help="concurrency control backend, redis requires a running server",
+    )
+    parser.add_argument(
+        "--save", action="store_true", help="save the results as the new baselines"
+    )
+    args = parser.parse_args()
+
+    cases = {
+        **request_cases(),
+        **response_cases(),
+        **history_cases(),
+        **concurrency_control_cases(args.backend),
+    }
+    if args.filter:
+        cases = {name: case for name, case in cases.items() if args.filter in name}
+
+    baselines = load_baselines()
+    if baselines["machine"] not in (None, machine()):
+        print(f"Baselines were saved on {baselines['machine']}, not {machine()}")
+
+    results: Dict[str, float] = {}
+    regressions: List[str] = []
+    for name, case in cases.items():
+        results[name] = min(case() for _ in range(args.repeats))
+        baseline: Optional[float] = baselines["cases"].get(name)
+        line = f"{name:<45} {format_time(results[name])}"
+        if baseline:
+            change = results[name] / baseline - 1
+            line += f"  baseline {format_time(baseline)} {change:+7.1%}"
+            if change > args.threshold:
+                line += "  REGRESSION"
+                regressions.append(name)
+        print(line)
+
+    if args.save:
+        baselines["machine"] = machine()
+        baselines["cases"].update(results)
+        with open(BASELINES_PATH, "w") as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Saved {len(results)} baselines to {BASELINES_PATH}")
+    elif regressions:
+        print(f"{len(regressions)} regressions above {args.threshold:.0%}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
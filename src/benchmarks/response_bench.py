@@ -0,0 +1,67 @@
+"""
+Compare how many replies per second can be produced by reading the sample media
+from disk for every reply, and by the pre-encoded ResponseAssetCache.
+
+Run from the src folder:
+python benchmarks/response_bench.py --duration 2
+"""
+
+import argparse
+import time
+from typing import Callable
+import uuid
+
+from chatserver.response_cache import ResponseAssetCache
+from response import ResponseType, get_sample_response_payload
+
+RESPONSE_TYPES = {
+    "TEXT": ResponseType.TEXT,
+    "TEXT_AUDIO": ResponseType.TEXT_AUDIO,
+    "TEXT_AUDIO_IMAGE": ResponseType.TEXT_AUDIO_IMAGE,
+}
+
+
+def replies_per_second(reply: Callable[[], object], duration: float) -> float:
+    count = 0
+    start = time.perf_counter()
+    deadline = start + duration
+    while time.perf_counter() < deadline:
+        reply()
+        count += 1
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--duration", type=float, default=2, help="seconds to run each case"
+    )
+    args = parser.parse_args()
+
+    cache = ResponseAssetCache(use_mmap=False)
+    mmap_cache = ResponseAssetCache(use_mmap=True)
+
+    for name, type in RESPONSE_TYPES.items():
+        before = replies_per_second(
+            lambda: get_sample_response_payload(type, uuid.uuid4()).encode(),
+            args.duration,
+        )
+        after = replies_per_second(
+            lambda: cache.get_response_payload(type, uuid.uuid4()).encode_buffers(),
+            args.duration,
+        )
+        after_mmap = replies_per_second(
+            lambda: mmap_cache.get_response_payload(
+                type, uuid.uuid4()
+            ).encode_buffers(),
+            args.duration,
+        )
+        print(
+            f"{name:<17} disk + encode: {before:10.0f}/s  "
+            f"cache: {after:10.0f}/s ({after / before:6.1f}x)  "
+            f"mmap cache: {after_mmap:10.0f}/s ({after_mmap / before:6.1f}x)"
+        )
+
+
+if __name__ == "__main__":
+    main()
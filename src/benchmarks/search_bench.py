@@ -0,0 +1,87 @@
+"""
+Latency of the full-text search of the chat history on a large synthetic
+history: words are drawn from a Zipf distribution, so the queries mix rare
+and very common terms.
+
+Run from the src folder:
+python benchmarks/search_bench.py --messages 1000000 --max-bytes 1073741824
+"""
+
+import argparse
+import itertools
+import random
+import statistics
+import time
+import uuid
+
+from chat_history.chat_history import ChatHistoryMessage, ChatHistoryMessageType
+from chat_history.search_index import SearchIndex
+
+VOCABULARY = [f"word{i}" for i in range(50_000)]
+
+
+def synthetic_texts(messages: int, words: int = 8):
+    rng = random.Random(0)
+    cum_weights = list(
+        itertools.accumulate(1 / rank for rank in range(1, len(VOCABULARY) + 1))
+    )
+    for _ in range(messages):
+        yield " ".join(rng.choices(VOCABULARY, cum_weights=cum_weights, k=words))
+
+
+def build_index(messages: int, clients: int, max_bytes: int) -> SearchIndex:
+    index = SearchIndex(max_bytes)
+    for i, text in enumerate(synthetic_texts(messages)):
+        client_id = f"client-{i % clients}"
+        index.add(
+            client_id,
+            ChatHistoryMessage(
+                id=uuid.uuid4(),
+                client_id=client_id,
+                text=text,
+                audio_url=None,
+                image_url=None,
+                video_url=None,
+                type=ChatHistoryMessageType.USER,
+                time="2024-01-01 00:00:00",
+            ),
+        )
+    return index
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=200_000)
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--max-bytes", type=int, default=256 * 2**20)
+    parser.add_argument("--queries", type=int, default=200, help="runs of every query")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    index = build_index(args.messages, args.clients, args.max_bytes)
+    elapsed = time.perf_counter() - start
+    print(
+        f"indexed {args.messages} messages in {elapsed:.1f}s "
+        f"({args.messages / elapsed:.0f}/s): {index.memory_usage()}"
+    )
+
+    queries = {
+        "rare term": ("word40000", None),
+        "common term": ("word1", None),
+        "two terms": ("word1 word50", None),
+        "phrase": ('"word1 word2"', None),
+        "common term, one client": ("word1", "client-7"),
+        "rare term, one client": ("word9000", "client-7"),
+    }
+    print(f"{'query':<25} {'matches':>9} {'p50':>10} {'p99':>10}")
+    for name, (query, client_id) in queries.items():
+        took = [
+            index.search(query, client_id).took_seconds for _ in range(args.queries)
+        ]
+        p50, p99 = (statistics.quantiles(took, n=100)[i] for i in (49, 98))
+        matches = index.search(query, client_id).total
+        print(f"{name:<25} {matches:>9} {p50 * 1000:>8.2f}ms {p99 * 1000:>8.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
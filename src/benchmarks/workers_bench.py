@@ -0,0 +1,136 @@
+"""
+Measure the throughput of the server started with different numbers of
+worker processes. Video requests are used because they are answered without
+the simulated delay, so the throughput is bound by the CPU of the server.
+
+Needs redis, run from the src folder:
+python benchmarks/workers_bench.py --workers 1 2 4 --connections 64 --duration 10
+"""
+
+import argparse
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import os
+import socket
+import subprocess
+import sys
+import time
+from typing import List
+import uuid
+
+import websockets
+
+from chatserver.config import Config
+from request import RequestType, get_sample_request_payload
+
+SERVER_PATH = os.path.join(os.path.dirname(__file__), "../chatserver/chat_server.py")
+
+
+def get_free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+def start_server(workers: int, port: int) -> subprocess.Popen:
+    env = dict(
+        os.environ,
+        SERVER_PORT=str(port),
+        CONCURRENCY_BACKEND="redis",
+        CONCURRENT_CONTROL_REDIS_KEY=f"workers_bench:{uuid.uuid4().hex}",
+        MAX_CONNECTIONS="100000",
+        MAX_CONNECTION_PER_CLIENT="100000",
+        MAX_MESSAGES="100000",
+        MAX_IN_FLIGHT_PER_CONNECTION="4",
+        REPLY_POLICY="text=0-24;audio=0-24;video=0-24",
+        PYTHONPATH=os.pathsep.join(sys.path),
+    )
+    return subprocess.Popen(
+        [sys.executable, SERVER_PATH, "--workers", str(workers)],
+        env=env,
+        stdout=subprocess.DEVNULL,
+    )
+
+
+async def wait_for_server(url: str, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            async with websockets.connect(f"{url}?client_id=probe&time_zone=UTC") as ws:
+                await ws.recv()
+                return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.2)
+
+
+async def run_connection(url: str, client_id: str, deadline: float) -> int:
+    """
+    Keep 4 requests in flight until the deadline, return the number of responses
+    """
+    fragments = get_sample_request_payload(RequestType.VIDEO).encode_fragments(
+        Config.MAX_FRAME_SIZE
+    )
+    responses = 0
+    async with websockets.connect(
+        f"{url}?client_id={client_id}&time_zone=UTC", max_size=None
+    ) as ws:
+        await ws.recv()
+        for _ in range(4):
+            await ws.send(fragments)
+        while time.monotonic() < deadline:
+            await ws.recv()
+            responses += 1
+            await ws.send(fragments)
+    return responses
+
+
+def run_clients(url: str, client_ids: List[str], duration: float) -> int:
+    async def run() -> int:
+        deadline = time.monotonic() + duration
+        counts = await asyncio.gather(
+            *[run_connection(url, client_id, deadline) for client_id in client_ids]
+        )
+        return sum(counts)
+
+    return asyncio.run(run())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--connections", type=int, default=64)
+    parser.add_argument(
+        "--client-processes",
+        type=int,
+        default=os.cpu_count(),
+        help="processes generating the load",
+    )
+    parser.add_argument("--duration", type=float, default=10)
+    args = parser.parse_args()
+
+    print(f"{os.cpu_count()} cores, {args.connections} connections")
+    for workers in args.workers:
+        port = get_free_port()
+        url = f"ws://localhost:{port}"
+        server = start_server(workers, port)
+        try:
+            asyncio.run(wait_for_server(url))
+            client_ids = [f"bench-{i}" for i in range(args.connections)]
+            with ProcessPoolExecutor(args.client_processes) as executor:
+                counts = executor.map(
+                    run_clients,
+                    [url] * args.client_processes,
+                    [client_ids[i :: args.client_processes] for i in range(args.client_processes)],
+                    [args.duration] * args.client_processes,
+                )
+                responses = sum(counts)
+            print(f"workers: {workers:<3} {responses / args.duration:10.1f} responses/s")
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    main()
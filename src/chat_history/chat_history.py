@@ -1,6 +1,10 @@
 from abc import ABC, abstractmethod
+import base64
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict, deque
 from dataclasses import dataclass
-from typing import List
+import sys
+from typing import Deque, Iterator, List, Optional, Tuple
 import uuid
 from enum import Enum
 
@@ -22,6 +26,36 @@ class ChatHistoryMessage:
     time: str
 
 
+class ChatHistoryOrder(Enum):
+    OLDEST_FIRST = "oldest"
+    NEWEST_FIRST = "newest"
+
+
+@dataclass
+class ChatHistoryPage:
+    messages: List[ChatHistoryMessage]
+    # cursor of the next page, None on the last page
+    next_cursor: Optional[str]
+
+
+# position of a message in the history of its client: its time, then the
+# order in which the messages of the client were added
+PagePosition = Tuple[str, int]
+
+
+def encode_cursor(position: PagePosition) -> str:
+    time, seq = position
+    return base64.urlsafe_b64encode(f"{seq} {time}".encode()).decode()
+
+
+def decode_cursor(cursor: str) -> PagePosition:
+    try:
+        seq, time = base64.urlsafe_b64decode(cursor.encode()).decode().split(" ", 1)
+        return time, int(seq)
+    except ValueError:
+        raise ValueError(f"Invalid chat history cursor: {cursor}")
+
+
 class IChatHistory(ABC):
     @abstractmethod
     @abstractmethod
@@ -32,20 +66,295 @@ class IChatHistory(ABC):
     def get_all_chat_history(self, client_id: str) -> List[ChatHistoryMessage]:
         pass
 
+    @abstractmethod
+    def get_chat_history_page(
+        self,
+        client_id: str,
+        limit: int = 50,
+        cursor: Optional[str] = None,
+        order: ChatHistoryOrder = ChatHistoryOrder.NEWEST_FIRST,
+        start_time: Optional[str] = None,
+        end_time: Optional[str] = None,
+    ) -> ChatHistoryPage:
+        """
+        Up to limit messages of the client ordered by time, starting after cursor.
+        start_time (included) and end_time (excluded) are in the format of
+        ChatHistoryMessage.time, the time of the client
+        """
+        pass
+
+    @abstractmethod
+    def client_ids(self) -> List[str]:
+        pass
+
+    def iter_client_ids(self, page_size: int = 500) -> Iterator[str]:
+        """
+        Every client_id, read page_size at a time by the backends that do not
+        keep them in memory
+        """
+        return iter(self.client_ids())
+
+    def iter_chat_history(
+        self, client_id: str, page_size: int = 500
+    ) -> Iterator[ChatHistoryMessage]:
+        """
+        Every message of the client oldest first, read page_size messages at a time
+        """
+        cursor = None
+        while True:
+            page = self.get_chat_history_page(
+                client_id, page_size, cursor, ChatHistoryOrder.OLDEST_FIRST
+            )
+            yield from page.messages
+            cursor = page.next_cursor
+            if cursor is None:
+                return
+
+    def start(self) -> None:
+        """
+        Start the background work of the history, from the event loop
+        """
+        pass
+
+    async def close(self) -> None:
+        """
+        Persist what is still buffered and release the storage
+        """
+        pass
+
+
+class StoredMessage:
+    """
+    ChatHistoryMessage as kept by ChatHistory, without its client_id
+    and with the id as 16 bytes. seq orders the messages of a client
+    """
+
+    __slots__ = (
+        "seq", "id", "text", "audio_url", "image_url", "video_url", "type", "time"
+    )
+
+    def __init__(self, message: ChatHistoryMessage, seq: int = 0) -> None:
+        self.seq = seq
+        self.id = message.id.bytes
+        self.text = message.text
+        self.audio_url = message.audio_url
+        self.image_url = message.image_url
+        self.video_url = message.video_url
+        self.type = message.type
+        self.time = message.time
+
+    def size(self) -> int:
+        """
+        Approximate bytes used by the message, its type is shared by every message
+        """
+        size = STORED_MESSAGE_SIZE
+        for value in (self.text, self.audio_url, self.image_url, self.video_url, self.time):
+            if value is not None:
+                # exact for ASCII text, cheaper than sys.getsizeof
+                size += EMPTY_STR_SIZE + len(value)
+        return size
+
+    def to_message(self, client_id: str) -> ChatHistoryMessage:
+        return ChatHistoryMessage(
+            id=uuid.UUID(bytes=self.id),
+            client_id=client_id,
+            text=self.text,
+            audio_url=self.audio_url,
+            image_url=self.image_url,
+            video_url=self.video_url,
+            type=self.type,
+            time=self.time,
+        )
+
+
+def page_position(stored: StoredMessage) -> PagePosition:
+    return stored.time, stored.seq
+
+
+EMPTY_STR_SIZE = sys.getsizeof("")
+# the record, its id and its pointers in the deque and the time index of the client
+STORED_MESSAGE_SIZE = (
+    sys.getsizeof(StoredMessage.__new__(StoredMessage)) + sys.getsizeof(bytes(16)) + 16
+)
+
+
+class ClientHistory:
+    __slots__ = ("messages", "time_index", "next_seq", "size")
+
+    def __init__(self, max_messages: int) -> None:
+        # ring buffer, the oldest message is dropped when it is full
+        self.messages: Deque[StoredMessage] = deque(maxlen=max_messages)
+        # the same messages sorted by page_position, the client clock
+        # rarely goes back so a new message is almost always appended
+        self.time_index: List[StoredMessage] = []
+        self.next_seq = 0
+        self.size = 0
+
 
 class ChatHistory(IChatHistory):
     """
-    Dummy chat history service store data on RAM
-    further implementation can store data in remote file storate like S3
+    Chat history stored on RAM, further implementation can store data in
+    remote file storage like S3.
+
+    Every client keeps its last max_messages_per_client messages. When all the
+    messages use more than max_bytes, the history of the least recently active
+    clients is evicted
     """
 
-    def __init__(self):
-        self.chat_history = {}
+    def __init__(
+        self, max_messages_per_client: int = 1000, max_bytes: int = 256 * 2**20
+    ) -> None:
+        self.max_messages_per_client = max_messages_per_client
+        self.max_bytes = max_bytes
+        # least recently active client first
+        self.chat_history: OrderedDict[str, ClientHistory] = OrderedDict()
+        self.used_bytes = 0
+        self.message_count = 0
+        self.evicted_clients = 0
+        self.evicted_messages = 0
 
     def add_chat_message(self, client_id: str, message: ChatHistoryMessage) -> None:
-        if client_id not in self.chat_history:
-            self.chat_history[client_id] = []
-        self.chat_history[client_id].append(message)
+        history = self.chat_history.get(client_id)
+        if history is None:
+            history = self.chat_history[client_id] = ClientHistory(
+                self.max_messages_per_client
+            )
+        else:
+            self.chat_history.move_to_end(client_id)
+
+        if len(history.messages) == history.messages.maxlen:
+            self._remove_oldest(history)
+        stored = StoredMessage(message, history.next_seq)
+        history.next_seq += 1
+        size = stored.size()
+        history.messages.append(stored)
+        index = history.time_index
+        if not index or index[-1].time <= stored.time:
+            index.append(stored)
+        else:
+            insort(index, stored, key=page_position)
+        history.size += size
+        self.used_bytes += size
+        self.message_count += 1
+
+        while self.used_bytes > self.max_bytes:
+            self._evict(client_id)
+
+    def _remove_oldest(self, history: ClientHistory) -> None:
+        stored = history.messages.popleft()
+        index = history.time_index
+        if index[0] is stored:
+            del index[0]
+        else:
+            del index[bisect_left(index, page_position(stored), key=page_position)]
+        size = stored.size()
+        history.size -= size
+        self.used_bytes -= size
+        self.message_count -= 1
+        self.evicted_messages += 1
+
+    def _evict(self, active_client_id: str) -> None:
+        client_id = next(iter(self.chat_history))
+        if client_id == active_client_id:
+            # the active client is the only one left, it loses its oldest messages
+            self._remove_oldest(self.chat_history[client_id])
+            return
+        history = self.chat_history.pop(client_id)
+        self.used_bytes -= history.size
+        self.message_count -= len(history.messages)
+        self.evicted_messages += len(history.messages)
+        self.evicted_clients += 1
 
     def get_all_chat_history(self, client_id: str) -> List[ChatHistoryMessage]:
-        return self.chat_history.get(client_id, [])
+        history = self.chat_history.get(client_id)
+        if history is None:
+            return []
+        self.chat_history.move_to_end(client_id)
+        return [stored.to_message(client_id) for stored in history.messages]
+
+    def get_chat_history_page(
+        self,
+        client_id: str,
+        limit: int = 50,
+        cursor: Optional[str] = None,
+        order: ChatHistoryOrder = ChatHistoryOrder.NEWEST_FIRST,
+        start_time: Optional[str] = None,
+        end_time: Optional[str] = None,
+    ) -> ChatHistoryPage:
+        if limit < 1:
+            raise ValueError("The page limit must be at least 1")
+        history = self.chat_history.get(client_id)
+        if history is None:
+            return ChatHistoryPage([], None)
+        self.chat_history.move_to_end(client_id)
+
+        # the page is taken from index[start:end], found by binary search
+        index = history.time_index
+        start = 0
+        end = len(index)
+        if start_time is not None:
+            start = bisect_left(index, (start_time, -1), key=page_position)
+        if end_time is not None:
+            end = bisect_left(index, (end_time, -1), key=page_position)
+        if cursor is not None:
+            position = decode_cursor(cursor)
+            if order is ChatHistoryOrder.OLDEST_FIRST:
+                start = max(start, bisect_right(index, position, key=page_position))
+            else:
+                end = min(end, bisect_left(index, position, key=page_position))
+
+        if order is ChatHistoryOrder.OLDEST_FIRST:
+            page = index[start : min(end, start + limit)]
+            has_more = start + limit < end
+        else:
+            page = index[max(start, end - limit) : end][::-1]
+            has_more = end - limit > start
+        return ChatHistoryPage(
+            [stored.to_message(client_id) for stored in page],
+            encode_cursor(page_position(page[-1])) if has_more else None,
+        )
+
+    def client_ids(self) -> List[str]:
+        return list(self.chat_history)
+
+    def memory_usage(self) -> dict:
+        return {
+            "clients": len(self.chat_history),
+            "messages": self.message_count,
+            "bytes": self.used_bytes,
+            "max_bytes": self.max_bytes,
+            "evicted_clients": self.evicted_clients,
+            "evicted_messages": self.evicted_messages,
+        }
+
+
+def create_chat_history(
+    backend: str = "memory",
+    max_messages_per_client: int = 1000,
+    max_bytes: int = 256 * 2**20,
+    sqlite_path: str = "chat_history.db",
+    durability: str = "normal",
+    batch_size: int = 500,
+    flush_interval: float = 0.05,
+    search_max_bytes: int = 0,
+) -> IChatHistory:
+    """
+    memory: bounded history of this process, lost on restart\n
+    sqlite: history written behind to a SQLite database\n
+    The text of the messages is indexed for search when search_max_bytes is not 0
+    """
+    if backend == "memory":
+        chat_history = ChatHistory(max_messages_per_client, max_bytes)
+    elif backend == "sqlite":
+        from chat_history.sqlite_chat_history import SqliteChatHistory
+
+        chat_history = SqliteChatHistory(
+            sqlite_path, durability, batch_size, flush_interval
+        )
+    else:
+        raise ValueError(f"Unknown chat history backend: {backend}")
+    if search_max_bytes:
+        from chat_history.search_index import SearchableChatHistory, SearchIndex
+
+        return SearchableChatHistory(chat_history, SearchIndex(search_max_bytes))
+    return chat_history
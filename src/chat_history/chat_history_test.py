@@ -0,0 +1,124 @@
+import uuid
+
+import pytest
+
+from chat_history.chat_history import (
+    ChatHistory,
+    ChatHistoryMessage,
+    ChatHistoryMessageType,
+    ChatHistoryOrder,
+    StoredMessage,
+)
+
+
+def new_message(
+    client_id: str, text: str, time: str = "2024-01-01 00:00:00"
+) -> ChatHistoryMessage:
+    return ChatHistoryMessage(
+        id=uuid.uuid4(),
+        client_id=client_id,
+        text=text,
+        audio_url=None,
+        image_url=None,
+        video_url=None,
+        type=ChatHistoryMessageType.USER,
+        time=time,
+    )
+
+
+def read_pages(chat_history, client_id: str, **kwargs) -> list:
+    """
+    Texts of every page, following the cursors
+    """
+    pages = []
+    cursor = None
+    while True:
+        page = chat_history.get_chat_history_page(client_id, cursor=cursor, **kwargs)
+        pages.append([message.text for message in page.messages])
+        cursor = page.next_cursor
+        if cursor is None:
+            return pages
+
+
+def test_round_trip():
+    chat_history = ChatHistory()
+    message = new_message("1", "Hello")
+    chat_history.add_chat_message("1", message)
+    assert chat_history.get_all_chat_history("1") == [message]
+    assert chat_history.get_all_chat_history("2") == []
+
+
+def test_messages_per_client():
+    chat_history = ChatHistory(max_messages_per_client=3)
+    for i in range(5):
+        chat_history.add_chat_message("1", new_message("1", str(i)))
+
+    texts = [message.text for message in chat_history.get_all_chat_history("1")]
+    assert texts == ["2", "3", "4"]
+    usage = chat_history.memory_usage()
+    assert usage["messages"] == 3
+    assert usage["evicted_messages"] == 2
+    assert usage["bytes"] == sum(
+        StoredMessage(new_message("1", str(i))).size() for i in range(3)
+    )
+
+
+def test_evict_least_recently_active_clients():
+    size = StoredMessage(new_message("1", "a")).size()
+    chat_history = ChatHistory(max_bytes=3 * size)
+    chat_history.add_chat_message("1", new_message("1", "a"))
+    chat_history.add_chat_message("2", new_message("2", "b"))
+    chat_history.add_chat_message("3", new_message("3", "c"))
+    # reading the history of client 1 makes it active again
+    chat_history.get_all_chat_history("1")
+    chat_history.add_chat_message("4", new_message("4", "d"))
+
+    assert chat_history.get_all_chat_history("2") == []
+    assert len(chat_history.get_all_chat_history("1")) == 1
+    assert chat_history.memory_usage()["evicted_clients"] == 1
+    assert chat_history.used_bytes <= chat_history.max_bytes
+
+    # a single client over the budget loses its oldest messages
+    for text in "efghij":
+        chat_history.add_chat_message("4", new_message("4", text))
+    texts = [message.text for message in chat_history.get_all_chat_history("4")]
+    assert texts == ["h", "i", "j"]
+    assert chat_history.memory_usage()["clients"] == 1
+
+
+def test_pages():
+    chat_history = ChatHistory(max_messages_per_client=6)
+    for i in range(8):
+        message = new_message("1", str(i), f"2024-01-01 00:00:0{i}")
+        chat_history.add_chat_message("1", message)
+
+    assert read_pages(chat_history, "1", limit=4) == [["7", "6", "5", "4"], ["3", "2"]]
+    assert read_pages(
+        chat_history, "1", limit=3, order=ChatHistoryOrder.OLDEST_FIRST
+    ) == [["2", "3", "4"], ["5", "6", "7"]]
+    assert read_pages(
+        chat_history,
+        "1",
+        start_time="2024-01-01 00:00:03",
+        end_time="2024-01-01 00:00:06",
+    ) == [["5", "4", "3"]]
+    assert read_pages(chat_history, "2") == [[]]
+    with pytest.raises(ValueError):
+        chat_history.get_chat_history_page("1", cursor="not a cursor")
+
+
+def test_pages_ordered_by_time():
+    chat_history = ChatHistory(max_messages_per_client=2)
+    # the clock of the client went back, the messages of a second keep their order
+    for text, time in [
+        ("a", "2024-01-01 10:00:00"),
+        ("b", "2024-01-01 09:00:00"),
+        ("c", "2024-01-01 09:00:00"),
+    ]:
+        chat_history.add_chat_message("1", new_message("1", text, time))
+
+    assert read_pages(chat_history, "1", limit=1) == [["c"], ["b"]]
+    history = chat_history.chat_history["1"]
+    assert history.time_index == sorted(
+        history.messages, key=lambda stored: (stored.time, stored.seq)
+    )
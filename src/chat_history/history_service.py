@@ -0,0 +1,361 @@
+"""
+HTTP service reading the chat history of an IChatHistory.
+
+GET /history/<client_id>?limit=&cursor=&order=&start_time=&end_time=
+    one page of messages of the client as JSON, with the cursor of the next page
+GET /export/<client_id>
+GET /export
+    every message of the client, or of every client, as NDJSON streamed with
+    chunked transfer encoding. Messages are read page by page and encoded by
+    a pipeline of generators, so an export uses the same memory whatever its size
+GET /search?q=&client_id=&limit=&offset=
+    messages matching the terms and "quoted phrases" of q, ranked, when the
+    history is a SearchableChatHistory. The index of the service follows
+    the messages committed to the database by the chat servers
+GET /media/<name>
+    a media of the messages, at the URL kept by the history
+
+Run it next to chat servers using CHAT_HISTORY_BACKEND=sqlite, from the src folder:
+python -m chat_history.history_service
+"""
+
+import argparse
+import asyncio
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import itertools
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from chat_history.chat_history import (
+    ChatHistoryMessage,
+    ChatHistoryOrder,
+    IChatHistory,
+)
+from chat_history.search_index import SearchableChatHistory, SearchIndex
+from chat_history.sqlite_chat_history import SqliteChatHistory
+from chatserver.config import Config
+from chatserver.log import setup_logging, stop_logging
+from file_storage import ContentAddressedFileStorage
+
+logger = logging.getLogger("chatserver.history_service")
+
+MAX_PAGE_LIMIT = 1000
+# messages read from the history at a time by an export
+EXPORT_PAGE_SIZE = 500
+# NDJSON lines are sent in HTTP chunks of about this size
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+
+def message_to_dict(message: ChatHistoryMessage) -> dict:
+    # media are referenced by their URL, their content is never inlined
+    return {
+        "id": str(message.id),
+        "client_id": message.client_id,
+        "type": message.type.name.lower(),
+        "text": message.text,
+        "audio_url": message.audio_url,
+        "image_url": message.image_url,
+        "video_url": message.video_url,
+        "time": message.time,
+    }
+
+
+def export_lines(
+    chat_history: IChatHistory,
+    client_ids: Iterable[str],
+    page_size: int = EXPORT_PAGE_SIZE,
+) -> Iterator[bytes]:
+    """
+    One NDJSON line for every message of the clients
+    """
+    encode = json.JSONEncoder(ensure_ascii=False).encode
+    for client_id in client_ids:
+        for message in chat_history.iter_chat_history(client_id, page_size):
+            yield (encode(message_to_dict(message)) + "\n").encode()
+
+
+class SearchIndexUpdater(threading.Thread):
+    """
+    Add the messages committed to the database by the chat servers to the
+    search index, polling the log of the commits every interval seconds.
+    The index is only read and written under lock
+    """
+
+    def __init__(
+        self,
+        chat_history: SqliteChatHistory,
+        search_index: SearchIndex,
+        lock: threading.Lock,
+        interval: float = 1.0,
+        batch_size: int = 1000,
+    ) -> None:
+        super().__init__(name="search-index-updater", daemon=True)
+        self.chat_history = chat_history
+        self.search_index = search_index
+        self.lock = lock
+        self.interval = interval
+        self.batch_size = batch_size
+        # log position of the last indexed message
+        self.position = 0
+        self._stopped = threading.Event()
+
+    def update(self) -> int:
+        """
+        Index every message committed since the last update, batch by batch
+        so that searches are not blocked for long
+        """
+        indexed = 0
+        while True:
+            position, messages = self.chat_history.read_committed(
+                self.position, self.batch_size
+            )
+            if not messages:
+                return indexed
+            with self.lock:
+                for client_id, message in messages:
+                    self.search_index.add(client_id, message)
+            self.position = position
+            indexed += len(messages)
+
+    def run(self) -> None:
+        while True:
+            try:
+                self.update()
+            except sqlite3.Error:
+                logger.exception("Can not update the search index")
+            if self._stopped.wait(self.interval):
+                return
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self.join()
+
+
+def join_chunks(
+    lines: Iterable[bytes], chunk_size: int = EXPORT_CHUNK_SIZE
+) -> Iterator[bytes]:
+    """
+    Join the lines in chunks of at least chunk_size bytes, except the last one
+    """
+    buffer: List[bytes] = []
+    size = 0
+    for line in lines:
+        buffer.append(line)
+        size += len(line)
+        if size >= chunk_size:
+            yield b"".join(buffer)
+            buffer.clear()
+            size = 0
+    if buffer:
+        yield b"".join(buffer)
+
+
+class HistoryRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "HistoryServer"
+
+    def do_GET(self) -> None:
+        url = urlsplit(self.path)
+        path = [unquote(part) for part in url.path.strip("/").split("/")]
+        query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        try:
+            if len(path) == 2 and path[0] == "history":
+                self.send_page(path[1], query)
+            elif path == ["export"]:
+                self.send_export(self.server.chat_history.iter_client_ids())
+            elif len(path) == 2 and path[0] == "export":
+                self.send_export([path[1]])
+            elif path == ["search"] and isinstance(
+                self.server.chat_history, SearchableChatHistory
+            ):
+                self.send_search(query)
+            elif (
+                len(path) == 2
+                and path[0] == "media"
+                and self.server.media_storage is not None
+            ):
+                self.send_media(path[1])
+            else:
+                self.send_json(HTTPStatus.NOT_FOUND, {"error": "Not found"})
+        except ValueError as e:
+            self.send_json(HTTPStatus.BAD_REQUEST, {"error": str(e)})
+        except sqlite3.Error:
+            logger.exception("Can not read the chat history")
+            self.send_json(HTTPStatus.INTERNAL_SERVER_ERROR, {"error": "Server error"})
+
+    def send_page(self, client_id: str, query: Dict[str, str]) -> None:
+        page = self.server.chat_history.get_chat_history_page(
+            client_id,
+            limit=min(int(query.get("limit", 50)), MAX_PAGE_LIMIT),
+            cursor=query.get("cursor"),
+            order=ChatHistoryOrder(query.get("order", "newest")),
+            start_time=query.get("start_time"),
+            end_time=query.get("end_time"),
+        )
+        self.send_json(
+            HTTPStatus.OK,
+            {
+                "messages": [message_to_dict(message) for message in page.messages],
+                "next_cursor": page.next_cursor,
+            },
+        )
+
+    def send_search(self, query: Dict[str, str]) -> None:
+        limit = min(int(query.get("limit", 20)), MAX_PAGE_LIMIT)
+        offset = int(query.get("offset", 0))
+        with self.server.search_lock:
+            page = self.server.chat_history.search(
+                query.get("q", ""),
+                client_id=query.get("client_id"),
+                limit=limit,
+                offset=offset,
+            )
+        self.send_json(
+            HTTPStatus.OK,
+            {
+                "results": [
+                    {**message_to_dict(result.message), "score": result.score}
+                    for result in page.results
+                ],
+                "total": page.total,
+                "next_offset": page.next_offset,
+                "took_ms": page.took_seconds * 1000,
+            },
+        )
+
+    def send_export(self, client_ids: Iterable[str]) -> None:
+        chunks = join_chunks(export_lines(self.server.chat_history, client_ids))
+        # an error before the first chunk still gets its own response
+        first_chunk = next(chunks, None)
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            if first_chunk is not None:
+                for chunk in itertools.chain([first_chunk], chunks):
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            logger.info("History export interrupted by the client")
+            self.close_connection = True
+        except Exception:
+            # the status is sent, the client sees a response without its last chunk
+            logger.exception("History export failed")
+            self.close_connection = True
+
+    def send_media(self, name: str) -> None:
+        try:
+            file = self.server.media_storage.open_file(name)
+        except FileNotFoundError:
+            self.send_json(HTTPStatus.NOT_FOUND, {"error": "Not found"})
+            return
+        with file:
+            self.send_response(HTTPStatus.OK)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(os.fstat(file.fileno()).st_size))
+            # the name is the hash of the content, it never changes
+            self.send_header("Cache-Control", "public, max-age=31536000, immutable")
+            self.end_headers()
+            shutil.copyfileobj(file, self.wfile)
+
+    def send_json(self, status: HTTPStatus, body: dict) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format: str, *args) -> None:
+        logger.debug(format, *args)
+
+
+class HistoryServer(ThreadingHTTPServer):
+    """
+    Serve the history from a thread per request, the backend must allow
+    reads from several threads
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address: Tuple[str, int],
+        chat_history: IChatHistory,
+        media_storage: Optional[ContentAddressedFileStorage] = None,
+    ) -> None:
+        super().__init__(address, HistoryRequestHandler)
+        self.chat_history = chat_history
+        self.media_storage = media_storage
+        # the search index is not thread safe, SearchIndexUpdater writes to it
+        self.search_lock = threading.Lock()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default=Config.HISTORY_SERVICE_HOST)
+    parser.add_argument("--port", type=int, default=Config.HISTORY_SERVICE_PORT)
+    parser.add_argument(
+        "--sqlite-path",
+        default=Config.CHAT_HISTORY_SQLITE_PATH,
+        help="database written by the chat servers",
+    )
+    parser.add_argument(
+        "--search-max-bytes",
+        type=int,
+        default=Config.CHAT_HISTORY_SEARCH_MAX_BYTES,
+        help="memory of the search index of the messages of the database, "
+        "0 disables /search",
+    )
+    parser.add_argument(
+        "--search-interval",
+        type=float,
+        default=Config.HISTORY_SERVICE_SEARCH_INTERVAL,
+        help="seconds between two updates of the search index from the database",
+    )
+    parser.add_argument(
+        "--media-dir",
+        default=Config.MEDIA_STORAGE_DIR,
+        help="media stored by the chat servers, served on /media",
+    )
+    args = parser.parse_args()
+
+    setup_logging()
+    sqlite_history = SqliteChatHistory(args.sqlite_path)
+    chat_history: IChatHistory = sqlite_history
+    search_index = SearchIndex(args.search_max_bytes) if args.search_max_bytes else None
+    if search_index is not None:
+        chat_history = SearchableChatHistory(sqlite_history, search_index)
+    media_storage = ContentAddressedFileStorage(args.media_dir, Config.MEDIA_BASE_URL)
+    server = HistoryServer((args.host, args.port), chat_history, media_storage)
+    updater = None
+    if search_index is not None:
+        # the history is indexed in the background, the service answers meanwhile
+        updater = SearchIndexUpdater(
+            sqlite_history, search_index, server.search_lock, args.search_interval
+        )
+        updater.start()
+    logger.info("History service listening on %s:%s", args.host, args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if updater is not None:
+            updater.stop()
+        server.server_close()
+        asyncio.run(chat_history.close())
+        media_storage.close()
+        stop_logging()
+
+
+if __name__ == "__main__":
+    main()
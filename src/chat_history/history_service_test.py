@@ -0,0 +1,148 @@
+import asyncio
+import hashlib
+from http.client import IncompleteRead
+import json
+import threading
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+import pytest
+
+from chat_history.chat_history import ChatHistory
+from chat_history.chat_history_test import new_message
+from chat_history.history_service import HistoryServer, SearchIndexUpdater, join_chunks
+from chat_history.search_index import SearchableChatHistory, SearchIndex
+from chat_history.sqlite_chat_history import SqliteChatHistory
+from file_storage import ContentAddressedFileStorage
+
+
+@pytest.fixture
+def history_url(tmp_path):
+    media_storage = ContentAddressedFileStorage(str(tmp_path))
+    media_storage.save_file("clip.mp3", b"clip")
+    chat_history = SearchableChatHistory(ChatHistory(), SearchIndex())
+    for i in range(5):
+        message = new_message("1", str(i), f"2024-01-01 00:00:0{i}")
+        message.audio_url = f"https://files.example/{i}.mp3"
+        chat_history.add_chat_message("1", message)
+    chat_history.add_chat_message("a b", new_message("a b", "other"))
+
+    server = HistoryServer(("localhost", 0), chat_history, media_storage)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield f"http://localhost:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+    thread.join()
+    media_storage.close()
+
+
+def get(url: str) -> bytes:
+    with urlopen(url) as response:
+        return response.read()
+
+
+def test_pages(history_url):
+    page = json.loads(get(f"{history_url}/history/1?limit=3"))
+    assert [message["text"] for message in page["messages"]] == ["4", "3", "2"]
+    assert page["messages"][0]["audio_url"] == "https://files.example/4.mp3"
+
+    page = json.loads(get(f"{history_url}/history/1?cursor={page['next_cursor']}"))
+    assert [message["text"] for message in page["messages"]] == ["1", "0"]
+    assert page["next_cursor"] is None
+
+    with pytest.raises(HTTPError) as e:
+        get(f"{history_url}/history/1?order=sideways")
+    assert e.value.code == 400
+    with pytest.raises(HTTPError) as e:
+        get(f"{history_url}/unknown")
+    assert e.value.code == 404
+
+
+def test_export(history_url):
+    lines = get(f"{history_url}/export/1").splitlines()
+    assert [json.loads(line)["text"] for line in lines] == ["0", "1", "2", "3", "4"]
+
+    client_ids = [
+        json.loads(line)["client_id"] for line in get(f"{history_url}/export").splitlines()
+    ]
+    assert sorted(client_ids) == ["1"] * 5 + ["a b"]
+    assert get(f"{history_url}/export/a%20b").count(b"\n") == 1
+    assert get(f"{history_url}/export/unknown") == b""
+
+
+def test_search(history_url):
+    body = json.loads(get(f"{history_url}/search?q=other&limit=1"))
+    assert [result["client_id"] for result in body["results"]] == ["a b"]
+    assert body["total"] == 1
+    assert body["next_offset"] is None
+    assert body["took_ms"] >= 0
+
+    body = json.loads(get(f"{history_url}/search?q=3&client_id=1"))
+    assert [result["text"] for result in body["results"]] == ["3"]
+
+
+class FailingChatHistory(ChatHistory):
+    def get_chat_history_page(self, client_id, *args, **kwargs):
+        if client_id == "broken":
+            raise ValueError("Broken history")
+        return super().get_chat_history_page(client_id, *args, **kwargs)
+
+
+def test_export_errors():
+    chat_history = FailingChatHistory()
+    # more than a chunk is sent before the export fails
+    chat_history.add_chat_message("1", new_message("1", "a" * 100_000))
+    chat_history.add_chat_message("broken", new_message("broken", "b"))
+    server = HistoryServer(("localhost", 0), chat_history)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    url = f"http://localhost:{server.server_address[1]}"
+
+    with pytest.raises(HTTPError) as e:
+        get(f"{url}/export/broken")
+    assert e.value.code == 400
+    with pytest.raises(IncompleteRead):
+        get(f"{url}/export")
+
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+@pytest.mark.asyncio
+async def test_search_follows_the_database(tmp_path):
+    path = str(tmp_path / "history.db")
+    chat_server_history = SqliteChatHistory(path, flush_interval=0.01)
+    chat_server_history.add_chat_message("1", new_message("1", "hello before"))
+    await asyncio.sleep(0.05)
+
+    service_history = SqliteChatHistory(path)
+    search_index = SearchIndex()
+    updater = SearchIndexUpdater(service_history, search_index, threading.Lock())
+    assert updater.update() == 1
+
+    # messages written by a chat server after the service started are indexed
+    chat_server_history.add_chat_message("2", new_message("2", "hello after"))
+    await chat_server_history.close()
+    assert updater.update() == 1
+    assert updater.update() == 0
+    assert search_index.search("hello").total == 2
+    assert search_index.search("after", client_id="2").total == 1
+    await service_history.close()
+
+
+def test_media(history_url):
+    digest = hashlib.sha256(b"clip").hexdigest()
+    with urlopen(f"{history_url}/media/{digest}.mp3") as response:
+        assert response.read() == b"clip"
+        assert "immutable" in response.headers["Cache-Control"]
+    with pytest.raises(HTTPError) as e:
+        get(f"{history_url}/media/{'0' * 64}.mp3")
+    assert e.value.code == 404
+
+
+def test_join_chunks():
+    lines = [b"a" * 3] * 5
+    assert list(join_chunks(lines, chunk_size=6)) == [b"a" * 6, b"a" * 6, b"a" * 3]
+    assert list(join_chunks([], chunk_size=6)) == []
@@ -0,0 +1,323 @@
+import asyncio
+from dataclasses import dataclass
+import heapq
+import math
+import re
+import sys
+import time
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+import uuid
+
+from chat_history.chat_history import (
+    ChatHistoryMessage,
+    ChatHistoryOrder,
+    ChatHistoryPage,
+    IChatHistory,
+    StoredMessage,
+)
+
+TOKEN = re.compile(r"\w+")
+PHRASE = re.compile(r'"([^"]*)"')
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+# approximate bytes of a document and of each of its postings:
+# the dict entries pointing to the document and the positions tuple
+DOCUMENT_SIZE = 200
+POSTING_SIZE = 150
+POSITION_SIZE = 8
+
+
+def tokenize(text: Optional[str]) -> List[str]:
+    return TOKEN.findall(text.lower()) if text else []
+
+
+def parse_query(query: str) -> Tuple[List[str], List[List[str]]]:
+    """
+    Terms and quoted phrases of the query, a phrase of one word is a term
+    """
+    phrases = [tokenize(phrase) for phrase in PHRASE.findall(query)]
+    terms = tokenize(PHRASE.sub(" ", query))
+    terms.extend(phrase[0] for phrase in phrases if len(phrase) == 1)
+    return terms, [phrase for phrase in phrases if len(phrase) > 1]
+
+
+def term_positions(terms: List[str]) -> Dict[str, Tuple[int, ...]]:
+    positions: Dict[str, List[int]] = {}
+    for position, term in enumerate(terms):
+        positions.setdefault(term, []).append(position)
+    return {term: tuple(values) for term, values in positions.items()}
+
+
+class Document:
+    __slots__ = ("client_id", "message", "length", "size")
+
+    def __init__(
+        self, client_id: str, message: StoredMessage, length: int, size: int
+    ) -> None:
+        self.client_id = client_id
+        self.message = message
+        self.length = length
+        self.size = size
+
+
+@dataclass
+class SearchResult:
+    message: ChatHistoryMessage
+    score: float
+
+
+@dataclass
+class SearchPage:
+    results: List[SearchResult]
+    # messages matching the query
+    total: int
+    # offset of the next page, None on the last page
+    next_offset: Optional[int]
+    took_seconds: float
+
+
+class SearchIndex:
+    """
+    Inverted index of the text of the messages, updated as they are added.
+
+    A query matches the messages containing all its terms and "quoted phrases",
+    of every client or of one client, ranked by BM25 then newest first.
+    When the documents and their postings use more than max_bytes, the
+    oldest messages are removed from the index
+    """
+
+    def __init__(self, max_bytes: int = 64 * 2**20) -> None:
+        self.max_bytes = max_bytes
+        # term -> doc_id -> positions of the term in the text
+        self.postings: Dict[str, Dict[int, Tuple[int, ...]]] = {}
+        # documents have consecutive ids, from the oldest one
+        self.documents: Dict[int, Document] = {}
+        self.client_documents: Dict[str, Dict[int, None]] = {}
+        self.oldest_doc_id = 0
+        self.next_doc_id = 0
+        self.total_length = 0
+        self.used_bytes = 0
+        self.evicted_documents = 0
+
+    def add(self, client_id: str, message: ChatHistoryMessage) -> None:
+        terms = tokenize(message.text)
+        if not terms:
+            return
+        doc_id = self.next_doc_id
+        self.next_doc_id += 1
+        stored = StoredMessage(message)
+        size = DOCUMENT_SIZE + stored.size()
+        for term, positions in term_positions(terms).items():
+            postings = self.postings.get(term)
+            if postings is None:
+                postings = self.postings[term] = {}
+                size += sys.getsizeof(term)
+            postings[doc_id] = positions
+            size += POSTING_SIZE + POSITION_SIZE * len(positions)
+        self.documents[doc_id] = Document(client_id, stored, len(terms), size)
+        self.client_documents.setdefault(client_id, {})[doc_id] = None
+        self.total_length += len(terms)
+        self.used_bytes += size
+
+        while self.used_bytes > self.max_bytes and len(self.documents) > 1:
+            self._evict_oldest()
+
+    def _evict_oldest(self) -> None:
+        doc_id = self.oldest_doc_id
+        self.oldest_doc_id += 1
+        document = self.documents.pop(doc_id)
+        # the terms are not kept, the text is tokenized again
+        for term in set(tokenize(document.message.text)):
+            postings = self.postings[term]
+            del postings[doc_id]
+            if not postings:
+                del self.postings[term]
+        client_documents = self.client_documents[document.client_id]
+        del client_documents[doc_id]
+        if not client_documents:
+            del self.client_documents[document.client_id]
+        self.total_length -= document.length
+        self.used_bytes -= document.size
+        self.evicted_documents += 1
+
+    def _candidates(
+        self, postings: List[Dict[int, Tuple[int, ...]]], client_id: Optional[str]
+    ) -> Iterator[int]:
+        # scan the smallest of the rarest postings and the documents of the client
+        rarest = postings[0]
+        if client_id is None:
+            return iter(rarest)
+        client_documents = self.client_documents.get(client_id, {})
+        if len(client_documents) < len(rarest):
+            return (doc_id for doc_id in client_documents if doc_id in rarest)
+        return (
+            doc_id
+            for doc_id in rarest
+            if self.documents[doc_id].client_id == client_id
+        )
+
+    def search(
+        self,
+        query: str,
+        client_id: Optional[str] = None,
+        limit: int = 20,
+        offset: int = 0,
+    ) -> SearchPage:
+        if limit < 1 or offset < 0:
+            raise ValueError("The limit must be at least 1 and the offset positive")
+        start = time.perf_counter()
+        terms, phrases = parse_query(query)
+        query_terms = list(dict.fromkeys([*terms, *(t for p in phrases for t in p)]))
+        if not query_terms or any(term not in self.postings for term in query_terms):
+            return SearchPage([], 0, None, time.perf_counter() - start)
+
+        query_terms.sort(key=lambda term: len(self.postings[term]))
+        postings = [self.postings[term] for term in query_terms]
+        others = postings[1:]
+        document_count = len(self.documents)
+        average_length = self.total_length / document_count
+        idfs = [
+            math.log(1 + (document_count - len(p) + 0.5) / (len(p) + 0.5))
+            for p in postings
+        ]
+
+        # floats and ints only, a list of tuples would make the GC scan the index
+        scores: List[float] = []
+        doc_ids: List[int] = []
+        documents = self.documents
+        length_norm = K1 * B / average_length
+        for doc_id in self._candidates(postings, client_id):
+            if others and not all(doc_id in other for other in others):
+                continue
+            if phrases and not all(
+                self._contains_phrase(doc_id, phrase) for phrase in phrases
+            ):
+                continue
+            norm = K1 * (1 - B) + length_norm * documents[doc_id].length
+            score = 0.0
+            for idf, term_postings in zip(idfs, postings):
+                frequency = len(term_postings[doc_id])
+                score += idf * frequency * (K1 + 1) / (frequency + norm)
+            scores.append(score)
+            doc_ids.append(doc_id)
+
+        # best score first, then newest first
+        top = heapq.nlargest(
+            offset + limit,
+            range(len(scores)),
+            key=lambda i: (scores[i], doc_ids[i]),
+        )[offset:]
+        results = [
+            SearchResult(
+                documents[doc_ids[i]].message.to_message(documents[doc_ids[i]].client_id),
+                scores[i],
+            )
+            for i in top
+        ]
+        next_offset = offset + limit if offset + limit < len(scores) else None
+        return SearchPage(results, len(scores), next_offset, time.perf_counter() - start)
+
+    def _contains_phrase(self, doc_id: int, phrase: List[str]) -> bool:
+        # positions where the phrase may start, the positions tuples are short
+        starts = self.postings[phrase[0]][doc_id]
+        for i, term in enumerate(phrase[1:], 1):
+            positions = self.postings[term][doc_id]
+            starts = [start for start in starts if start + i in positions]
+            if not starts:
+                return False
+        return True
+
+    def memory_usage(self) -> dict:
+        return {
+            "documents": len(self.documents),
+            "terms": len(self.postings),
+            "bytes": self.used_bytes,
+            "max_bytes": self.max_bytes,
+            "evicted_documents": self.evicted_documents,
+        }
+
+
+class SearchableChatHistory(IChatHistory):
+    """
+    Chat history whose messages are also added to a SearchIndex.
+    The messages already in the history are indexed in the background by start
+    """
+
+    def __init__(self, chat_history: IChatHistory, search_index: SearchIndex) -> None:
+        self.chat_history = chat_history
+        self.search_index = search_index
+        self._indexing_task: Optional[asyncio.Task] = None
+        # messages added while index_history runs, they are indexed already
+        self._added_while_indexing: Optional[Set[uuid.UUID]] = None
+
+    def __getattr__(self, name: str):
+        # statistics of the history, like used_bytes or queue_depth
+        return getattr(self.chat_history, name)
+
+    def add_chat_message(self, client_id: str, message: ChatHistoryMessage) -> None:
+        self.chat_history.add_chat_message(client_id, message)
+        self.search_index.add(client_id, message)
+        if self._added_while_indexing is not None:
+            self._added_while_indexing.add(message.id)
+
+    async def index_history(self, batch_size: int = 1000) -> None:
+        """
+        Index the messages already in the history, letting the event loop run
+        every batch_size messages
+        """
+        self._added_while_indexing = set()
+        try:
+            indexed = 0
+            for client_id in self.chat_history.client_ids():
+                for message in self.chat_history.iter_chat_history(client_id):
+                    if message.id not in self._added_while_indexing:
+                        self.search_index.add(client_id, message)
+                    indexed += 1
+                    if indexed % batch_size == 0:
+                        await asyncio.sleep(0)
+        finally:
+            self._added_while_indexing = None
+
+    def get_all_chat_history(self, client_id: str) -> List[ChatHistoryMessage]:
+        return self.chat_history.get_all_chat_history(client_id)
+
+    def get_chat_history_page(
+        self,
+        client_id: str,
+        limit: int = 50,
+        cursor: Optional[str] = None,
+        order: ChatHistoryOrder = ChatHistoryOrder.NEWEST_FIRST,
+        start_time: Optional[str] = None,
+        end_time: Optional[str] = None,
+    ) -> ChatHistoryPage:
+        return self.chat_history.get_chat_history_page(
+            client_id, limit, cursor, order, start_time, end_time
+        )
+
+    def client_ids(self) -> List[str]:
+        return self.chat_history.client_ids()
+
+    def iter_client_ids(self, page_size: int = 500) -> Iterator[str]:
+        return self.chat_history.iter_client_ids(page_size)
+
+    def search(
+        self,
+        query: str,
+        client_id: Optional[str] = None,
+        limit: int = 20,
+        offset: int = 0,
+    ) -> SearchPage:
+        return self.search_index.search(query, client_id, limit, offset)
+
+    def start(self) -> None:
+        self.chat_history.start()
+        self._indexing_task = asyncio.create_task(self.index_history())
+
+    async def close(self) -> None:
+        if self._indexing_task is not None:
+            self._indexing_task.cancel()
+            await asyncio.gather(self._indexing_task, return_exceptions=True)
+        await self.chat_history.close()
@@ -0,0 +1,98 @@
+import asyncio
+
+import pytest
+
+from chat_history.chat_history import ChatHistory
+from chat_history.chat_history_test import new_message
+from chat_history.search_index import (
+    SearchableChatHistory,
+    SearchIndex,
+    parse_query,
+)
+
+
+def texts(page) -> list:
+    return [result.message.text for result in page.results]
+
+
+def test_parse_query():
+    assert parse_query('Hello "good  Morning" "bot"') == (
+        ["hello", "bot"],
+        [["good", "morning"]],
+    )
+
+
+def test_terms_and_phrases():
+    index = SearchIndex()
+    for client_id, text in [
+        ("1", "good morning bot"),
+        ("1", "morning, good bot"),
+        ("2", "Good morning to you"),
+        ("2", "good night"),
+    ]:
+        index.add(client_id, new_message(client_id, text))
+
+    assert sorted(texts(index.search("good morning"))) == [
+        "Good morning to you",
+        "good morning bot",
+        "morning, good bot",
+    ]
+    assert sorted(texts(index.search('"good morning"'))) == [
+        "Good morning to you",
+        "good morning bot",
+    ]
+    assert texts(index.search('"good morning"', client_id="1")) == ["good morning bot"]
+    assert texts(index.search("night", client_id="1")) == []
+    assert texts(index.search("evening")) == []
+    assert texts(index.search("")) == []
+
+
+def test_ranking_and_pages():
+    index = SearchIndex()
+    index.add("1", new_message("1", "hello"))
+    index.add("1", new_message("1", "hello hello world"))
+    index.add("1", new_message("1", "a long message saying hello once among many words"))
+
+    page = index.search("hello", limit=2)
+    assert texts(page) == ["hello hello world", "hello"]
+    assert page.total == 3
+    assert page.results[0].score > page.results[1].score
+
+    page = index.search("hello", limit=2, offset=page.next_offset)
+    assert texts(page) == ["a long message saying hello once among many words"]
+    assert page.next_offset is None
+    with pytest.raises(ValueError):
+        index.search("hello", limit=0)
+
+
+def test_bounded_memory():
+    index = SearchIndex(max_bytes=5000)
+    for i in range(100):
+        index.add(str(i % 3), new_message(str(i % 3), f"message number {i}"))
+
+    assert index.used_bytes <= index.max_bytes
+    assert 0 < len(index.documents) < 100
+    assert index.evicted_documents == 100 - len(index.documents)
+    # the oldest messages left the index, their terms too
+    assert texts(index.search("0")) == []
+    assert texts(index.search("99")) == ["message number 99"]
+    assert index.search("message").total == len(index.documents)
+
+
+@pytest.mark.asyncio
+async def test_searchable_chat_history():
+    chat_history = ChatHistory()
+    # more than a page of the history
+    for i in range(600):
+        chat_history.add_chat_message("1", new_message("1", f"before {i}"))
+    searchable = SearchableChatHistory(chat_history, SearchIndex())
+    indexing = asyncio.create_task(searchable.index_history(batch_size=2))
+    await asyncio.sleep(0)
+    # a message added while the history is indexed is not indexed twice
+    searchable.add_chat_message("1", new_message("1", "after"))
+    await indexing
+
+    assert searchable.search("before").total == 600
+    assert texts(searchable.search("after")) == ["after"]
+    assert len(searchable.get_all_chat_history("1")) == 601
+    assert searchable.message_count == 601
@@ -0,0 +1,470 @@
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import heapq
+import logging
+import os
+import sqlite3
+import threading
+from typing import Deque, Dict, Iterator, List, Optional, Tuple
+import uuid
+
+from chat_history.chat_history import (
+    ChatHistoryMessage,
+    ChatHistoryMessageType,
+    ChatHistoryOrder,
+    ChatHistoryPage,
+    IChatHistory,
+    PagePosition,
+    decode_cursor,
+    encode_cursor,
+)
+
+logger = logging.getLogger("chatserver.chat_history")
+
+# PRAGMA synchronous of every durability mode:
+# off: batches are handed to the OS, a crash of the machine can lose any of them
+# normal: WAL is synced at checkpoints, a crash of the machine can lose the last batches
+# full: every batch is synced to disk before the next one is written
+DURABILITY_MODES = {"off": "OFF", "normal": "NORMAL", "full": "FULL"}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chat_messages (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    client_id TEXT NOT NULL,
+    id BLOB NOT NULL,
+    type INTEGER NOT NULL,
+    text TEXT,
+    audio_url TEXT,
+    image_url TEXT,
+    video_url TEXT,
+    time TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS chat_messages_client ON chat_messages (client_id, seq);
+CREATE INDEX IF NOT EXISTS chat_messages_client_time
+    ON chat_messages (client_id, time, seq);
+CREATE TABLE IF NOT EXISTS chat_message_seq (next_seq INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS chat_message_log (
+    position INTEGER PRIMARY KEY AUTOINCREMENT,
+    seq INTEGER NOT NULL
+);
+BEGIN IMMEDIATE;
+INSERT INTO chat_message_seq
+    SELECT (SELECT COALESCE(MAX(seq), 0) + 1 FROM chat_messages)
+    WHERE NOT EXISTS (SELECT 1 FROM chat_message_seq);
+INSERT INTO chat_message_log (seq)
+    SELECT seq FROM chat_messages
+    WHERE NOT EXISTS (SELECT 1 FROM chat_message_log)
+    ORDER BY seq;
+COMMIT;
+"""
+
+# seqs reserved at a time by every SqliteChatHistory sharing the database
+SEQ_BLOCK_SIZE = 10000
+
+INSERT = """
+INSERT INTO chat_messages
+    (seq, client_id, id, type, text, audio_url, image_url, video_url, time)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+INSERT_LOG = "INSERT INTO chat_message_log (seq) VALUES (?)"
+
+COLUMNS = "seq, id, type, text, audio_url, image_url, video_url, time"
+
+SELECT_CLIENT = f"""
+SELECT {COLUMNS} FROM chat_messages WHERE client_id = ? ORDER BY time, seq
+"""
+
+SELECT_CLIENT_IDS = "SELECT DISTINCT client_id FROM chat_messages"
+
+SELECT_LOG = f"""
+SELECT position, client_id, {COLUMNS}
+FROM chat_message_log JOIN chat_messages USING (seq)
+WHERE position > ? ORDER BY position LIMIT ?
+"""
+
+Row = Tuple[
+    int, str, bytes, int, Optional[str], Optional[str], Optional[str], Optional[str], str
+]
+
+
+def to_row(seq: int, client_id: str, message: ChatHistoryMessage) -> Row:
+    return (
+        seq,
+        client_id,
+        message.id.bytes,
+        message.type.value,
+        message.text,
+        message.audio_url,
+        message.image_url,
+        message.video_url,
+        message.time,
+    )
+
+
+def from_row(client_id: str, row: tuple) -> ChatHistoryMessage:
+    _, id, type, text, audio_url, image_url, video_url, time = row
+    return ChatHistoryMessage(
+        id=uuid.UUID(bytes=id),
+        client_id=client_id,
+        text=text,
+        audio_url=audio_url,
+        image_url=image_url,
+        video_url=video_url,
+        type=ChatHistoryMessageType(type),
+        time=time,
+    )
+
+
+class SqliteChatHistory(IChatHistory):
+    """
+    Chat history persisted in a SQLite database in WAL mode.
+
+    add_chat_message only puts the message in a queue, a background task
+    writes the queue in batches of up to batch_size messages, or what is
+    queued after flush_interval seconds, from a dedicated thread.
+    When max_queue messages are waiting, new messages are dropped and counted,
+    as are the messages of a batch that can not be written.
+    What was committed before a restart is read back from the database.
+
+    Every message gets its seq when it is added, so the queued messages
+    are ordered and paginated with the committed ones. Seqs are reserved in
+    the database SEQ_BLOCK_SIZE at a time, so that several processes can
+    write to the same database, the next block is reserved in the background
+    and the messages added if it is not ready yet wait for it. The seqs of every batch are also appended
+    to a log, which read_committed follows in the order of the commits
+    """
+
+    def __init__(
+        self,
+        path: str,
+        durability: str = "normal",
+        batch_size: int = 500,
+        flush_interval: float = 0.05,
+        max_queue: int = 100000,
+    ) -> None:
+        if durability not in DURABILITY_MODES:
+            raise ValueError(f"Unknown chat history durability: {durability}")
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.durability = durability
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.dropped = 0
+        # every write goes through the connection of the single writer thread
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="chat-history")
+        self._write_connection = self._executor.submit(self._connect).result()
+        # readers may be threads of a server, every thread has its connection
+        self._readers = threading.local()
+        self._read_connections: Dict[threading.Thread, sqlite3.Connection] = {}
+        self._read_connections_lock = threading.Lock()
+        # seqs of the current block, and the next block once it is reserved
+        self._next_seq, self._seq_end = self._executor.submit(
+            self._reserve_seqs
+        ).result()
+        self._next_block: Optional[Tuple[int, int]] = None
+        self._reserving: Optional[asyncio.Task] = None
+        # messages added while no seq was left, they get one once a block is reserved
+        self._unsequenced: Deque[Tuple[str, ChatHistoryMessage]] = deque()
+        # messages not written yet, readers see them until they are committed
+        self._queue: Deque[Row] = deque()
+        self._writing: List[Row] = []
+        self._queued = asyncio.Event()
+        self._batch_ready = asyncio.Event()
+        self._closing = False
+        self._writer_task: Optional[asyncio.Task] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute(f"PRAGMA synchronous={DURABILITY_MODES[self.durability]}")
+        connection.executescript(SCHEMA)
+        return connection
+
+    @property
+    def _read_connection(self) -> sqlite3.Connection:
+        connection = getattr(self._readers, "connection", None)
+        if connection is None:
+            # the schema is created by the writer, the database is in WAL mode
+            connection = sqlite3.connect(self.path, check_same_thread=False)
+            with self._read_connections_lock:
+                for thread in [
+                    thread for thread in self._read_connections if not thread.is_alive()
+                ]:
+                    self._read_connections.pop(thread).close()
+                self._read_connections[threading.current_thread()] = connection
+            self._readers.connection = connection
+        return connection
+
+    def _reserve_seqs(self) -> Tuple[int, int]:
+        """
+        Reserve the next SEQ_BLOCK_SIZE seqs, from the writer thread
+        """
+        with self._write_connection:
+            ((end,),) = self._write_connection.execute(
+                "UPDATE chat_message_seq SET next_seq = next_seq + ? RETURNING next_seq",
+                (SEQ_BLOCK_SIZE,),
+            ).fetchall()
+        return end - SEQ_BLOCK_SIZE, end
+
+    def _take_seq(self) -> Optional[int]:
+        """
+        The next seq, None while the next block is being reserved
+        """
+        if self._next_seq == self._seq_end:
+            if self._next_block is None:
+                self._reserve_next_block()
+                return None
+            (self._next_seq, self._seq_end), self._next_block = self._next_block, None
+        seq = self._next_seq
+        self._next_seq += 1
+        return seq
+
+    def _reserve_next_block(self) -> None:
+        if self._next_block is None and self._reserving is None:
+            self._reserving = asyncio.create_task(self._reserve_next_block_async())
+
+    async def _reserve_next_block_async(self) -> None:
+        # the reservation waits for the writer thread, never on the event loop
+        try:
+            self._next_block = await asyncio.get_running_loop().run_in_executor(
+                self._executor, self._reserve_seqs
+            )
+        except sqlite3.Error:
+            # the next message tries again
+            logger.exception("Can not reserve chat history seqs")
+            return
+        finally:
+            self._reserving = None
+        while self._unsequenced:
+            seq = self._take_seq()
+            if seq is None:
+                return
+            client_id, message = self._unsequenced.popleft()
+            self._enqueue(to_row(seq, client_id, message))
+
+    @property
+    def queue_depth(self) -> int:
+        """
+        Messages waiting to be committed
+        """
+        return len(self._queue) + len(self._writing) + len(self._unsequenced)
+
+    def add_chat_message(self, client_id: str, message: ChatHistoryMessage) -> None:
+        if len(self._queue) + len(self._unsequenced) >= self.max_queue:
+            self.dropped += 1
+            logger.warning("Chat history queue is full, message dropped")
+            return
+        # messages keep their order, none gets a seq before the waiting ones
+        seq = None if self._unsequenced else self._take_seq()
+        if seq is None:
+            self._unsequenced.append((client_id, message))
+            self._reserve_next_block()
+            return
+        self._enqueue(to_row(seq, client_id, message))
+
+    def _enqueue(self, row: Row) -> None:
+        # the writer never stops before close, unless a bug killed it
+        if self._writer_task is None or self._writer_task.done():
+            self._writer_task = asyncio.create_task(self._write_forever())
+        self._queue.append(row)
+        self._queued.set()
+        if len(self._queue) >= self.batch_size:
+            self._batch_ready.set()
+
+    async def _write_forever(self) -> None:
+        while True:
+            await self._queued.wait()
+            if len(self._queue) < self.batch_size and not self._closing:
+                try:
+                    await asyncio.wait_for(self._batch_ready.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            batch = [
+                self._queue.popleft()
+                for _ in range(min(self.batch_size, len(self._queue)))
+            ]
+            if len(self._queue) < self.batch_size:
+                self._batch_ready.clear()
+            if not self._queue:
+                self._queued.clear()
+            await self._write(batch)
+            if self._closing and not self._queue:
+                return
+
+    async def _write(self, batch: List[Row]) -> None:
+        self._writing = batch
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                self._executor, self._write_batch, batch
+            )
+        except Exception:
+            # the writer keeps going, the messages of the batch are lost
+            self.dropped += len(batch)
+            logger.exception("Can not write %d chat history messages", len(batch))
+        finally:
+            self._writing = []
+        # the next block of seqs is reserved before the current one runs out
+        if not self._closing and self._seq_end - self._next_seq < SEQ_BLOCK_SIZE // 2:
+            self._reserve_next_block()
+
+    def _write_batch(self, batch: List[Row]) -> None:
+        with self._write_connection:
+            self._write_connection.executemany(INSERT, batch)
+            self._write_connection.executemany(INSERT_LOG, [row[:1] for row in batch])
+
+    def _pending_rows(self, client_id: str) -> Dict[int, tuple]:
+        # the batch being written may be committed already, rows are merged by seq
+        return {
+            row[0]: row[:1] + row[2:]
+            for row in [*self._writing, *self._queue]
+            if row[1] == client_id
+        }
+
+    def get_all_chat_history(self, client_id: str) -> List[ChatHistoryMessage]:
+        rows = {
+            row[0]: row
+            for row in self._read_connection.execute(SELECT_CLIENT, (client_id,))
+        }
+        rows.update(self._pending_rows(client_id))
+        # seqs come in blocks of every process, the time orders the messages
+        messages = [
+            from_row(client_id, row)
+            for row in sorted(rows.values(), key=lambda row: (row[-1], row[0]))
+        ]
+        # messages waiting for a seq are the newest, pages only see them later
+        messages.extend(
+            message for other_id, message in self._unsequenced if other_id == client_id
+        )
+        return messages
+
+    def get_chat_history_page(
+        self,
+        client_id: str,
+        limit: int = 50,
+        cursor: Optional[str] = None,
+        order: ChatHistoryOrder = ChatHistoryOrder.NEWEST_FIRST,
+        start_time: Optional[str] = None,
+        end_time: Optional[str] = None,
+    ) -> ChatHistoryPage:
+        if limit < 1:
+            raise ValueError("The page limit must be at least 1")
+        position = decode_cursor(cursor) if cursor is not None else None
+        newest_first = order is ChatHistoryOrder.NEWEST_FIRST
+
+        def in_page(time: str, seq: int) -> bool:
+            if start_time is not None and time < start_time:
+                return False
+            if end_time is not None and time >= end_time:
+                return False
+            if position is not None:
+                return (time, seq) < position if newest_first else (time, seq) > position
+            return True
+
+        # keyset pagination on the (client_id, time, seq) index
+        conditions = ["client_id = ?"]
+        params: list = [client_id]
+        if start_time is not None:
+            conditions.append("time >= ?")
+            params.append(start_time)
+        if end_time is not None:
+            conditions.append("time < ?")
+            params.append(end_time)
+        if position is not None:
+            conditions.append(f"(time, seq) {'<' if newest_first else '>'} (?, ?)")
+            params.extend(position)
+        direction = "DESC" if newest_first else "ASC"
+        query = (
+            f"SELECT {COLUMNS} FROM chat_messages WHERE {' AND '.join(conditions)} "
+            f"ORDER BY time {direction}, seq {direction} LIMIT ?"
+        )
+        rows = {
+            row[0]: row
+            for row in self._read_connection.execute(query, (*params, limit + 1))
+        }
+        # messages not committed yet are few, they are filtered here
+        for seq, row in self._pending_rows(client_id).items():
+            if in_page(row[-1], seq):
+                rows[seq] = row
+
+        def row_position(row: tuple) -> PagePosition:
+            return row[-1], row[0]
+
+        page = sorted(rows.values(), key=row_position, reverse=newest_first)
+        return ChatHistoryPage(
+            [from_row(client_id, row) for row in page[:limit]],
+            encode_cursor(row_position(page[limit - 1])) if len(page) > limit else None,
+        )
+
+    def read_committed(
+        self, position: int = 0, limit: int = 1000
+    ) -> Tuple[int, List[Tuple[str, ChatHistoryMessage]]]:
+        """
+        Up to limit messages committed by any process after the log position,
+        with their client_id, and the position of the last one
+        """
+        messages = []
+        for row in self._read_connection.execute(SELECT_LOG, (position, limit)):
+            position, client_id = row[:2]
+            messages.append((client_id, from_row(client_id, row[2:])))
+        return position, messages
+
+    def client_ids(self) -> List[str]:
+        return list(self.iter_client_ids())
+
+    def iter_client_ids(self, page_size: int = 500) -> Iterator[str]:
+        pending = {row[1] for row in [*self._writing, *self._queue]}
+        pending.update(client_id for client_id, _ in self._unsequenced)
+        previous = None
+        for client_id in heapq.merge(
+            self._iter_committed_client_ids(page_size), sorted(pending)
+        ):
+            if client_id != previous:
+                yield client_id
+                previous = client_id
+
+    def _iter_committed_client_ids(self, page_size: int) -> Iterator[str]:
+        # DISTINCT is read from the (client_id, seq) index, page after page
+        query = f"{SELECT_CLIENT_IDS} ORDER BY client_id LIMIT ?"
+        params: tuple = (page_size,)
+        while True:
+            client_ids = [
+                client_id
+                for (client_id,) in self._read_connection.execute(query, params)
+            ]
+            yield from client_ids
+            if len(client_ids) < page_size:
+                return
+            query = (
+                f"{SELECT_CLIENT_IDS} WHERE client_id > ? ORDER BY client_id LIMIT ?"
+            )
+            params = (client_ids[-1], page_size)
+
+    async def close(self) -> None:
+        """
+        Write the queued messages and close the database
+        """
+        if self._unsequenced:
+            self._reserve_next_block()
+        if self._reserving is not None:
+            await self._reserving
+        if self._unsequenced:
+            self.dropped += len(self._unsequenced)
+            logger.error(
+                "%d chat history messages never got a seq", len(self._unsequenced)
+            )
+        if self._writer_task is not None:
+            self._closing = True
+            self._queued.set()
+            self._batch_ready.set()
+            await self._writer_task
+            self._writer_task = None
+        self._executor.submit(self._write_connection.close).result()
+        self._executor.shutdown()
+        with self._read_connections_lock:
+            for connection in self._read_connections.values():
+                connection.close()
+            self._read_connections.clear()
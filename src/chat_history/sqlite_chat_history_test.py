@@ -0,0 +1,212 @@
+import asyncio
+import threading
+import uuid
+
+import pytest
+
+from chat_history.chat_history import (
+    ChatHistory,
+    ChatHistoryMessage,
+    ChatHistoryMessageType,
+    ChatHistoryOrder,
+)
+from chat_history.chat_history_test import read_pages
+from chat_history import sqlite_chat_history
+from chat_history.sqlite_chat_history import SqliteChatHistory
+
+
+def new_message(
+    client_id: str, text: str, time: str = "2024-01-01 00:00:00"
+) -> ChatHistoryMessage:
+    return ChatHistoryMessage(
+        id=uuid.uuid4(),
+        client_id=client_id,
+        text=text,
+        audio_url=None,
+        image_url=None,
+        video_url=None,
+        type=ChatHistoryMessageType.USER,
+        time=time,
+    )
+
+
+@pytest.mark.asyncio
+async def test_write_behind(tmp_path):
+    path = str(tmp_path / "history.db")
+    chat_history = SqliteChatHistory(path, batch_size=3, flush_interval=60)
+    messages = [new_message("1", str(i)) for i in range(4)]
+    for message in messages:
+        chat_history.add_chat_message("1", message)
+    chat_history.add_chat_message("2", new_message("2", "other"))
+
+    # queued messages are read before they are written
+    assert chat_history.queue_depth == 5
+    assert chat_history.get_all_chat_history("1") == messages
+
+    # a full batch is written without waiting for flush_interval
+    for _ in range(100):
+        if chat_history.queue_depth == 2:
+            break
+        await asyncio.sleep(0.01)
+    assert chat_history.queue_depth == 2
+    assert chat_history.get_all_chat_history("1") == messages
+
+    # close writes what is left, the history is read back after a restart
+    await chat_history.close()
+    chat_history = SqliteChatHistory(path, durability="full")
+    assert chat_history.get_all_chat_history("1") == messages
+    assert [m.text for m in chat_history.get_all_chat_history("2")] == ["other"]
+    await chat_history.close()
+
+
+@pytest.mark.asyncio
+async def test_shared_database(tmp_path, monkeypatch):
+    monkeypatch.setattr(sqlite_chat_history, "SEQ_BLOCK_SIZE", 4)
+    path = str(tmp_path / "history.db")
+    # two processes writing to the same database, like the workers of a server
+    first = SqliteChatHistory(path, flush_interval=0.01)
+    second = SqliteChatHistory(path, flush_interval=0.01)
+    for i in range(10):
+        first.add_chat_message("1", new_message("1", str(i)))
+        second.add_chat_message("2", new_message("2", str(i)))
+        await asyncio.sleep(0.01)
+    # the seq block of the second process comes after the one of the first
+    second.add_chat_message("3", new_message("3", "first", "2024-01-01 00:00:00"))
+    first.add_chat_message("3", new_message("3", "second", "2024-01-01 00:00:01"))
+    await first.close()
+    await second.close()
+    assert first.dropped == second.dropped == 0
+
+    chat_history = SqliteChatHistory(path)
+    for client_id in ["1", "2"]:
+        assert [m.text for m in chat_history.get_all_chat_history(client_id)] == [
+            str(i) for i in range(10)
+        ]
+    assert [m.text for m in chat_history.get_all_chat_history("3")] == [
+        "first",
+        "second",
+    ]
+    await chat_history.close()
+
+
+@pytest.mark.asyncio
+async def test_seqs_are_reserved_in_the_background(tmp_path, monkeypatch):
+    monkeypatch.setattr(sqlite_chat_history, "SEQ_BLOCK_SIZE", 4)
+    chat_history = SqliteChatHistory(str(tmp_path / "history.db"), flush_interval=0.01)
+    reserve_seqs = chat_history._reserve_seqs
+    reserved_from = []
+
+    def record_thread():
+        reserved_from.append(threading.current_thread())
+        return reserve_seqs()
+
+    chat_history._reserve_seqs = record_thread
+    messages = [new_message("1", str(i)) for i in range(10)]
+    for message in messages:
+        chat_history.add_chat_message("1", message)
+    # the messages past the block wait for the next one, and are read meanwhile
+    assert chat_history.queue_depth == 10
+    assert chat_history.get_all_chat_history("1") == messages
+
+    await asyncio.sleep(0.1)
+    assert chat_history.queue_depth == 0
+    # never from the event loop
+    assert reserved_from and threading.main_thread() not in reserved_from
+    assert chat_history.get_all_chat_history("1") == messages
+    assert sum(read_pages(chat_history, "1", limit=3), []) == [
+        str(i) for i in reversed(range(10))
+    ]
+    await chat_history.close()
+
+
+@pytest.mark.asyncio
+async def test_flush_interval_and_full_queue(tmp_path):
+    chat_history = SqliteChatHistory(
+        str(tmp_path / "history.db"), flush_interval=0.01, max_queue=2
+    )
+    for i in range(3):
+        chat_history.add_chat_message("1", new_message("1", str(i)))
+    assert chat_history.dropped == 1
+
+    await asyncio.sleep(0.1)
+    assert chat_history.queue_depth == 0
+    assert [m.text for m in chat_history.get_all_chat_history("1")] == ["0", "1"]
+    await chat_history.close()
+
+
+@pytest.mark.asyncio
+async def test_failed_batch_is_counted(tmp_path):
+    chat_history = SqliteChatHistory(str(tmp_path / "history.db"), flush_interval=0.01)
+    invalid = new_message("1", "no time")
+    invalid.time = None
+    chat_history.add_chat_message("1", new_message("1", "lost"))
+    chat_history.add_chat_message("1", invalid)
+    await asyncio.sleep(0.1)
+    # the batch is rolled back and the writer keeps going
+    assert chat_history.dropped == 2
+    assert chat_history.get_all_chat_history("1") == []
+
+    chat_history.add_chat_message("1", new_message("1", "written"))
+    await asyncio.sleep(0.1)
+    assert chat_history.queue_depth == 0
+    assert [m.text for m in chat_history.get_all_chat_history("1")] == ["written"]
+    await chat_history.close()
+
+
+@pytest.mark.asyncio
+async def test_pages(tmp_path):
+    chat_history = SqliteChatHistory(
+        str(tmp_path / "history.db"), batch_size=4, flush_interval=60
+    )
+    memory_history = ChatHistory()
+    for i in range(10):
+        # the clock of the client goes back after the fifth message
+        message = new_message("1", str(i), f"2024-01-01 00:00:{(i + 5) % 10:02}")
+        chat_history.add_chat_message("1", message)
+        memory_history.add_chat_message("1", message)
+    await asyncio.sleep(0.05)
+    # committed and queued messages are paginated together
+    assert 0 < chat_history.queue_depth < 10
+
+    for kwargs in [
+        {"limit": 3},
+        {"limit": 4, "order": ChatHistoryOrder.OLDEST_FIRST},
+        {
+            "limit": 2,
+            "start_time": "2024-01-01 00:00:02",
+            "end_time": "2024-01-01 00:00:07",
+        },
+    ]:
+        assert read_pages(chat_history, "1", **kwargs) == read_pages(
+            memory_history, "1", **kwargs
+        )
+    await chat_history.close()
+
+
+@pytest.mark.asyncio
+async def test_client_ids_and_readers(tmp_path):
+    chat_history = SqliteChatHistory(
+        str(tmp_path / "history.db"), batch_size=4, flush_interval=60
+    )
+    for client_id in ["c", "a", "e", "b", "d", "a"]:
+        chat_history.add_chat_message(client_id, new_message(client_id, "hello"))
+    await asyncio.sleep(0.05)
+    # committed and queued clients are listed together, page by page
+    assert chat_history.queue_depth == 2
+    assert list(chat_history.iter_client_ids(page_size=2)) == ["a", "b", "c", "d", "e"]
+
+    # every thread reads from its own connection
+    connections = [chat_history._read_connection]
+    thread = threading.Thread(
+        target=lambda: connections.append(chat_history._read_connection)
+    )
+    thread.start()
+    thread.join()
+    assert connections[0] is not connections[1]
+    assert connections[0] is chat_history._read_connection
+    await chat_history.close()
+
+
+def test_durability():
+    with pytest.raises(ValueError):
+        SqliteChatHistory(":memory:", durability="sometimes")
@@ -0,0 +1,207 @@
+import asyncio
+from collections import deque
+from dataclasses import dataclass, field
+import logging
+from typing import Awaitable, Callable, Deque, Optional, Set
+
+from chatserver.concurrency_control import AcquireResult, IConcurrencyControl
+from chatserver.config import Config
+
+logger = logging.getLogger("chatserver.admission_queue")
+
+
+@dataclass
+class AdmissionWaiter:
+    client_id: str
+    # None while waiting, then True if a connection slot was acquired
+    admitted: Optional[bool] = None
+    # set when the waiter is admitted, rejected or its position changes
+    changed: asyncio.Event = field(default_factory=asyncio.Event)
+
+
+# called with the position in the queue (1 is the next to be admitted)
+# and the estimated wait in seconds, None when not known yet
+PositionCallback = Callable[[int, Optional[float]], Awaitable[None]]
+
+
+class AdmissionQueue:
+    """
+    FIFO queue of connections waiting for a slot when the server is full.
+
+    Waiters are woken up when the concurrency control backend reports that a
+    slot was released on any node, they never poll it.
+    The order is only guaranteed between waiters of the same node
+    """
+
+    def __init__(
+        self,
+        concurrency_control: IConcurrencyControl,
+        max_length: Optional[int] = None,
+        timeout: Optional[float] = None,
+    ) -> None:
+        self.concurrency_control = concurrency_control
+        self.max_length = (
+            Config.ADMISSION_QUEUE_MAX_LENGTH if max_length is None else max_length
+        )
+        self.timeout = Config.ADMISSION_QUEUE_TIMEOUT if timeout is None else timeout
+        self.waiters: Deque[AdmissionWaiter] = deque()
+        # moving average of the seconds between two admissions from the queue
+        self.admission_interval: Optional[float] = None
+        self._last_admission: Optional[float] = None
+        self._draining = False
+        self._wake_up_again = False
+        self._background_tasks: Set[asyncio.Task] = set()
+        concurrency_control.add_release_listener(self.wake_up)
+
+    @property
+    def length(self) -> int:
+        return len(self.waiters)
+
+    def estimated_wait(self, position: int) -> Optional[float]:
+        if self.admission_interval is None:
+            return None
+        return position * self.admission_interval
+
+    def join(self, client_id: str) -> Optional[AdmissionWaiter]:
+        """
+        Take a place at the end of the queue, None if the queue is full.
+        The waiter is passed to acquire, or to cancel if it never waits
+        """
+        if len(self.waiters) >= self.max_length:
+            return None
+        waiter = AdmissionWaiter(client_id)
+        self.waiters.append(waiter)
+        if len(self.waiters) == 1:
+            # a slot may have been released between our attempt and joining the queue
+            self.wake_up()
+        return waiter
+
+    def cancel(self, waiter: AdmissionWaiter) -> None:
+        """
+        Leave the queue, releasing the slot if the waiter was already admitted
+        """
+        if waiter.admitted:
+            self._run_in_background(
+                self.concurrency_control.release_connection(waiter.client_id)
+            )
+        waiter.admitted = False
+        self._remove(waiter)
+
+    async def acquire(
+        self,
+        client_id: str,
+        on_position: Optional[PositionCallback] = None,
+        waiter: Optional[AdmissionWaiter] = None,
+    ) -> bool:
+        """
+        Acquire a connection slot for the client, waiting in the queue if the
+        server is full, from the place of waiter if it already joined the queue.
+        Return False if the client is at its own limit, the queue is full or no
+        slot was freed in time
+        """
+        if waiter is None:
+            if not self.waiters:
+                result = await self.concurrency_control.try_acquire_connection(
+                    client_id
+                )
+                if result == AcquireResult.ACQUIRED:
+                    return True
+                if result == AcquireResult.CLIENT_FULL:
+                    return False
+            waiter = self.join(client_id)
+            if waiter is None:
+                return False
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout
+        try:
+            while waiter.admitted is None:
+                if on_position:
+                    position = self.waiters.index(waiter) + 1
+                    await on_position(position, self.estimated_wait(position))
+                    if waiter.admitted is not None:
+                        break
+                waiter.changed.clear()
+                try:
+                    await asyncio.wait_for(
+                        waiter.changed.wait(), deadline - loop.time()
+                    )
+                except asyncio.TimeoutError:
+                    break
+        except BaseException:
+            if waiter.admitted:
+                self._run_in_background(
+                    self.concurrency_control.release_connection(client_id)
+                )
+            raise
+        finally:
+            self._remove(waiter)
+
+        return bool(waiter.admitted)
+
+    def wake_up(self) -> None:
+        """
+        Admit waiters in order until the server is full again
+        """
+        if not self.waiters:
+            return
+        if self._draining:
+            self._wake_up_again = True
+            return
+        self._draining = True
+        self._run_in_background(self._drain())
+
+    async def _drain(self) -> None:
+        try:
+            while True:
+                self._wake_up_again = False
+                while self.waiters:
+                    waiter = self.waiters[0]
+                    result = await self.concurrency_control.try_acquire_connection(
+                        waiter.client_id
+                    )
+                    if waiter.admitted is not None or waiter not in self.waiters:
+                        # the waiter gave up while we were acquiring its slot
+                        if result == AcquireResult.ACQUIRED:
+                            await self.concurrency_control.release_connection(
+                                waiter.client_id
+                            )
+                        continue
+                    if result == AcquireResult.SERVER_FULL:
+                        break
+                    waiter.admitted = result == AcquireResult.ACQUIRED
+                    if waiter.admitted:
+                        self._record_admission()
+                    self._remove(waiter)
+                if not self._wake_up_again:
+                    break
+        except Exception as e:
+            logger.error("Can not admit waiting connections: %s", e)
+        finally:
+            self._draining = False
+
+    def _record_admission(self) -> None:
+        now = asyncio.get_running_loop().time()
+        if self._last_admission is not None:
+            interval = now - self._last_admission
+            if self.admission_interval is None:
+                self.admission_interval = interval
+            else:
+                self.admission_interval = 0.8 * self.admission_interval + 0.2 * interval
+        self._last_admission = now
+
+    def _remove(self, waiter: AdmissionWaiter) -> None:
+        waiter.changed.set()
+        if waiter not in self.waiters:
+            return
+        self.waiters.remove(waiter)
+        if not self.waiters:
+            self._last_admission = None
+        # everyone behind the waiter moved up
+        for other in self.waiters:
+            other.changed.set()
+
+    def _run_in_background(self, coro) -> None:
+        task = asyncio.create_task(coro)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
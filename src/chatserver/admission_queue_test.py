@@ -0,0 +1,107 @@
+import asyncio
+
+import pytest
+
+from chatserver.admission_queue import AdmissionQueue
+from chatserver.concurrency_control import create_concurrency_control
+
+BACKENDS = ["redis", "memory"]
+
+
+async def new_concurrency_control(backend: str, max_connections: int):
+    concurrency_control = create_concurrency_control(
+        max_connections=max_connections,
+        max_connection_per_client=1,
+        redis_key="admission_queue_test",
+        backend=backend,
+    )
+    await concurrency_control.clean_all_sessions()
+    await concurrency_control.start()
+    return concurrency_control
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("backend", BACKENDS)
+async def test_waiters_are_admitted_in_order_on_release(backend):
+    concurrency_control = await new_concurrency_control(backend, max_connections=1)
+    queue = AdmissionQueue(concurrency_control, max_length=2, timeout=2)
+
+    assert await queue.acquire("1")
+
+    positions = {"2": [], "3": []}
+
+    async def connect(client_id: str) -> bool:
+        async def on_position(position, estimated_wait):
+            positions[client_id].append(position)
+
+        return await queue.acquire(client_id, on_position)
+
+    second = asyncio.create_task(connect("2"))
+    await asyncio.sleep(0.05)
+    third = asyncio.create_task(connect("3"))
+    await asyncio.sleep(0.05)
+    # the queue is full
+    assert not await queue.acquire("4")
+
+    await concurrency_control.release_connection("1")
+    assert await second
+    assert not third.done()
+
+    await concurrency_control.release_connection("2")
+    assert await third
+    assert positions == {"2": [1], "3": [2, 1]}
+    assert await concurrency_control.get_connections() == {"3": 1}
+
+    await concurrency_control.stop()
+    await concurrency_control.clean_all_sessions()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("backend", BACKENDS)
+async def test_waiter_times_out(backend):
+    concurrency_control = await new_concurrency_control(backend, max_connections=1)
+    queue = AdmissionQueue(concurrency_control, max_length=2, timeout=0.1)
+
+    assert await queue.acquire("1")
+    assert not await queue.acquire("2")
+    assert queue.length == 0
+
+    # a client at its own limit is rejected without waiting
+    queue.timeout = 10
+    await concurrency_control.clean_all_sessions()
+    assert await queue.acquire("1")
+    concurrency_control.max_connections = 2
+    assert not await queue.acquire("1")
+
+    await concurrency_control.stop()
+    await concurrency_control.clean_all_sessions()
+
+
+@pytest.mark.asyncio
+async def test_place_taken_before_waiting():
+    concurrency_control = await new_concurrency_control("memory", max_connections=1)
+    # a zero timeout is not replaced by the default
+    queue = AdmissionQueue(concurrency_control, max_length=1, timeout=0)
+    assert queue.timeout == 0
+    queue.timeout = 2
+
+    assert await queue.acquire("1")
+    waiter = queue.join("2")
+    assert waiter is not None
+    assert queue.join("3") is None
+    assert not await queue.acquire("3")
+
+    await concurrency_control.release_connection("1")
+    assert await queue.acquire("2", waiter=waiter)
+
+    # a place that is never used gives its slot back
+    waiter = queue.join("3")
+    await concurrency_control.release_connection("2")
+    await asyncio.sleep(0.05)
+    assert waiter.admitted
+    queue.cancel(waiter)
+    await asyncio.sleep(0.05)
+    assert await concurrency_control.get_connections() == {}
+    assert queue.length == 0
+
+    await concurrency_control.stop()
@@ -1,44 +1,158 @@
 import asyncio
 from datetime import datetime
+from http import HTTPStatus
+import logging
+import math
 import random
+import time
+from typing import Optional
 from urllib.parse import parse_qs, urlparse
-import pytz
-from websockets import WebSocketServerProtocol
+import uuid
 import websockets
+from websockets.datastructures import Headers
+from websockets.legacy.server import HTTPResponse
 from chat_history.chat_history import (
-    ChatHistory,
     ChatHistoryMessage,
     ChatHistoryMessageType,
+    create_chat_history,
 )
 from websockets.frames import CloseCode
 
-from chatserver.chatbot_reply_policy import ChatBotReplyPolicy
-from chatserver.concurrency_control import ConcurrencyControl
+from chatserver.admission_queue import AdmissionQueue
+from chatserver.chatbot_reply_policy import (
+    REQUEST_TYPE_NAMES_BY_TYPE,
+    ChatBotReplyPolicy,
+    is_valid_time_zone,
+)
+from chatserver.concurrency_control import AcquireResult, create_concurrency_control
 from chatserver.config import Config
-from chatserver.exceptions import MessagePolicyException
-from request import RequestPayload, RequestType
+from chatserver.exceptions import MessageLimitException, MessagePolicyException
+from chatserver.log import MESSAGE_LOGGER
+from chatserver.message_limiter import MessageLimiter
+from chatserver.metrics import ChatServerMetrics, RequestTypeMetrics
+from chatserver.protocol import ChatBotServerProtocol
+from chatserver.response_cache import ResponseAssetCache
+from chatserver.startup import StartupTimer
+from chatserver.upload import StreamedRequest, UploadMemoryBudget, create_spool_storage
+from file_storage import ContentAddressedFileStorage
+from request import REQUEST_HEADER_SIZE, RequestPayload, RequestType
 from response import (
     ResponsePayload,
     ResponseType,
     get_error_payload,
-    get_sample_response_payload,
 )
+from utils import Buffer
+
+logger = logging.getLogger("chatserver.chat_bot")
+# logs of every message, sampled
+message_logger = logging.getLogger(MESSAGE_LOGGER)
 
 
 class ChatBot:
     """
     ChatBot class to handle the chat server
 
+    process_request: function to validate and admit a client during the HTTP handshake
     handle_ws_connection: function to handle the websocket connection
     """
 
-    def __init__(self):
-        self.chat_history = ChatHistory()
-        self.concurrent_control = ConcurrencyControl(
+    def __init__(self, startup_timer: Optional[StartupTimer] = None):
+        self.startup_timer = startup_timer or StartupTimer()
+        self.chat_history = create_chat_history(
+            backend=Config.CHAT_HISTORY_BACKEND,
+            max_messages_per_client=Config.CHAT_HISTORY_MAX_MESSAGES_PER_CLIENT,
+            max_bytes=Config.CHAT_HISTORY_MAX_BYTES,
+            sqlite_path=Config.CHAT_HISTORY_SQLITE_PATH,
+            durability=Config.CHAT_HISTORY_DURABILITY,
+            batch_size=Config.CHAT_HISTORY_BATCH_SIZE,
+            flush_interval=Config.CHAT_HISTORY_FLUSH_INTERVAL,
+            search_max_bytes=Config.CHAT_HISTORY_SEARCH_MAX_BYTES,
+        )
+        self.reply_policy = ChatBotReplyPolicy()
+        self.response_cache = ResponseAssetCache()
+        self.media_storage = ContentAddressedFileStorage(
+            Config.MEDIA_STORAGE_DIR, Config.MEDIA_BASE_URL
+        )
+        # the media of the replies are stored once, by the id of their buffer
+        self.reply_media_urls = {
+            id(self.response_cache.audio): self.media_storage.save_file(
+                "reply.mp3", self.response_cache.audio
+            ),
+            id(self.response_cache.image): self.media_storage.save_file(
+                "reply.jpg", self.response_cache.image
+            ),
+        }
+        # request bodies are kept in memory up to the budget, then written to disk
+        self.upload_budget = UploadMemoryBudget()
+        self.upload_storage = create_spool_storage()
+        self.concurrent_control = create_concurrency_control(
             max_connections=Config.MAX_CONNECTIONS,
             max_connection_per_client=Config.MAX_CONNECTION_PER_CLIENT,
-            redis_key=Config.CONCURRENT_CONTROL_REDIS_KEY
+            redis_key=Config.CONCURRENT_CONTROL_REDIS_KEY,
+        )
+        self.admission_queue = AdmissionQueue(self.concurrent_control)
+        self.message_limiter = MessageLimiter(self.concurrent_control)
+        self.metrics = ChatServerMetrics(self.startup_timer, self.chat_history)
+        self.concurrent_control.round_trip_listener = (
+            self.metrics.observe_redis_round_trip
         )
+        self._node_connections = self.metrics.node_connections.labels()
+        self._request_metrics = {
+            type: RequestTypeMetrics(self.metrics, name)
+            for type, name in REQUEST_TYPE_NAMES_BY_TYPE.items()
+        }
+
+    def check_reply_policy(
+        self, client_id: str, client_time: datetime, type: int
+    ) -> None:
+        """
+        Raise MessagePolicyException if requests of this type are not accepted
+        at the client time
+        """
+        if not self.reply_policy.accept(type, client_time):
+            name = REQUEST_TYPE_NAMES_BY_TYPE.get(type, "this")
+            raise MessagePolicyException(f"We can not accept {name} message now")
+
+    def reject_early(self, websocket: ChatBotServerProtocol, header: bytes) -> bool:
+        """
+        Called by the protocol as soon as the header of a request is received.
+        If the reply policy rejects the request, the error response is sent right
+        away, True is returned and the body is discarded without being stored
+        """
+        if not websocket.admitted:
+            # a queued connection may never be admitted, nothing is stored for it
+            return False
+        message_id = uuid.UUID(bytes=header[:16])
+        type = header[REQUEST_HEADER_SIZE - 1]
+        if type not in (RequestType.AUDIO, RequestType.VIDEO):
+            # text requests are small, the handler keeps their text in the history
+            return False
+        client_time = self.reply_policy.client_time(websocket.time_zone)
+        try:
+            self.check_reply_policy(websocket.client_id, client_time, type)
+        except MessagePolicyException as e:
+            message_logger.info(
+                "Message rejected by the reply policy",
+                extra={"client_id": websocket.client_id, "message_id": message_id},
+            )
+            self.chat_history.add_chat_message(
+                websocket.client_id,
+                ChatHistoryMessage(
+                    id=message_id,
+                    client_id=websocket.client_id,
+                    type=ChatHistoryMessageType.USER,
+                    text=None,
+                    audio_url=None,
+                    image_url=None,
+                    video_url=None,
+                    time=client_time.strftime("%Y-%m-%d %H:%M:%S"),
+                ),
+            )
+            websocket.send_in_background(
+                get_error_payload(e.message, message_id).encode()
+            )
+            return True
+        return False
 
     async def handle_response_for_text(
         self, client_id: str, client_time: datetime, req_payload: RequestPayload
@@ -47,10 +161,9 @@ class ChatBot:
         if req_payload.type != RequestType.TEXT:
             raise ValueError("Invalid request type")
 
-        if not ChatBotReplyPolicy.accept_text_msg_policy(client_id, client_time):
-            raise MessagePolicyException("We can not accept text message now")
-
-        return get_sample_response_payload(ResponseType.TEXT)
+        return self.response_cache.get_response_payload(
+            ResponseType.TEXT, req_payload.message_id
+        )
 
     async def handle_response_for_audio(
         self, client_id: str, client_time: datetime, req_payload: RequestPayload
@@ -60,19 +173,19 @@ class ChatBot:
         if req_payload.type != RequestType.AUDIO:
             raise ValueError("Invalid request type")
 
-        if not ChatBotReplyPolicy.accept_audio_msg_policy(client_id, client_time):
-            raise MessagePolicyException("We can not accept audio message now")
-        return get_sample_response_payload(ResponseType.TEXT_AUDIO)
+        return self.response_cache.get_response_payload(
+            ResponseType.TEXT_AUDIO, req_payload.message_id
+        )
 
-    def handle_response_for_video(
+    async def handle_response_for_video(
         self, client_id: str, client_time: datetime, req_payload: RequestPayload
     ) -> ResponsePayload:
         if req_payload.type != RequestType.VIDEO:
             raise ValueError("Invalid request type")
 
-        if not ChatBotReplyPolicy.accept_video_msg_policy(client_id, client_time):
-            raise MessagePolicyException("We can not accept video message now")
-        return get_sample_response_payload(ResponseType.TEXT_AUDIO)
+        return self.response_cache.get_response_payload(
+            ResponseType.TEXT_AUDIO, req_payload.message_id
+        )
 
     async def generate_response(
         self, client_id: str, client_time: datetime, req_payload: RequestPayload
@@ -89,95 +202,308 @@ class ChatBot:
 
         return await handler(client_id, client_time, req_payload)
 
-    async def handle_ws_connection(self, websocket: WebSocketServerProtocol, path: str):
-        query_params = parse_qs(urlparse(path).query)
+    async def save_media(
+        self, file_name: str, media: Optional[Buffer]
+    ) -> Optional[str]:
+        """
+        Store the media once per content and return its URL for the chat history.
+        The media of the replies are stored at startup and never deleted,
+        their URL is returned without counting a reference per reply
+        """
+        if media is None:
+            return None
+        url = self.reply_media_urls.get(id(media))
+        if url is not None:
+            return url
+        # hashing and writing large media would block the event loop
+        return await asyncio.to_thread(self.media_storage.save_file, file_name, media)
+
+    def _retry_after(self) -> str:
+        estimated_wait = self.admission_queue.estimated_wait(
+            self.admission_queue.length + 1
+        )
+        if estimated_wait is None:
+            return str(Config.RETRY_AFTER)
+        return str(max(1, math.ceil(estimated_wait)))
+
+    def _count_admission(self, result: str, reason: str) -> None:
+        self.metrics.admissions.labels(result, reason).inc()
+
+    async def metrics_response(self) -> HTTPResponse:
+        """
+        The metrics of this node in the Prometheus text format
+        """
+        try:
+            self.metrics.global_connections.labels().set(
+                await self.concurrent_control.get_total_connections()
+            )
+        except Exception as e:
+            logger.warning("Can not read the total connections: %s", e)
+        return (
+            HTTPStatus.OK,
+            [("Content-Type", "text/plain; version=0.0.4; charset=utf-8")],
+            self.metrics.registry.render().encode("utf-8"),
+        )
+
+    async def process_request(
+        self, websocket: ChatBotServerProtocol, path: str, request_headers: Headers
+    ) -> Optional[HTTPResponse]:
+        """
+        Validate the query parameters and try to admit the client before the
+        websocket upgrade, so a rejected client only costs a plain HTTP response.
+        Return None to go on with the upgrade
+        """
+        url = urlparse(path)
+        if Config.METRICS_PATH and url.path == Config.METRICS_PATH:
+            return await self.metrics_response()
+
+        query_params = parse_qs(url.query)
         client_ids = query_params.get("client_id")
         time_zones = query_params.get("time_zone")
         if not client_ids or not time_zones:
-            print("Invalid query parameters")
-            await websocket.close(CloseCode.INVALID_DATA, "Invalid query parameters")
-            return
+            logger.info("Invalid query parameters", extra={"path": path})
+            self._count_admission("rejected", "invalid_request")
+            return HTTPStatus.BAD_REQUEST, [], b"Invalid query parameters\n"
 
         client_id = client_ids[0]
         time_zone = time_zones[0]
-        ok = await self.concurrent_control.acquire_connection(client_id)
-        if not ok:
-            print(f"Can not serve {client_id} because of too many connections")
-            await websocket.close(CloseCode.POLICY_VIOLATION, "Too many connections")
-            return
+        if not is_valid_time_zone(time_zone):
+            logger.info("Invalid time zone", extra={"time_zone": time_zone})
+            self._count_admission("rejected", "invalid_request")
+            return HTTPStatus.BAD_REQUEST, [], b"Invalid time zone\n"
+
+        websocket.client_id = client_id
+        websocket.time_zone = time_zone
+
+        # clients already waiting go first
+        if not self.admission_queue.length:
+            result = await self.concurrent_control.try_acquire_connection(client_id)
+            if result == AcquireResult.ACQUIRED:
+                websocket.admitted = True
+                self._count_admission("accepted", "direct")
+                return None
+            if result == AcquireResult.CLIENT_FULL:
+                logger.info(
+                    "Too many connections for this client",
+                    extra={"client_id": client_id},
+                )
+                self._count_admission("rejected", "client_full")
+                return (
+                    HTTPStatus.TOO_MANY_REQUESTS,
+                    [("Retry-After", str(Config.RETRY_AFTER))],
+                    b"Too many connections for this client\n",
+                )
+
+        # the place in the queue is taken now, a burst of handshakes can not
+        # all pass this check and be closed once upgraded
+        websocket.admission_waiter = self.admission_queue.join(client_id)
+        if websocket.admission_waiter is None:
+            logger.info("Too many connections", extra={"client_id": client_id})
+            self._count_admission("rejected", "server_full")
+            return (
+                HTTPStatus.SERVICE_UNAVAILABLE,
+                [("Retry-After", self._retry_after())],
+                b"Too many connections\n",
+            )
+
+        # wait in the admission queue after the upgrade
+        # so the client can be told its position
+        return None
+
+    async def handle_ws_connection(self, websocket: ChatBotServerProtocol, path: str):
+        client_id = websocket.client_id
+        time_zone = websocket.time_zone
+
+        if not websocket.admitted:
 
+            async def send_queue_position(
+                position: int, estimated_wait: Optional[float]
+            ):
+                wait = "unknown" if estimated_wait is None else f"{estimated_wait:.1f}"
+                await websocket.send(f"queued {position} {wait}")
+
+            waiter, websocket.admission_waiter = websocket.admission_waiter, None
+            websocket.admitted = await self.admission_queue.acquire(
+                client_id, send_queue_position, waiter
+            )
+            if not websocket.admitted:
+                logger.info(
+                    "No connection freed while queued", extra={"client_id": client_id}
+                )
+                self._count_admission("rejected", "queue")
+                await websocket.close(CloseCode.POLICY_VIOLATION, "Too many connections")
+                websocket.close_pending_requests()
+                return
+            self._count_admission("accepted", "queue")
+
+        self.startup_timer.connection_accepted()
+        self._node_connections.inc()
+        try:
+            await self.serve_client(websocket, client_id, time_zone)
+        finally:
+            logger.info("Connection closed", extra={"client_id": client_id})
+            self._node_connections.dec()
+            websocket.close_pending_requests()
+            await self.concurrent_control.release_connection(client_id)
+
+    async def serve_client(
+        self, websocket: ChatBotServerProtocol, client_id: str, time_zone: str
+    ):
         await websocket.send("connected")
-        print(f"Connection to {client_id} has established time zone: {time_zone}")
+        logger.info(
+            "Connection established",
+            extra={"client_id": client_id, "time_zone": time_zone},
+        )
 
-        timezone = pytz.timezone(time_zone)
-        client_time = datetime.now(timezone)
+        # a connection can have up to MAX_IN_FLIGHT_PER_CONNECTION requests handled
+        # at the same time, responses carry the request message_id and may be sent
+        # in a different order than the requests
+        in_flight = asyncio.Semaphore(Config.MAX_IN_FLIGHT_PER_CONNECTION)
+        in_flight_tasks = set()
 
-        async def handle_msgs():
+        async def handle_msg(message):
             """
-            Handle incoming messages from the client
+            Handle one request of the client and send the response
             """
-            async for message in websocket:
-                try:
-                    # Handle heartbeat message
-                    if message == "ping":
-                        await websocket.send("pong")
-                        continue
+            message_id = None
+            try:
+                start = time.perf_counter()
+                # binary messages are read as StreamedRequest whose body is kept in memory
+                # or on disk, the audio and video of the request are views of it, not copies
+                if isinstance(message, StreamedRequest):
+                    req_payload = message.decode()
+                    request_size = len(message.header) + message.body.size
+                else:
+                    req_payload = RequestPayload.decode(message)
+                    request_size = len(message)
+                message_id = req_payload.message_id
+                metrics = self._request_metrics.get(req_payload.type)
+                decoded = time.perf_counter()
+                # the reply policy is checked against the time the message is received
+                client_time = self.reply_policy.client_time(time_zone)
+                audio_url = await self.save_media("audio", req_payload.audio)
+                video_url = await self.save_media("video", req_payload.video)
+                stored = time.perf_counter()
 
-                    # incoming message is a bytes object contain all the text (utf-8), audio(mp3) and video(mp4) data
-                    req_payload = RequestPayload.decode(bytes(message))
+                message_logger.info(
+                    "Incoming message",
+                    extra={
+                        "client_id": client_id,
+                        "message_id": message_id,
+                        "type": req_payload.type,
+                    },
+                )
+                # Save request message to chat history
+                self.chat_history.add_chat_message(
+                    client_id,
+                    ChatHistoryMessage(
+                        id=req_payload.message_id,
+                        client_id=client_id,
+                        type=ChatHistoryMessageType.USER,
+                        text=req_payload.text,
+                        audio_url=audio_url,
+                        image_url=None,
+                        video_url=video_url,
+                        time=client_time.strftime("%Y-%m-%d %H:%M:%S"),
+                    ),
+                )
 
-                    print(
-                        f"[Client {client_id}] new incoming message: {req_payload.message_id}, message type {req_payload.type}"
-                    )
-                    # Save request message to chat history
-                    self.chat_history.add_chat_message(
-                        client_id,
-                        ChatHistoryMessage(
-                            id=req_payload.message_id,
-                            client_id=client_id,
-                            type=ChatHistoryMessageType.USER,
-                            text=req_payload.text,
-                            audio_url=None,  # TODO: save audio file and return the url
-                            image_url=None,  # TODO: save image file and return the url
-                            video_url=None,  # TODO: save video file and return the url
-                            time=client_time.strftime("%Y-%m-%d %H:%M:%S"),
-                        ),
-                    )
+                policy_start = time.perf_counter()
+                self.check_reply_policy(client_id, client_time, req_payload.type)
+                policy_checked = time.perf_counter()
 
+                # acquire gives the token back itself when it fails or is
+                # cancelled, only an acquired token is released
+                await self.message_limiter.acquire()
+                try:
                     resp_payload = await self.generate_response(
                         client_id, client_time, req_payload
                     )
+                finally:
+                    self.message_limiter.release()
+                generated = time.perf_counter()
 
-                    # Save response message to chat history
-                    self.chat_history.add_chat_message(
-                        client_id,
-                        ChatHistoryMessage(
-                            id=resp_payload.message_id,
-                            client_id=client_id,
-                            type=ChatHistoryMessageType.BOT,
-                            text=req_payload.text,
-                            audio_url=None,  # TODO: save audio file and return the url
-                            image_url=None,  # TODO: save image file and return the url
-                            video_url=None,  # TODO: save video file and return the url
-                            time=client_time.strftime("%Y-%m-%d %H:%M:%S"),
-                        ),
-                    )
+                # Save response message to chat history
+                reply_audio_url = await self.save_media("audio", resp_payload.audio)
+                reply_image_url = await self.save_media("image", resp_payload.image)
+                self.chat_history.add_chat_message(
+                    client_id,
+                    ChatHistoryMessage(
+                        id=resp_payload.message_id,
+                        client_id=client_id,
+                        type=ChatHistoryMessageType.BOT,
+                        text=req_payload.text,
+                        audio_url=reply_audio_url,
+                        image_url=reply_image_url,
+                        video_url=None,
+                        time=client_time.strftime("%Y-%m-%d %H:%M:%S"),
+                    ),
+                )
+                reply_stored = time.perf_counter()
+
+                buffers = resp_payload.encode_buffers()
+                await websocket.send(buffers)
+                if metrics is not None:
+                    metrics.decode.observe(decoded - start)
+                    metrics.store.observe(stored - decoded + reply_stored - generated)
+                    metrics.policy.observe(policy_checked - policy_start)
+                    metrics.generate.observe(generated - policy_checked)
+                    metrics.send.observe(time.perf_counter() - reply_stored)
+                    metrics.request_bytes.observe(request_size)
+                    metrics.response_bytes.observe(sum(map(len, buffers)))
+            except websockets.exceptions.ConnectionClosed:
+                pass
+            except MessagePolicyException as e:
+                message_logger.info(
+                    "Message rejected by the reply policy",
+                    extra={"client_id": client_id, "message_id": message_id},
+                )
+                await websocket.send(get_error_payload(e.message, message_id).encode())
+            except MessageLimitException as e:
+                message_logger.warning(
+                    "Message rejected: %s",
+                    e.message,
+                    extra={"client_id": client_id, "message_id": message_id},
+                )
+                await websocket.send(get_error_payload(e.message, message_id).encode())
+            except Exception as e:
+                message_logger.exception(
+                    "Can not handle message",
+                    extra={"client_id": client_id, "message_id": message_id},
+                )
+                # TODO: return server error information to client is just for debugging
+                # we should return a user-friendly message
+                await websocket.send(get_error_payload(str(e), message_id).encode())
+            finally:
+                if isinstance(message, StreamedRequest):
+                    message.close()
+                in_flight.release()
+
+        async def handle_msgs():
+            """
+            Handle incoming messages from the client
+            """
+            try:
+                async for message in websocket:
+                    # Handle heartbeat message
+                    if message == "ping":
+                        await websocket.send("pong")
+                        continue
 
-                    await websocket.send(resp_payload.encode())
-                except websockets.exceptions.ConnectionClosedError:
-                    print(f"[Client {client_id}] disconnected")
-                    break
-                except MessagePolicyException as e:
-                    print(f"[Client {client_id}]: Message Policy Exception: {e}")
-                    await websocket.send(get_error_payload(e.message).encode())
-                except Exception as e:
-                    print(f"[Client {client_id}]Error: {e}")
-                    # TODO: return server error information to client is just for debugging
-                    # we should return a user-friendly message
-                    await websocket.send(get_error_payload(str(e)).encode())
+                    # stop reading while the connection has too many requests in flight
+                    await in_flight.acquire()
+                    task = asyncio.create_task(handle_msg(message))
+                    in_flight_tasks.add(task)
+                    task.add_done_callback(in_flight_tasks.discard)
+            except websockets.exceptions.ConnectionClosedError:
+                pass
+            finally:
+                # the responses can not be sent anymore
+                for task in in_flight_tasks:
+                    task.cancel()
+                await asyncio.gather(*in_flight_tasks, return_exceptions=True)
 
         async def handle_disconnect():
             await websocket.wait_closed()
 
         await asyncio.gather(handle_msgs(), handle_disconnect())
-        await self.concurrent_control.release_connection(client_id)
@@ -0,0 +1,344 @@
+import asyncio
+import os
+import random
+import subprocess
+import sys
+from typing import Tuple
+
+import pytest
+import websockets
+from websockets.server import WebSocketServer
+
+from chatserver.chat_bot import ChatBot
+from chatserver.chat_server import serve_chatbot
+from chatserver.config import Config
+from request import RequestType, get_sample_request_payload
+from response import ResponsePayload, ResponseType
+
+
+@pytest.fixture
+def config(monkeypatch, tmp_path):
+    monkeypatch.setattr(Config, "UPLOAD_SPOOL_DIR", str(tmp_path / "uploads"))
+    monkeypatch.setattr(Config, "MEDIA_STORAGE_DIR", str(tmp_path / "media"))
+    monkeypatch.setattr(Config, "CONCURRENCY_BACKEND", "memory")
+    monkeypatch.setattr(Config, "MAX_CONNECTIONS", 1)
+    monkeypatch.setattr(Config, "MAX_CONNECTION_PER_CLIENT", 1)
+    monkeypatch.setattr(Config, "ADMISSION_QUEUE_MAX_LENGTH", 0)
+    monkeypatch.setattr(Config, "RETRY_AFTER", 7)
+    return Config
+
+
+async def start_server(chatbot: ChatBot) -> Tuple[WebSocketServer, str]:
+    server = await serve_chatbot(chatbot, "localhost", 0, Config.MAX_REQUEST_SIZE)
+    port = server.sockets[0].getsockname()[1]
+    return server, f"ws://localhost:{port}"
+
+
+def test_lazy_imports():
+    # the modules needed by the first client only are imported by it
+    code = (
+        "import sys, chatserver.chat_bot; "
+        "print(sorted({'pytz', 'redis'} & sys.modules.keys()))"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    assert output.strip() == "[]"
+
+
+@pytest.mark.asyncio
+async def test_handshake_rejections(config):
+    chatbot = ChatBot()
+    server, url = await start_server(chatbot)
+
+    with pytest.raises(websockets.InvalidStatusCode) as e:
+        await websockets.connect(f"{url}?client_id=1")
+    assert e.value.status_code == 400
+
+    with pytest.raises(websockets.InvalidStatusCode) as e:
+        await websockets.connect(f"{url}?client_id=1&time_zone=Not/A_Zone")
+    assert e.value.status_code == 400
+
+    async with websockets.connect(f"{url}?client_id=1&time_zone=Asia/Tokyo") as ws:
+        assert await ws.recv() == "connected"
+
+        with pytest.raises(websockets.InvalidStatusCode) as e:
+            await websockets.connect(f"{url}?client_id=2&time_zone=Asia/Tokyo")
+        assert e.value.status_code == 503
+        assert e.value.headers["Retry-After"] == "7"
+
+    server.close()
+    await server.wait_closed()
+    assert await chatbot.concurrent_control.get_total_connections() == 0
+
+
+@pytest.mark.asyncio
+async def test_burst_of_handshakes(config, monkeypatch):
+    monkeypatch.setattr(Config, "ADMISSION_QUEUE_MAX_LENGTH", 1)
+    chatbot = ChatBot()
+    acquire = chatbot.admission_queue.acquire
+
+    async def acquire_after_the_burst(*args):
+        await asyncio.sleep(0.1)
+        return await acquire(*args)
+
+    monkeypatch.setattr(chatbot.admission_queue, "acquire", acquire_after_the_burst)
+    server, url = await start_server(chatbot)
+
+    async with websockets.connect(f"{url}?client_id=1&time_zone=Asia/Tokyo") as ws:
+        assert await ws.recv() == "connected"
+        # only one of the handshakes takes the place in the queue
+        results = await asyncio.gather(
+            *[
+                websockets.connect(f"{url}?client_id={i}&time_zone=Asia/Tokyo")
+                for i in range(2, 6)
+            ],
+            return_exceptions=True,
+        )
+        queued = [result for result in results if not isinstance(result, Exception)]
+        assert len(queued) == 1
+        assert [
+            result.status_code
+            for result in results
+            if isinstance(result, websockets.InvalidStatusCode)
+        ] == [503] * 3
+        assert (await queued[0].recv()).startswith("queued 1")
+        await queued[0].close()
+
+    server.close()
+    await server.wait_closed()
+    assert await chatbot.concurrent_control.get_total_connections() == 0
+
+
+@pytest.mark.asyncio
+async def test_pipelined_requests(config, monkeypatch):
+    monkeypatch.setattr(Config, "MAX_IN_FLIGHT_PER_CONNECTION", 2)
+    # audio requests take longer than text requests
+    monkeypatch.setattr(random, "uniform", lambda low, high: low / 10)
+    monkeypatch.setattr(Config, "REPLY_POLICY", "text=0-24;audio=0-24")
+    chatbot = ChatBot()
+    server, url = await start_server(chatbot)
+
+    async with websockets.connect(f"{url}?client_id=1&time_zone=Asia/Tokyo") as ws:
+        assert await ws.recv() == "connected"
+        audio_req = get_sample_request_payload(RequestType.AUDIO)
+        text_req = get_sample_request_payload(RequestType.TEXT)
+        await ws.send(audio_req.encode())
+        await ws.send(text_req.encode())
+
+        first = ResponsePayload.decode(await ws.recv())
+        second = ResponsePayload.decode(await ws.recv())
+        assert first.message_id == text_req.message_id
+        assert second.message_id == audio_req.message_id
+
+        # the same audio is sent again, its content is stored once
+        await ws.send(get_sample_request_payload(RequestType.AUDIO).encode())
+        await ws.recv()
+
+    server.close()
+    await server.wait_closed()
+
+    history = chatbot.chat_history.get_all_chat_history("1")
+    audio_urls = [message.audio_url for message in history if message.audio_url]
+    # 2 requests and 2 replies with audio, the replies use the sample audio
+    assert len(audio_urls) == 4
+    assert len(set(audio_urls)) == 2
+    request_audio_url = next(
+        message.audio_url for message in history if message.id == audio_req.message_id
+    )
+    assert chatbot.media_storage.get_file(request_audio_url) == bytes(audio_req.audio)
+    assert chatbot.media_storage.references(request_audio_url) == 2
+
+
+@pytest.mark.asyncio
+async def test_cancelled_message_gives_its_token_back(config, monkeypatch):
+    monkeypatch.setattr(Config, "MAX_IN_FLIGHT_PER_CONNECTION", 2)
+    monkeypatch.setattr(Config, "MAX_MESSAGES", 1)
+    monkeypatch.setattr(Config, "MESSAGE_TOKEN_BLOCK_SIZE", 1)
+    monkeypatch.setattr(Config, "MESSAGE_QUEUE_TIMEOUT", 1)
+    monkeypatch.setattr(random, "uniform", lambda low, high: 0)
+    monkeypatch.setattr(Config, "REPLY_POLICY", "text=0-24;audio=0-24")
+    chatbot = ChatBot()
+    generate_response = chatbot.generate_response
+
+    async def generate_and_cancel_queued(*args):
+        while not chatbot.message_limiter.queue_length:
+            await asyncio.sleep(0)
+        resp = await generate_response(*args)
+        # the queued message is cancelled, as when the connection is closed,
+        # while the token of this message is handed over to it
+        for task in asyncio.all_tasks():
+            if task.get_coro().__qualname__.endswith("handle_msg") and (
+                task is not asyncio.current_task()
+            ):
+                task.cancel()
+        return resp
+
+    monkeypatch.setattr(chatbot, "generate_response", generate_and_cancel_queued)
+    server, url = await start_server(chatbot)
+
+    async with websockets.connect(f"{url}?client_id=1&time_zone=Asia/Tokyo") as ws:
+        assert await ws.recv() == "connected"
+        await ws.send(get_sample_request_payload(RequestType.AUDIO).encode())
+        await ws.send(get_sample_request_payload(RequestType.TEXT).encode())
+        ResponsePayload.decode(await ws.recv())
+        assert chatbot.message_limiter.in_use == 0
+
+    # the token is available to the next message
+    monkeypatch.setattr(chatbot, "generate_response", generate_response)
+    async with websockets.connect(f"{url}?client_id=1&time_zone=Asia/Tokyo") as ws:
+        assert await ws.recv() == "connected"
+        text_req = get_sample_request_payload(RequestType.TEXT)
+        await ws.send(text_req.encode())
+        resp = ResponsePayload.decode(await ws.recv())
+        assert resp.type == ResponseType.TEXT
+        assert resp.message_id == text_req.message_id
+
+    server.close()
+    await server.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_streamed_upload(config, monkeypatch):
+    # an oversized frame is not read, it must fit in the read buffer of the server
+    # for the server to notice that the client closed the connection
+    monkeypatch.setattr(Config, "MAX_FRAME_SIZE", 2**15)
+    monkeypatch.setattr(Config, "UPLOAD_MEMORY_BUDGET", 2**16)
+    chatbot = ChatBot()
+    server, url = await start_server(chatbot)
+
+    async with websockets.connect(f"{url}?client_id=1&time_zone=Asia/Tokyo") as ws:
+        assert await ws.recv() == "connected"
+
+        video_req = get_sample_request_payload(RequestType.VIDEO)
+        await ws.send(video_req.encode_fragments(2**15))
+        resp = ResponsePayload.decode(await ws.recv())
+        assert resp.message_id == video_req.message_id
+
+    # the body did not fit in memory and was written to disk, then deleted
+    assert chatbot.upload_budget.used == 0
+    assert os.listdir(Config.UPLOAD_SPOOL_DIR) == []
+
+    async with websockets.connect(f"{url}?client_id=1&time_zone=Asia/Tokyo") as ws:
+        assert await ws.recv() == "connected"
+        # an unfragmented message larger than a frame is rejected
+        text_req = get_sample_request_payload(RequestType.TEXT)
+        text_req.text = "a" * 2**15
+        await ws.send(text_req.encode())
+        with pytest.raises(websockets.ConnectionClosed) as e:
+            await ws.recv()
+        assert e.value.rcvd.code == 1009
+
+    server.close()
+    await server.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_early_policy_rejection(config, monkeypatch):
+    monkeypatch.setattr(random, "uniform", lambda low, high: 0)
+    monkeypatch.setattr(Config, "MAX_FRAME_SIZE", 2**16)
+    monkeypatch.setattr(Config, "UPLOAD_MEMORY_BUDGET", 0)
+    monkeypatch.setattr(Config, "REPLY_POLICY", "text=0-24;video=")
+    chatbot = ChatBot()
+    server, url = await start_server(chatbot)
+
+    async with websockets.connect(f"{url}?client_id=1&time_zone=Asia/Tokyo") as ws:
+        assert await ws.recv() == "connected"
+        video_req = get_sample_request_payload(RequestType.VIDEO)
+        fragments = video_req.encode_fragments(2**16)
+        rejected = asyncio.Event()
+
+        async def send_fragments():
+            yield fragments[0]
+            # the request is rejected from its header, before the body is sent
+            await rejected.wait()
+            for fragment in fragments[1:]:
+                yield fragment
+
+        send_task = asyncio.create_task(ws.send(send_fragments()))
+        resp = ResponsePayload.decode(await ws.recv())
+        rejected.set()
+        await send_task
+        assert resp.type == ResponseType.ERROR
+        assert resp.message_id == video_req.message_id
+        assert resp.error_message == "We can not accept video message now"
+
+        # the body was discarded and the next request is read as usual
+        text_req = get_sample_request_payload(RequestType.TEXT)
+        await ws.send(text_req.encode())
+        resp = ResponsePayload.decode(await ws.recv())
+        assert resp.type == ResponseType.TEXT
+        assert resp.message_id == text_req.message_id
+        assert os.listdir(Config.UPLOAD_SPOOL_DIR) == []
+
+    server.close()
+    await server.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_no_early_rejection_while_queued(config, monkeypatch):
+    monkeypatch.setattr(Config, "ADMISSION_QUEUE_MAX_LENGTH", 1)
+    monkeypatch.setattr(Config, "ADMISSION_QUEUE_TIMEOUT", 0.2)
+    monkeypatch.setattr(Config, "MAX_FRAME_SIZE", 2**16)
+    monkeypatch.setattr(Config, "REPLY_POLICY", "text=0-24;video=")
+    chatbot = ChatBot()
+    server, url = await start_server(chatbot)
+
+    async with websockets.connect(f"{url}?client_id=1&time_zone=Asia/Tokyo") as ws:
+        assert await ws.recv() == "connected"
+        async with websockets.connect(
+            f"{url}?client_id=2&time_zone=Asia/Tokyo"
+        ) as queued_ws:
+            assert (await queued_ws.recv()).startswith("queued 1")
+            video_req = get_sample_request_payload(RequestType.VIDEO)
+            await queued_ws.send(video_req.encode_fragments(2**16))
+            with pytest.raises(websockets.ConnectionClosed) as e:
+                await queued_ws.recv()
+            assert e.value.rcvd.code == 1008
+
+    server.close()
+    await server.wait_closed()
+    # the connection was never admitted, its request is not in the history
+    assert chatbot.chat_history.get_all_chat_history("2") == []
+
+
+@pytest.mark.asyncio
+async def test_metrics_endpoint(config, monkeypatch):
+    monkeypatch.setattr(random, "uniform", lambda low, high: low)
+    monkeypatch.setattr(Config, "REPLY_POLICY", "text=0-24")
+    chatbot = ChatBot()
+    server, url = await start_server(chatbot)
+
+    async with websockets.connect(f"{url}?client_id=1&time_zone=Asia/Tokyo") as ws:
+        assert await ws.recv() == "connected"
+        await ws.send(get_sample_request_payload(RequestType.TEXT).encode())
+        ResponsePayload.decode(await ws.recv())
+
+        with pytest.raises(websockets.InvalidStatusCode):
+            await websockets.connect(f"{url}?client_id=2&time_zone=Asia/Tokyo")
+
+        port = server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection("localhost", port)
+        writer.write(b"GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n")
+        response = (await reader.read()).decode()
+        writer.close()
+
+    status, _, body = response.partition("\r\n\r\n")
+    assert status.startswith("HTTP/1.1 200")
+    assert "chatserver_node_connections 1" in body
+    assert "chatserver_global_connections 1" in body
+    assert 'chatserver_admissions_total{result="accepted",reason="direct"} 1' in body
+    assert 'chatserver_admissions_total{result="rejected",reason="server_full"} 1' in body
+    for phase in ["decode", "store", "policy", "generate", "send"]:
+        assert (
+            f'chatserver_request_phase_seconds_count{{type="text",phase="{phase}"}} 1'
+            in body
+        )
+    assert 'chatserver_response_bytes_count{type="text"} 1' in body
+
+    server.close()
+    await server.wait_closed()
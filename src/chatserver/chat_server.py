@@ -1,22 +1,114 @@
+import time
+
+# measure the startup from here, before the imports
+STARTED_AT = time.perf_counter()
+
 import asyncio
+import functools
+import logging
+import signal
+from typing import Optional
+from websockets.legacy.server import Serve
 from websockets.server import serve
 
+from chatserver import event_loop
 from chatserver.chat_bot import ChatBot
 from chatserver.config import Config
+from chatserver.log import setup_logging, stop_logging
+from chatserver.protocol import ChatBotServerProtocol
+from chatserver.startup import StartupTimer
+
+logger = logging.getLogger("chatserver.chat_server")
+
 
+def serve_chatbot(
+    chatbot: ChatBot, host: str, port: int, max_size: int, reuse_port: bool = False
+) -> Serve:
+    return serve(
+        chatbot.handle_ws_connection,
+        host,
+        port,
+        max_size=max_size,
+        create_protocol=functools.partial(ChatBotServerProtocol, chatbot=chatbot),
+        compression="deflate" if Config.WEBSOCKET_COMPRESSION else None,
+        reuse_port=reuse_port,
+    )
 
-async def main():
-    chatbot = ChatBot()
-    await chatbot.concurrent_control.clean_all_sessions()
+
+async def main(reuse_port: bool = False, started_at: Optional[float] = None):
+    setup_logging()
+    chatbot = ChatBot(StartupTimer(STARTED_AT if started_at is None else started_at))
+    # only drop the connections this node held before a restart,
+    # other nodes keep theirs
+    await chatbot.concurrent_control.clean_node_sessions()
+    await chatbot.concurrent_control.start()
+    chatbot.metrics.start()
+    chatbot.chat_history.start()
 
     PORT = Config.SERVER_PORT
-    MAX_SIZE = 100000000
     HOST = "0.0.0.0"
-    print(f"Starting server on {HOST}:{PORT}")
-    async with serve(chatbot.handle_ws_connection, HOST, PORT, max_size=MAX_SIZE):
-        print(f"Server started, listening on {HOST}:{PORT}")
-        await asyncio.Future()  # run forever
+    logger.info("Starting server on %s:%s", HOST, PORT)
+    loop = asyncio.get_running_loop()
+    stop = loop.create_future()
+    loop.add_signal_handler(
+        signal.SIGTERM, lambda: stop.done() or stop.set_result(None)
+    )
+    try:
+        async with serve_chatbot(
+            chatbot, HOST, PORT, Config.MAX_REQUEST_SIZE, reuse_port=reuse_port
+        ):
+            logger.info("Server started, listening on %s:%s", HOST, PORT)
+            chatbot.startup_timer.listening()
+            await stop  # run until SIGTERM
+    finally:
+        await chatbot.metrics.stop()
+        await chatbot.message_limiter.close()
+        await chatbot.concurrent_control.stop()
+        await chatbot.chat_history.close()
+        stop_logging()
+
+
+def preload_workers():
+    """
+    Import and warm up what the workers need before they are forked,
+    so a started or restarted worker only binds its socket and connects to redis
+    """
+    import pytz
+
+    from chatserver import redis_concurrency_control  # noqa: F401
+
+    # the zone set checked by the handshake of every client is built on first
+    # use, loading a zone builds it ("UTC" is returned without any lookup)
+    pytz.timezone("Etc/UTC")
+    event_loop.get_event_loop_factory()
+
+
+def run_worker(worker_id: int):
+    started_at = time.perf_counter()
+    # every worker holds its connections under its own lease, so the connections
+    # of a dead worker are released and its restarted process cleans them
+    Config.NODE_ID = f"{Config.NODE_ID}-{worker_id}"
+    event_loop.run(main(reuse_port=True, started_at=started_at))
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=Config.WORKERS,
+        help="number of worker processes sharing the port with SO_REUSEPORT",
+    )
+    args = parser.parse_args()
+
+    if args.workers > 1:
+        if Config.CONCURRENCY_BACKEND != "redis":
+            parser.error("--workers needs CONCURRENCY_BACKEND=redis to share the limits")
+        from chatserver.supervisor import WorkerSupervisor
+
+        preload_workers()
+        WorkerSupervisor(args.workers, run_worker).run()
+    else:
+        event_loop.run(main())
@@ -1,24 +1,142 @@
-from datetime import datetime
+import bisect
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+import math
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from chatserver.config import Config
+from request import RequestType
+
+REQUEST_TYPE_NAMES = {
+    "text": RequestType.TEXT,
+    "audio": RequestType.AUDIO,
+    "video": RequestType.VIDEO,
+}
+REQUEST_TYPE_NAMES_BY_TYPE = {type: name for name, type in REQUEST_TYPE_NAMES.items()}
+
+EPOCH = datetime(1970, 1, 1)
+
+
+@dataclass
+class ZoneOffset:
+    """
+    UTC offset of a time zone, valid between two of its transitions
+    """
+
+    tzinfo: timezone
+    offset: float
+    # timestamps of the transitions around the offset
+    valid_from: float
+    valid_until: float
+
+
+def parse_rules(rules: str) -> Dict[int, int]:
+    """
+    Parse rules like "text=5-24;audio=8-12,14-16;video=" into a mask of the
+    accepted hours for every request type, bit h is set if the type is
+    accepted from h:00 to h:59. A type without windows is never accepted
+    """
+    hour_masks = {}
+    for rule in rules.split(";"):
+        if not rule.strip():
+            continue
+        name, _, windows = rule.partition("=")
+        type = REQUEST_TYPE_NAMES.get(name.strip())
+        if type is None:
+            raise ValueError(f"Invalid request type in reply policy: {name}")
+        mask = 0
+        for window in windows.split(","):
+            if not window.strip():
+                continue
+            start, _, end = window.partition("-")
+            start, end = int(start), int(end)
+            if not 0 <= start <= end <= 24:
+                raise ValueError(f"Invalid hours in reply policy: {window}")
+            for hour in range(start, end):
+                mask |= 1 << hour
+        hour_masks[type] = mask
+    return hour_masks
+
+
+def is_valid_time_zone(time_zone: str) -> bool:
+    # pytz is imported by the first client, not before the server listens
+    import pytz
+
+    return time_zone in pytz.all_timezones_set
 
 
 class ChatBotReplyPolicy:
-    @staticmethod
-    def accept_text_msg_policy(client_id: str, client_time: datetime) -> bool:
-        """
-        Accept if the message is sent between 5am and midnight
-        """
-        return 5 <= client_time.hour < 24
+    """
+    Decide from the client local time whether a request is accepted.
+
+    The rules are compiled into a mask of accepted hours per request type,
+    a type without rule is always accepted. Time zones and their UTC offset
+    are cached until the next transition of the zone, so checking a request
+    costs a clock read and a few arithmetic operations
+    """
+
+    def __init__(self, rules: Optional[str] = None) -> None:
+        self.hour_masks = parse_rules(Config.REPLY_POLICY if rules is None else rules)
+        self._zone_offsets: Dict[str, ZoneOffset] = {}
 
-    @staticmethod
-    def accept_audio_msg_policy(client_id: str, client_time: datetime) -> bool:
+    def _zone_offset(self, time_zone: str, now: float) -> ZoneOffset:
+        zone_offset = self._zone_offsets.get(time_zone)
+        if zone_offset and zone_offset.valid_from <= now < zone_offset.valid_until:
+            return zone_offset
+
+        import pytz
+
+        tz = pytz.timezone(time_zone)
+        offset = datetime.fromtimestamp(now, tz).utcoffset()
+        valid_from, valid_until = -math.inf, math.inf
+        # pytz only exposes the transitions of zones with more than one offset
+        transitions = getattr(tz, "_utc_transition_times", None)
+        if transitions:
+            utc_now = EPOCH + timedelta(seconds=now)
+            i = bisect.bisect_right(transitions, utc_now)
+            if i > 0:
+                valid_from = (transitions[i - 1] - EPOCH).total_seconds()
+            if i < len(transitions):
+                valid_until = (transitions[i] - EPOCH).total_seconds()
+
+        zone_offset = ZoneOffset(
+            tzinfo=timezone(offset),
+            offset=offset.total_seconds(),
+            valid_from=valid_from,
+            valid_until=valid_until,
+        )
+        self._zone_offsets[time_zone] = zone_offset
+        return zone_offset
+
+    def client_time(self, time_zone: str, now: Optional[float] = None) -> datetime:
         """
-        Accept if the message is sent between 8am and 12pm
+        Current time of the client time zone
         """
-        return 8 <= client_time.hour < 12
+        now = time.time() if now is None else now
+        zone_offset = self._zone_offset(time_zone, now)
+        return datetime.fromtimestamp(now, zone_offset.tzinfo)
+
+    def accept(self, type: int, client_time: datetime) -> bool:
+        mask = self.hour_masks.get(type)
+        return mask is None or bool(mask >> client_time.hour & 1)
 
-    @staticmethod
-    def accept_video_msg_policy(client_id: str, client_time: datetime) -> bool:
+    def accept_batch(
+        self, requests: Iterable[Tuple[int, str]], now: Optional[float] = None
+    ) -> List[bool]:
         """
-        Accept if the message is sent between 8pm and midnight
+        Check (request type, client time zone) pairs against one reading of
+        the clock, the local hour of every time zone is computed once
         """
-        return 20 <= client_time.hour < 24
+        now = time.time() if now is None else now
+        local_hours: Dict[str, int] = {}
+        accepted = []
+        for type, time_zone in requests:
+            hour = local_hours.get(time_zone)
+            if hour is None:
+                offset = self._zone_offset(time_zone, now).offset
+                hour = int((now + offset) // 3600 % 24)
+                local_hours[time_zone] = hour
+            mask = self.hour_masks.get(type)
+            accepted.append(mask is None or bool(mask >> hour & 1))
+        return accepted
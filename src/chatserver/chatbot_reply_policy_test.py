@@ -0,0 +1,75 @@
+from datetime import datetime
+
+import pytest
+import pytz
+
+from chatserver.chatbot_reply_policy import ChatBotReplyPolicy, parse_rules
+from request import RequestType
+
+
+def timestamp(time_zone: str, *args) -> float:
+    return pytz.timezone(time_zone).localize(datetime(*args)).timestamp()
+
+
+def test_parse_rules() -> None:
+    hour_masks = parse_rules("text=5-24;audio=8-12,14-15;video=")
+
+    assert hour_masks[RequestType.TEXT] == sum(1 << hour for hour in range(5, 24))
+    assert hour_masks[RequestType.AUDIO] == sum(1 << hour for hour in [8, 9, 10, 11, 14])
+    assert hour_masks[RequestType.VIDEO] == 0
+
+    with pytest.raises(ValueError):
+        parse_rules("image=1-2")
+    with pytest.raises(ValueError):
+        parse_rules("text=20-25")
+
+
+def test_accept() -> None:
+    policy = ChatBotReplyPolicy("text=5-24;audio=8-12;video=")
+    tokyo = "Asia/Tokyo"
+
+    morning = policy.client_time(tokyo, timestamp(tokyo, 2024, 7, 1, 9, 30))
+    assert morning.hour == 9
+    assert policy.accept(RequestType.TEXT, morning)
+    assert policy.accept(RequestType.AUDIO, morning)
+    assert not policy.accept(RequestType.VIDEO, morning)
+
+    night = policy.client_time(tokyo, timestamp(tokyo, 2024, 7, 1, 4, 59))
+    assert not policy.accept(RequestType.TEXT, night)
+
+
+def test_offset_changes_at_transition() -> None:
+    policy = ChatBotReplyPolicy("audio=8-12")
+    new_york = "America/New_York"
+    # clocks go from 2:00 to 3:00 on 2024-03-10
+    before = timestamp(new_york, 2024, 3, 10, 1, 59)
+
+    assert policy.client_time(new_york, before).hour == 1
+    assert policy.client_time(new_york, before + 60).hour == 3
+    # the cached offset is not used after the transition: 7:29 EDT then 8:29 EDT
+    assert policy.accept_batch([(RequestType.AUDIO, new_york)], before + 4.5 * 3600) == [
+        False
+    ]
+    assert policy.accept_batch([(RequestType.AUDIO, new_york)], before + 5.5 * 3600) == [
+        True
+    ]
+
+
+def test_accept_batch() -> None:
+    policy = ChatBotReplyPolicy("text=5-24;audio=8-12;video=20-24")
+    now = timestamp("UTC", 2024, 7, 1, 10, 0)
+
+    accepted = policy.accept_batch(
+        [
+            (RequestType.AUDIO, "UTC"),
+            (RequestType.VIDEO, "UTC"),
+            # 21:00
+            (RequestType.VIDEO, "Pacific/Noumea"),
+            (RequestType.AUDIO, "Pacific/Noumea"),
+            # 3:00
+            (RequestType.TEXT, "America/Los_Angeles"),
+        ],
+        now,
+    )
+
+    assert accepted == [True, False, True, False, False]
@@ -1,94 +1,131 @@
-import asyncio
-import time
-from typing import Optional
-import redis.asyncio as redis
-from redis.asyncio.client import Pipeline
+from abc import ABC, abstractmethod
+from enum import Enum
+from typing import Callable, Dict, Optional
 
 from chatserver.config import Config
 
 
-class ConcurrencyControl:
-    def __init__(
-        self,
-        max_connections: int,
-        max_connection_per_client: int,
-        redis_key: Optional[str] = None,
-    ) -> None:
-        self.redis_client = redis.StrictRedis(host=Config.REDIS_HOST, port=Config.REDIS_PORT, db=0)
-        self.redis_key = redis_key if redis_key else "concurrency_control"
-        self.max_connections = max_connections
-        self.max_connections_per_client = max_connection_per_client
+class AcquireResult(Enum):
+    ACQUIRED = 1
+    SERVER_FULL = 0
+    CLIENT_FULL = -1
 
-    async def _get_hash_map(self, pipe: Optional[Pipeline] = None) -> dict:
-        client = pipe if pipe else self.redis_client
-        hash_map = await client.hgetall(self.redis_key)
-        return {
-            key.decode("utf-8"): value.decode("utf-8")
-            for key, value in hash_map.items()
-        }
 
-    async def _increase_connection(self, client_id: str, pipe: Pipeline) -> None:
-        await pipe.hincrby(self.redis_key, client_id, 1)
+class IConcurrencyControl(ABC):
+    """
+    Limit the number of connections served at the same time,
+    in total and per client, and the number of messages processed at the same time
+    """
 
-    async def _decrease_connection(self, client_id: str) -> None:
-        await self.redis_client.hincrby(self.redis_key, client_id, -1)
+    # called with the operation name and the seconds of every round trip
+    # to a remote backend, to record its latency
+    round_trip_listener: Optional[Callable[[str, float], None]] = None
 
-    def can_client_connect(self, hash_map: dict, client_id: str) -> bool:
-        total_connections = sum(int(value) for value in hash_map.values())
-        if total_connections >= self.max_connections:
-            return False
-
-        if client_id not in hash_map:
-            return True
-
-        if int(hash_map[client_id]) >= self.max_connections_per_client:
-            return False
-
-        return True
+    @abstractmethod
+    async def try_acquire_connection(self, client_id: str) -> AcquireResult:
+        """
+        Take a connection slot for the client, or tell whether the server
+        or the client is already at its limit. Nothing is changed on failure
+        """
+        pass
 
     async def acquire_connection(self, client_id: str) -> bool:
-        # redis lua script
-        lua_script = """
-        local key = KEYS[1]
-        local client_id = ARGV[1]
-        local max_connections = tonumber(ARGV[2])
-        local max_connection_per_client = tonumber(ARGV[3])
-
-        local hash_map = redis.call('HGETALL', key)
-        local total_connections = 0
-        local client_connections = 0
-
-        for i = 1, #hash_map, 2 do
-            total_connections = total_connections + tonumber(hash_map[i + 1])
-            if hash_map[i] == client_id then
-                client_connections = tonumber(hash_map[i + 1])
-            end
-        end
-
-        if total_connections >= max_connections then
-            return 0
-        end
-
-        if client_connections >= max_connection_per_client then
-            return 0
-        end
-
-        redis.call('HINCRBY', key, client_id, 1)
-        return 1
-        """
-        # print("client_id", client_id)
-        # print("max_connections", self.max_connections)
-        # print("max_connection_per_client", self.max_connections_per_client)
-        acquire = self.redis_client.register_script(lua_script)
-        ok = await acquire(
-            keys=[self.redis_key],
-            args=[client_id, self.max_connections, self.max_connections_per_client],
-        )
-        return bool(ok)
+        result = await self.try_acquire_connection(client_id)
+        return result == AcquireResult.ACQUIRED
 
+    @abstractmethod
     async def release_connection(self, client_id: str) -> None:
-        print(f"[Client {client_id}] released connection")
-        await self._decrease_connection(client_id)
+        pass
+
+    @abstractmethod
+    def add_release_listener(self, listener: Callable[[], None]) -> None:
+        """
+        Call listener whenever connection slots are freed on any node
+        """
+        pass
 
+    @abstractmethod
     async def clean_all_sessions(self) -> None:
-        await self.redis_client.delete(self.redis_key)
+        """
+        Drop the connections of every node
+        """
+        pass
+
+    @abstractmethod
+    async def clean_node_sessions(self) -> None:
+        """
+        Drop the connections held by this node only, called when the node (re)starts
+        """
+        pass
+
+    @abstractmethod
+    async def lease_message_tokens(self, count: int) -> int:
+        """
+        Lease up to count in-flight message tokens for this node,
+        return the number of tokens granted (0 when the budget is exhausted)
+        """
+        pass
+
+    @abstractmethod
+    async def return_message_tokens(self, count: int) -> None:
+        pass
+
+    @abstractmethod
+    async def get_leased_message_tokens(self) -> int:
+        """
+        Number of message tokens leased by every node
+        """
+        pass
+
+    async def start(self) -> None:
+        """
+        Start background work of the backend (e.g. lease renewal)
+        """
+        pass
+
+    async def stop(self) -> None:
+        pass
+
+    @abstractmethod
+    async def get_connections(self) -> Dict[str, int]:
+        """
+        Number of connections per client, clients without connection are omitted
+        """
+        pass
+
+    @abstractmethod
+    async def get_total_connections(self) -> int:
+        pass
+
+
+def create_concurrency_control(
+    max_connections: int,
+    max_connection_per_client: int,
+    redis_key: Optional[str] = None,
+    backend: Optional[str] = None,
+    max_messages: Optional[int] = None,
+) -> IConcurrencyControl:
+    """
+    Create the concurrency control backend chosen by Config.CONCURRENCY_BACKEND\n
+    redis: counters are shared by every server node\n
+    memory: counters live in this process, for single node deployments
+    """
+    backend = backend or Config.CONCURRENCY_BACKEND
+    if backend == "redis":
+        from chatserver.redis_concurrency_control import RedisConcurrencyControl
+
+        return RedisConcurrencyControl(
+            max_connections=max_connections,
+            max_connection_per_client=max_connection_per_client,
+            redis_key=redis_key,
+            max_messages=max_messages,
+        )
+    if backend == "memory":
+        from chatserver.memory_concurrency_control import InMemoryConcurrencyControl
+
+        return InMemoryConcurrencyControl(
+            max_connections=max_connections,
+            max_connection_per_client=max_connection_per_client,
+            max_messages=max_messages,
+        )
+    raise ValueError(f"Unknown concurrency control backend: {backend}")
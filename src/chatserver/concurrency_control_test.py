@@ -2,11 +2,14 @@ import asyncio
 
 import pytest
 
-from chatserver.concurrency_control import ConcurrencyControl
+from chatserver.concurrency_control import create_concurrency_control
+
+BACKENDS = ["redis", "memory"]
 
 
 @pytest.mark.asyncio
-async def test_concurrency():
+@pytest.mark.parametrize("backend", BACKENDS)
+async def test_concurrency(backend):
     test_cases = [
         {
             "max_connections": 4,
@@ -46,9 +49,10 @@ async def test_concurrency():
         },
     ]
     for test_case in test_cases:
-        concurrency_control = ConcurrencyControl(
+        concurrency_control = create_concurrency_control(
             max_connections=test_case["max_connections"],
             max_connection_per_client=test_case["max_connection_per_client"],
+            backend=backend,
         )
         await concurrency_control.clean_all_sessions()
         client_ids = test_case["client_ids"]
@@ -58,7 +62,7 @@ async def test_concurrency():
                 for client_id in client_ids
             ]
         )
-        hash_map = await concurrency_control._get_hash_map()
+        hash_map = await concurrency_control.get_connections()
         print("-----")
         print(test_case)
         print("result", result)
@@ -67,3 +71,30 @@ async def test_concurrency():
         assert connection_count == test_case["expected"]
 
     await concurrency_control.clean_all_sessions()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("backend", BACKENDS)
+async def test_release_connection(backend):
+    concurrency_control = create_concurrency_control(
+        max_connections=2,
+        max_connection_per_client=1,
+        backend=backend,
+    )
+    await concurrency_control.clean_all_sessions()
+
+    assert await concurrency_control.acquire_connection("1")
+    assert await concurrency_control.acquire_connection("2")
+    assert not await concurrency_control.acquire_connection("3")
+    assert await concurrency_control.get_total_connections() == 2
+
+    await concurrency_control.release_connection("1")
+    # releasing a client without connections must not free extra capacity
+    await concurrency_control.release_connection("1")
+    assert await concurrency_control.get_total_connections() == 1
+    assert await concurrency_control.get_connections() == {"2": 1}
+
+    assert await concurrency_control.acquire_connection("3")
+    assert not await concurrency_control.acquire_connection("4")
+
+    await concurrency_control.clean_all_sessions()
@@ -1,4 +1,6 @@
 import os
+import socket
+import tempfile
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -9,8 +11,102 @@ class Config:
     SERVER_PORT = int(os.getenv("SERVER_PORT") or 3)
     MAX_CONNECTIONS = int(os.getenv("MAX_CONNECTIONS") or 1000)
     MAX_CONNECTION_PER_CLIENT = int(os.getenv("MAX_CONNECTION_PER_CLIENT") or 1)
+    # asyncio, uvloop or winloop, auto uses uvloop or winloop when installed
+    EVENT_LOOP = os.getenv("EVENT_LOOP") or "auto"
+    # Logs are written by a background thread from a queue of LOG_QUEUE_SIZE records,
+    # records that do not fit are dropped. LOG_FORMAT is text or json.
+    # Only LOG_MESSAGE_SAMPLE_RATE of the info logs of every message are kept
+    LOG_LEVEL = (os.getenv("LOG_LEVEL") or "INFO").upper()
+    LOG_FORMAT = os.getenv("LOG_FORMAT") or "text"
+    LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE") or 10000)
+    LOG_MESSAGE_SAMPLE_RATE = float(os.getenv("LOG_MESSAGE_SAMPLE_RATE") or 1)
+    # HTTP path of the Prometheus metrics on the server port, empty to disable them
+    METRICS_PATH = os.getenv("METRICS_PATH", "/metrics")
+    # Number of server processes sharing the port, more than 1 needs the redis backend
+    WORKERS = int(os.getenv("WORKERS") or 1)
+    # permessage-deflate, the media of requests and responses is already compressed
+    # so deflating it costs most of the CPU of the server for nothing
+    WEBSOCKET_COMPRESSION = (
+        os.getenv("WEBSOCKET_COMPRESSION") or "false"
+    ).lower() in ("1", "true")
+    # Maximum size of a request and of each of its websocket fragments,
+    # large media must be sent as a fragmented message
+    MAX_REQUEST_SIZE = int(os.getenv("MAX_REQUEST_SIZE") or 100000000)
+    MAX_FRAME_SIZE = int(os.getenv("MAX_FRAME_SIZE") or 2**20)
+    # Bytes of request bodies all the connections keep in memory,
+    # the bodies that do not fit are written to files in UPLOAD_SPOOL_DIR
+    UPLOAD_MEMORY_BUDGET = int(os.getenv("UPLOAD_MEMORY_BUDGET") or 64 * 2**20)
+    UPLOAD_SPOOL_DIR = os.getenv("UPLOAD_SPOOL_DIR") or os.path.join(
+        tempfile.gettempdir(), "chatserver_uploads"
+    )
+    # Media of the requests and replies are stored once per content in
+    # MEDIA_STORAGE_DIR, the chat history keeps their URL MEDIA_BASE_URL/<sha256>
+    MEDIA_STORAGE_DIR = os.getenv("MEDIA_STORAGE_DIR") or os.path.join(
+        tempfile.gettempdir(), "chatserver_media"
+    )
+    MEDIA_BASE_URL = os.getenv("MEDIA_BASE_URL") or "/media"
+    # Memory-map the sample media of the responses instead of reading them in memory
+    RESPONSE_ASSETS_MMAP = (os.getenv("RESPONSE_ASSETS_MMAP") or "false").lower() in (
+        "1",
+        "true",
+    )
+    # The chat history keeps the last CHAT_HISTORY_MAX_MESSAGES_PER_CLIENT messages
+    # of every client, the least recently active clients are dropped when all the
+    # messages use more than CHAT_HISTORY_MAX_BYTES
+    CHAT_HISTORY_MAX_MESSAGES_PER_CLIENT = int(
+        os.getenv("CHAT_HISTORY_MAX_MESSAGES_PER_CLIENT") or 1000
+    )
+    CHAT_HISTORY_MAX_BYTES = int(os.getenv("CHAT_HISTORY_MAX_BYTES") or 256 * 2**20)
+    # memory: bounded history of this process, sqlite: history written to
+    # CHAT_HISTORY_SQLITE_PATH in batches of CHAT_HISTORY_BATCH_SIZE messages or
+    # every CHAT_HISTORY_FLUSH_INTERVAL seconds, with durability off, normal or full
+    CHAT_HISTORY_BACKEND = os.getenv("CHAT_HISTORY_BACKEND") or "memory"
+    CHAT_HISTORY_SQLITE_PATH = os.getenv("CHAT_HISTORY_SQLITE_PATH") or "chat_history.db"
+    CHAT_HISTORY_DURABILITY = os.getenv("CHAT_HISTORY_DURABILITY") or "normal"
+    CHAT_HISTORY_BATCH_SIZE = int(os.getenv("CHAT_HISTORY_BATCH_SIZE") or 500)
+    CHAT_HISTORY_FLUSH_INTERVAL = float(os.getenv("CHAT_HISTORY_FLUSH_INTERVAL") or 0.05)
+    # Memory of the full-text index of the history, 0 disables the search
+    CHAT_HISTORY_SEARCH_MAX_BYTES = int(os.getenv("CHAT_HISTORY_SEARCH_MAX_BYTES") or 0)
+    # Address of the history service, python -m chat_history.history_service
+    HISTORY_SERVICE_HOST = os.getenv("HISTORY_SERVICE_HOST") or "localhost"
+    HISTORY_SERVICE_PORT = int(os.getenv("HISTORY_SERVICE_PORT") or 8081)
+    # Seconds between two updates of the search index of the history service
+    HISTORY_SERVICE_SEARCH_INTERVAL = float(
+        os.getenv("HISTORY_SERVICE_SEARCH_INTERVAL") or 1
+    )
+    # Hours of the client time zone at which each request type is accepted,
+    # start-end windows separated by commas, a type with no window is never accepted
+    REPLY_POLICY = os.getenv("REPLY_POLICY") or "text=5-24;audio=8-12;video=20-24"
+    # Number of requests of a connection handled at the same time,
+    # 1 answers the requests of a connection one by one in order
+    MAX_IN_FLIGHT_PER_CONNECTION = int(
+        os.getenv("MAX_IN_FLIGHT_PER_CONNECTION") or 1
+    )
+    # When the server is full, a connection waits up to ADMISSION_QUEUE_TIMEOUT
+    # seconds in a queue of at most ADMISSION_QUEUE_MAX_LENGTH connections
+    ADMISSION_QUEUE_MAX_LENGTH = int(os.getenv("ADMISSION_QUEUE_MAX_LENGTH") or 100)
+    ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT") or 30)
+    # seconds sent in the Retry-After header of a rejected handshake
+    # when the wait can not be estimated
+    RETRY_AFTER = int(os.getenv("RETRY_AFTER") or 5)
+    # At most MAX_MESSAGES messages are processed at the same time by all nodes.
+    # Nodes lease tokens MESSAGE_TOKEN_BLOCK_SIZE at a time, when none is left a
+    # message waits up to MESSAGE_QUEUE_TIMEOUT seconds in a queue of at most
+    # MAX_MESSAGE_QUEUE messages, otherwise it gets an error response
+    MAX_MESSAGES = int(os.getenv("MAX_MESSAGES") or 500)
+    MESSAGE_TOKEN_BLOCK_SIZE = int(os.getenv("MESSAGE_TOKEN_BLOCK_SIZE") or 10)
+    MAX_MESSAGE_QUEUE = int(os.getenv("MAX_MESSAGE_QUEUE") or 100)
+    MESSAGE_QUEUE_TIMEOUT = float(os.getenv("MESSAGE_QUEUE_TIMEOUT") or 5)
+    # redis: share connection counters between nodes, memory: single node only
+    CONCURRENCY_BACKEND = os.getenv("CONCURRENCY_BACKEND") or "redis"
     CONCURRENT_CONTROL_REDIS_KEY = (
         os.getenv("CONCURRENT_CONTROL_REDIS_KEY") or "concurrency_control"
     )
+    # Connections of a node are released by the other nodes when the node does not
+    # renew its lease for CONNECTION_LEASE_TTL seconds.
+    # NODE_ID must stay the same across restarts of a node
+    NODE_ID = os.getenv("NODE_ID") or socket.gethostname()
+    CONNECTION_LEASE_TTL = float(os.getenv("CONNECTION_LEASE_TTL") or 10)
+    # A single Redis server, the scripts of the redis backend do not run on Redis Cluster
     REDIS_HOST = os.getenv("REDIS_HOST")
     REDIS_PORT = int(os.getenv("REDIS_PORT") or 6379)
@@ -0,0 +1,51 @@
+import asyncio
+import importlib
+import logging
+from typing import Callable, Coroutine, Optional, TypeVar
+
+from chatserver.config import Config
+
+logger = logging.getLogger("chatserver.event_loop")
+
+T = TypeVar("T")
+
+# modules providing a faster drop-in event loop, tried in order by "auto"
+EVENT_LOOP_MODULES = ["uvloop", "winloop"]
+
+
+def get_event_loop_factory(
+    name: Optional[str] = None,
+) -> Optional[Callable[[], asyncio.AbstractEventLoop]]:
+    """
+    Event loop factory of Config.EVENT_LOOP, None for the default asyncio loop\n
+    asyncio: the default loop\n
+    uvloop, winloop: that loop, the default one if it is not installed\n
+    auto: the first of EVENT_LOOP_MODULES installed
+    """
+    name = name or Config.EVENT_LOOP
+    if name == "asyncio":
+        return None
+    if name == "auto":
+        candidates = EVENT_LOOP_MODULES
+    elif name in EVENT_LOOP_MODULES:
+        candidates = [name]
+    else:
+        raise ValueError(f"Unknown event loop: {name}")
+
+    for module_name in candidates:
+        try:
+            module = importlib.import_module(module_name)
+        except ImportError:
+            continue
+        return module.new_event_loop
+    if name != "auto":
+        logger.warning("%s is not installed, using the asyncio event loop", name)
+    return None
+
+
+def run(main: Coroutine[None, None, T], event_loop: Optional[str] = None) -> T:
+    """
+    asyncio.run on the event loop chosen by Config.EVENT_LOOP
+    """
+    with asyncio.Runner(loop_factory=get_event_loop_factory(event_loop)) as runner:
+        return runner.run(main)
@@ -0,0 +1,41 @@
+import asyncio
+import sys
+import types
+
+import pytest
+
+from chatserver import event_loop
+
+
+async def get_loop() -> asyncio.AbstractEventLoop:
+    return asyncio.get_running_loop()
+
+
+def test_default_event_loop() -> None:
+    assert event_loop.get_event_loop_factory("asyncio") is None
+    assert isinstance(event_loop.run(get_loop(), "asyncio"), asyncio.BaseEventLoop)
+
+    with pytest.raises(ValueError):
+        event_loop.get_event_loop_factory("trio")
+
+
+def test_fallback_when_not_installed(monkeypatch, caplog) -> None:
+    # a None entry makes the import fail
+    monkeypatch.setitem(sys.modules, "uvloop", None)
+    monkeypatch.setitem(sys.modules, "winloop", None)
+
+    assert event_loop.get_event_loop_factory("uvloop") is None
+    assert caplog.messages == ["uvloop is not installed, using the asyncio event loop"]
+    assert event_loop.get_event_loop_factory("auto") is None
+
+
+def test_installed_event_loop(monkeypatch) -> None:
+    class FastEventLoop(asyncio.SelectorEventLoop):
+        pass
+
+    monkeypatch.setitem(
+        sys.modules, "uvloop", types.SimpleNamespace(new_event_loop=FastEventLoop)
+    )
+
+    assert event_loop.get_event_loop_factory("auto") is FastEventLoop
+    assert isinstance(event_loop.run(get_loop(), "uvloop"), FastEventLoop)
@@ -2,3 +2,9 @@ class MessagePolicyException(Exception):
     def __init__(self, message):
         self.message = message
         super().__init__(self.message)
+
+
+class MessageLimitException(Exception):
+    def __init__(self, message):
+        self.message = message
+        super().__init__(self.message)
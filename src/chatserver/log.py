@@ -0,0 +1,152 @@
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+from typing import Optional
+
+from chatserver.config import Config
+
+# logger of the logs written for every message, sampled with LOG_MESSAGE_SAMPLE_RATE
+MESSAGE_LOGGER = "chatserver.messages"
+
+# attributes of every LogRecord, the others were passed with extra=
+RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class StructuredFormatter(logging.Formatter):
+    """
+    Format a record and the fields given with extra= as a JSON object,
+    or as a line of text followed by key=value pairs
+    """
+
+    def __init__(self, use_json: bool = False) -> None:
+        super().__init__("%(asctime)s %(levelname)s %(name)s %(message)s")
+        self.use_json = use_json
+
+    def format(self, record: logging.LogRecord) -> str:
+        fields = {
+            key: value
+            for key, value in vars(record).items()
+            if key not in RECORD_ATTRIBUTES
+        }
+        if not self.use_json:
+            line = super().format(record)
+            return " ".join([line, *(f"{key}={value}" for key, value in fields.items())])
+
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            **fields,
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keep a random rate of the records below WARNING, warnings and errors
+    are always kept
+    """
+
+    def __init__(self, rate: float) -> None:
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno >= logging.WARNING or random.random() < self.rate
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Put records in a bounded queue without waiting, the records are
+    formatted and written by a QueueListener thread.
+    A record that does not fit in the queue is dropped and counted
+    """
+
+    def __init__(self, max_size: int) -> None:
+        super().__init__(queue.Queue(max_size))
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # the record stays in this process, it is formatted by the listener
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class DrainingQueueListener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self) -> None:
+        # the queue may be full, wait until the records in front are written
+        self.queue.put(self._sentinel)
+
+
+_handler: Optional[DroppingQueueHandler] = None
+_listener: Optional[DrainingQueueListener] = None
+
+
+def setup_logging(
+    level: Optional[str] = None,
+    use_json: Optional[bool] = None,
+    queue_size: Optional[int] = None,
+    message_sample_rate: Optional[float] = None,
+) -> DroppingQueueHandler:
+    """
+    Send the logs of the chatserver loggers through a bounded queue
+    to a thread writing them to stdout
+    """
+    global _handler, _listener
+    stop_logging()
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(
+        StructuredFormatter(Config.LOG_FORMAT == "json" if use_json is None else use_json)
+    )
+    _handler = DroppingQueueHandler(queue_size or Config.LOG_QUEUE_SIZE)
+    _listener = DrainingQueueListener(_handler.queue, stream_handler)
+    _listener.start()
+
+    logger = logging.getLogger("chatserver")
+    logger.setLevel(level or Config.LOG_LEVEL)
+    logger.addHandler(_handler)
+    logger.propagate = False
+
+    message_logger = logging.getLogger(MESSAGE_LOGGER)
+    for log_filter in list(message_logger.filters):
+        message_logger.removeFilter(log_filter)
+    message_logger.addFilter(
+        SamplingFilter(
+            Config.LOG_MESSAGE_SAMPLE_RATE
+            if message_sample_rate is None
+            else message_sample_rate
+        )
+    )
+    return _handler
+
+
+def stop_logging() -> None:
+    """
+    Write the records left in the queue and stop the listener thread
+    """
+    global _handler, _listener
+    if _handler is None:
+        return
+    logger = logging.getLogger("chatserver")
+    logger.removeHandler(_handler)
+    logger.propagate = True
+    _listener.stop()
+    if _handler.dropped:
+        print(f"{_handler.dropped} log records were dropped", file=sys.stderr)
+    _handler = _listener = None
+
+
+def dropped_records() -> int:
+    return _handler.dropped if _handler is not None else 0
@@ -0,0 +1,61 @@
+import json
+import logging
+
+from chatserver.log import (
+    MESSAGE_LOGGER,
+    DroppingQueueHandler,
+    SamplingFilter,
+    StructuredFormatter,
+    setup_logging,
+    stop_logging,
+)
+
+
+def make_record(level: int = logging.INFO, **extra) -> logging.LogRecord:
+    record = logging.makeLogRecord(
+        {"name": "chatserver.test", "levelno": level, "msg": "Hello %s", "args": ("you",)}
+    )
+    record.levelname = logging.getLevelName(level)
+    record.__dict__.update(extra)
+    return record
+
+
+def test_dropping_queue_handler():
+    handler = DroppingQueueHandler(max_size=2)
+    for _ in range(5):
+        handler.handle(make_record())
+    assert handler.queue.qsize() == 2
+    assert handler.dropped == 3
+
+
+def test_sampling_filter():
+    assert not SamplingFilter(0).filter(make_record())
+    assert SamplingFilter(0).filter(make_record(logging.WARNING))
+    assert SamplingFilter(1).filter(make_record())
+
+
+def test_structured_formatter():
+    record = make_record(client_id="1")
+    entry = json.loads(StructuredFormatter(use_json=True).format(record))
+    assert entry["message"] == "Hello you"
+    assert entry["level"] == "INFO"
+    assert entry["client_id"] == "1"
+
+    line = StructuredFormatter().format(record)
+    assert line.endswith("INFO chatserver.test Hello you client_id=1")
+
+
+def test_setup_logging(capsys):
+    setup_logging(level="INFO", use_json=True, queue_size=100, message_sample_rate=0)
+    try:
+        logging.getLogger("chatserver.test").info("Started", extra={"port": 3})
+        logging.getLogger(MESSAGE_LOGGER).info("Sampled out")
+        logging.getLogger(MESSAGE_LOGGER).error("Kept")
+    finally:
+        stop_logging()
+
+    lines = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert [(line["message"], line.get("port")) for line in lines] == [
+        ("Started", 3),
+        ("Kept", None),
+    ]
@@ -0,0 +1,87 @@
+import logging
+from typing import Callable, Dict, List, Optional
+
+from chatserver.concurrency_control import AcquireResult, IConcurrencyControl
+from chatserver.config import Config
+
+logger = logging.getLogger("chatserver.concurrency_control")
+
+
+class InMemoryConcurrencyControl(IConcurrencyControl):
+    """
+    Connection counters kept in this process, only valid when a single
+    server node is running.
+    Each method runs without awaiting, so it is atomic on the event loop
+    """
+
+    def __init__(
+        self,
+        max_connections: int,
+        max_connection_per_client: int,
+        max_messages: Optional[int] = None,
+    ) -> None:
+        self.max_connections = max_connections
+        self.max_connections_per_client = max_connection_per_client
+        self.max_messages = max_messages or Config.MAX_MESSAGES
+        self.connections: Dict[str, int] = {}
+        self.total_connections = 0
+        self.leased_message_tokens = 0
+        self.release_listeners: List[Callable[[], None]] = []
+
+    async def try_acquire_connection(self, client_id: str) -> AcquireResult:
+        if self.total_connections >= self.max_connections:
+            return AcquireResult.SERVER_FULL
+
+        client_connections = self.connections.get(client_id, 0)
+        if client_connections >= self.max_connections_per_client:
+            return AcquireResult.CLIENT_FULL
+
+        self.connections[client_id] = client_connections + 1
+        self.total_connections += 1
+        return AcquireResult.ACQUIRED
+
+    async def release_connection(self, client_id: str) -> None:
+        logger.debug("Released connection", extra={"client_id": client_id})
+        client_connections = self.connections.get(client_id, 0)
+        if client_connections <= 0:
+            return
+
+        if client_connections == 1:
+            del self.connections[client_id]
+        else:
+            self.connections[client_id] = client_connections - 1
+        self.total_connections -= 1
+        self._notify_release()
+
+    def add_release_listener(self, listener: Callable[[], None]) -> None:
+        self.release_listeners.append(listener)
+
+    def _notify_release(self) -> None:
+        for listener in self.release_listeners:
+            listener()
+
+    async def lease_message_tokens(self, count: int) -> int:
+        granted = max(0, min(count, self.max_messages - self.leased_message_tokens))
+        self.leased_message_tokens += granted
+        return granted
+
+    async def return_message_tokens(self, count: int) -> None:
+        self.leased_message_tokens = max(0, self.leased_message_tokens - count)
+
+    async def get_leased_message_tokens(self) -> int:
+        return self.leased_message_tokens
+
+    async def clean_all_sessions(self) -> None:
+        self.connections.clear()
+        self.total_connections = 0
+        self.leased_message_tokens = 0
+        self._notify_release()
+
+    async def clean_node_sessions(self) -> None:
+        await self.clean_all_sessions()
+
+    async def get_connections(self) -> Dict[str, int]:
+        return dict(self.connections)
+
+    async def get_total_connections(self) -> int:
+        return self.total_connections
@@ -0,0 +1,148 @@
+import asyncio
+from collections import deque
+from typing import Deque, Optional, Set
+
+from chatserver.concurrency_control import IConcurrencyControl
+from chatserver.config import Config
+from chatserver.exceptions import MessageLimitException
+
+
+class MessageLimiter:
+    """
+    Limit the number of messages processed at the same time by every node.
+
+    Tokens are leased from the concurrency control backend block_size at a time
+    and handed out locally, so most messages do not cost a round trip.
+    When no token is left, a message waits in a FIFO queue of at most max_queue
+    messages for up to queue_timeout seconds, otherwise MessageLimitException is raised
+    """
+
+    def __init__(
+        self,
+        concurrency_control: IConcurrencyControl,
+        block_size: Optional[int] = None,
+        max_queue: Optional[int] = None,
+        queue_timeout: Optional[float] = None,
+        retry_interval: float = 0.05,
+    ) -> None:
+        self.concurrency_control = concurrency_control
+        self.block_size = block_size or Config.MESSAGE_TOKEN_BLOCK_SIZE
+        self.max_queue = Config.MAX_MESSAGE_QUEUE if max_queue is None else max_queue
+        self.queue_timeout = (
+            Config.MESSAGE_QUEUE_TIMEOUT if queue_timeout is None else queue_timeout
+        )
+        # how often the first waiter tries to lease tokens released by other nodes
+        self.retry_interval = retry_interval
+        # leased tokens not used by any message
+        self.available = 0
+        self.in_use = 0
+        self.waiters: Deque[asyncio.Future] = deque()
+        self._lease_lock = asyncio.Lock()
+        self._background_tasks: Set[asyncio.Task] = set()
+
+    @property
+    def queue_length(self) -> int:
+        return len(self.waiters)
+
+    async def _lease_block(self) -> None:
+        async with self._lease_lock:
+            # another message may have leased a block while we were waiting for the lock
+            if self.available > 0:
+                return
+            self.available += await self.concurrency_control.lease_message_tokens(
+                self.block_size
+            )
+
+    def _take(self) -> bool:
+        if self.available <= 0:
+            return False
+        self.available -= 1
+        self.in_use += 1
+        return True
+
+    async def acquire(self) -> None:
+        """
+        Take a token for one message. If the task is cancelled, the token handed
+        over to it is released, so the caller only releases after a successful acquire
+        """
+        if not self.waiters and self._take():
+            return
+
+        if not self.waiters:
+            await self._lease_block()
+            if self._take():
+                return
+
+        if len(self.waiters) >= self.max_queue:
+            raise MessageLimitException("Too many messages, please try again later")
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            await asyncio.wait_for(self._wait_for_token(waiter), self.queue_timeout)
+        except asyncio.TimeoutError:
+            # a token may have been handed over right before the timeout
+            if not waiter.done():
+                raise MessageLimitException("Too many messages, please try again later")
+        except BaseException:
+            # the token handed over to this waiter would otherwise be lost
+            if waiter.done():
+                self.release()
+            raise
+        finally:
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+
+    async def _wait_for_token(self, waiter: asyncio.Future) -> None:
+        """
+        Wait until release hands a token to this waiter. The first waiter also
+        tries to lease tokens given back by other nodes.
+        The waiter is done once it owns a token, however it got it
+        """
+        while True:
+            if waiter.done():
+                return
+            if waiter is self.waiters[0]:
+                await self._lease_block()
+                # release may have handed a token over during the lease
+                if waiter.done():
+                    return
+                if self._take():
+                    waiter.set_result(None)
+                    return
+            try:
+                await asyncio.wait_for(asyncio.shield(waiter), self.retry_interval)
+                return
+            except asyncio.TimeoutError:
+                continue
+
+    def release(self) -> None:
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                # hand the token over to the first waiter
+                waiter.set_result(None)
+                return
+
+        self.in_use -= 1
+        self.available += 1
+        # keep at most one block idle on this node, give the rest back
+        excess = self.available - self.block_size
+        if excess > 0:
+            self.available -= excess
+            self._run_in_background(
+                self.concurrency_control.return_message_tokens(excess)
+            )
+
+    def _run_in_background(self, coro) -> None:
+        task = asyncio.create_task(coro)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+
+    async def close(self) -> None:
+        """
+        Give back every idle token
+        """
+        if self.available > 0:
+            available, self.available = self.available, 0
+            await self.concurrency_control.return_message_tokens(available)
@@ -0,0 +1,132 @@
+import asyncio
+
+import pytest
+
+from chatserver.concurrency_control import create_concurrency_control
+from chatserver.exceptions import MessageLimitException
+from chatserver.message_limiter import MessageLimiter
+
+BACKENDS = ["redis", "memory"]
+
+
+def new_concurrency_control(backend: str, max_messages: int):
+    return create_concurrency_control(
+        max_connections=10,
+        max_connection_per_client=1,
+        redis_key="message_limiter_test",
+        backend=backend,
+        max_messages=max_messages,
+    )
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("backend", BACKENDS)
+async def test_tokens_are_leased_in_blocks(backend):
+    concurrency_control = new_concurrency_control(backend, max_messages=5)
+    await concurrency_control.clean_all_sessions()
+    limiter = MessageLimiter(concurrency_control, block_size=2, max_queue=0)
+
+    await limiter.acquire()
+    assert await concurrency_control.get_leased_message_tokens() == 2
+    await limiter.acquire()
+    await limiter.acquire()
+    await limiter.acquire()
+    await limiter.acquire()
+    assert await concurrency_control.get_leased_message_tokens() == 5
+
+    # budget exhausted and no room to queue
+    with pytest.raises(MessageLimitException):
+        await limiter.acquire()
+
+    for _ in range(5):
+        limiter.release()
+    await asyncio.gather(*limiter._background_tasks)
+    # only one block stays idle on the node
+    assert limiter.available == 2
+    assert await concurrency_control.get_leased_message_tokens() == 2
+
+    await limiter.close()
+    assert await concurrency_control.get_leased_message_tokens() == 0
+    await concurrency_control.clean_all_sessions()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("backend", BACKENDS)
+async def test_waiters_are_served_in_order(backend):
+    concurrency_control = new_concurrency_control(backend, max_messages=1)
+    await concurrency_control.clean_all_sessions()
+    limiter = MessageLimiter(
+        concurrency_control, block_size=1, max_queue=2, queue_timeout=1
+    )
+    await limiter.acquire()
+
+    served = []
+
+    async def process(name: str):
+        await limiter.acquire()
+        served.append(name)
+
+    first = asyncio.create_task(process("first"))
+    await asyncio.sleep(0)
+    second = asyncio.create_task(process("second"))
+    await asyncio.sleep(0)
+    # the queue is full
+    with pytest.raises(MessageLimitException):
+        await limiter.acquire()
+
+    limiter.release()
+    await first
+    limiter.release()
+    await second
+    assert served == ["first", "second"]
+
+    limiter.release()
+    await limiter.close()
+    await concurrency_control.clean_all_sessions()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("backend", BACKENDS)
+async def test_waiter_times_out(backend):
+    concurrency_control = new_concurrency_control(backend, max_messages=1)
+    await concurrency_control.clean_all_sessions()
+    limiter = MessageLimiter(
+        concurrency_control, block_size=1, max_queue=1, queue_timeout=0.1
+    )
+    await limiter.acquire()
+
+    with pytest.raises(MessageLimitException):
+        await limiter.acquire()
+    assert limiter.queue_length == 0
+
+    limiter.release()
+    await limiter.close()
+    await concurrency_control.clean_all_sessions()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("backend", BACKENDS)
+async def test_cancelled_waiter_gives_its_token_back(backend):
+    concurrency_control = new_concurrency_control(backend, max_messages=1)
+    await concurrency_control.clean_all_sessions()
+    limiter = MessageLimiter(
+        concurrency_control, block_size=1, max_queue=1, queue_timeout=1
+    )
+    await limiter.acquire()
+
+    waiter = asyncio.create_task(limiter.acquire())
+    while not limiter.queue_length:
+        await asyncio.sleep(0)
+    await asyncio.sleep(0)
+    # the waiting task is cancelled while the token is handed over to it
+    waiter.cancel()
+    limiter.release()
+    with pytest.raises(asyncio.CancelledError):
+        await waiter
+    assert limiter.in_use == 0
+    assert limiter.available == 1
+
+    await asyncio.wait_for(limiter.acquire(), 0.5)
+    limiter.release()
+    await limiter.close()
+    await concurrency_control.clean_all_sessions()
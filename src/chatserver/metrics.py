@@ -0,0 +1,369 @@
+from abc import ABC, abstractmethod
+import asyncio
+import bisect
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from chat_history.chat_history import IChatHistory
+from chatserver.log import dropped_records
+from chatserver.startup import StartupTimer
+
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10
+)
+# 256 bytes to 64 MiB, every bucket 4 times larger than the previous one
+SIZE_BUCKETS = tuple(256 * 4**i for i in range(10))
+
+LabelValues = Tuple[str, ...]
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    escaped = (
+        str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        for value in values
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class CounterValue:
+    __slots__ = ("value",)
+
+    def __init__(self) -> None:
+        self.value = 0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+
+class GaugeValue:
+    __slots__ = ("value",)
+
+    def __init__(self) -> None:
+        self.value = 0
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        self.value -= amount
+
+
+class HistogramValue:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Sequence[float]) -> None:
+        self.buckets = buckets
+        # counts[i] is the number of observations in (buckets[i - 1], buckets[i]],
+        # the last one of those above the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metric(ABC):
+    """
+    Metric with one value per combination of label values.
+    The value of labels(...) can be kept by the caller, so recording
+    on the hot path is a plain attribute update
+    """
+
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, label_names: Sequence[str] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.values: Dict[LabelValues, object] = {}
+
+    @abstractmethod
+    def _new_value(self):
+        pass
+
+    def labels(self, *label_values: str):
+        if len(label_values) != len(self.label_names):
+            raise ValueError(f"{self.name} expects labels {self.label_names}")
+        value = self.values.get(label_values)
+        if value is None:
+            value = self.values[label_values] = self._new_value()
+        return value
+
+    def samples(self) -> List[Tuple[str, str, float]]:
+        return [
+            ("", _format_labels(self.label_names, label_values), value.value)
+            for label_values, value in self.values.items()
+        ]
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{labels} {_format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def _new_value(self) -> CounterValue:
+        return CounterValue()
+
+
+class Gauge(Metric):
+    """
+    Gauge set by the caller, or read from function when rendered
+    """
+
+    type = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        label_names: Sequence[str] = (),
+        function: Optional[Callable[[], Optional[float]]] = None,
+    ) -> None:
+        super().__init__(name, help, label_names)
+        self.function = function
+
+    def _new_value(self) -> GaugeValue:
+        return GaugeValue()
+
+    def samples(self) -> List[Tuple[str, str, float]]:
+        if self.function is None:
+            return super().samples()
+        value = self.function()
+        return [] if value is None else [("", "", value)]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        label_names: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ) -> None:
+        super().__init__(name, help, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_value(self) -> HistogramValue:
+        return HistogramValue(self.buckets)
+
+    def samples(self) -> List[Tuple[str, str, float]]:
+        samples = []
+        for label_values, value in self.values.items():
+            cumulative = 0
+            for bound, count in zip([*self.buckets, float("inf")], value.counts):
+                cumulative += count
+                labels = _format_labels(
+                    [*self.label_names, "le"], [*label_values, _format_value(bound)]
+                )
+                samples.append(("_bucket", labels, cumulative))
+            labels = _format_labels(self.label_names, label_values)
+            samples.append(("_sum", labels, value.sum))
+            samples.append(("_count", labels, value.count))
+        return samples
+
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        self.metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """
+        Every metric in the Prometheus text format
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class ChatServerMetrics:
+    """
+    Metrics of a chat server node, exposed on Config.METRICS_PATH
+    """
+
+    def __init__(
+        self,
+        startup_timer: Optional[StartupTimer] = None,
+        chat_history: Optional[IChatHistory] = None,
+    ) -> None:
+        self.registry = MetricsRegistry()
+        register = self.registry.register
+        if startup_timer is not None:
+            register(
+                Gauge(
+                    "chatserver_listening_after_seconds",
+                    "Seconds from the start of the process to listening",
+                    function=lambda: startup_timer.listening_after,
+                )
+            )
+            register(
+                Gauge(
+                    "chatserver_first_connection_after_seconds",
+                    "Seconds from the start of the process to the first accepted connection",
+                    function=lambda: startup_timer.first_connection_after,
+                )
+            )
+        if chat_history is not None:
+            # every backend reports what it can, the others have no sample
+            register(
+                Gauge(
+                    "chatserver_chat_history_bytes",
+                    "Approximate memory used by the chat history",
+                    function=lambda: getattr(chat_history, "used_bytes", None),
+                )
+            )
+            register(
+                Gauge(
+                    "chatserver_chat_history_messages",
+                    "Messages kept in the chat history",
+                    function=lambda: getattr(chat_history, "message_count", None),
+                )
+            )
+            register(
+                Gauge(
+                    "chatserver_chat_history_queue_depth",
+                    "Messages waiting to be written to the chat history",
+                    function=lambda: getattr(chat_history, "queue_depth", None),
+                )
+            )
+            register(
+                Gauge(
+                    "chatserver_chat_history_dropped",
+                    "Messages dropped because the chat history queue was full "
+                    "or their batch could not be written",
+                    function=lambda: getattr(chat_history, "dropped", None),
+                )
+            )
+            search_index = getattr(chat_history, "search_index", None)
+            if search_index is not None:
+                register(
+                    Gauge(
+                        "chatserver_search_index_bytes",
+                        "Approximate memory used by the search index of the history",
+                        function=lambda: search_index.used_bytes,
+                    )
+                )
+        self.node_connections: Gauge = register(
+            Gauge("chatserver_node_connections", "Connections served by this node")
+        )
+        self.global_connections: Gauge = register(
+            Gauge(
+                "chatserver_global_connections",
+                "Connections of every node, from the concurrency control backend",
+            )
+        )
+        self.admissions: Counter = register(
+            Counter(
+                "chatserver_admissions_total",
+                "Connection attempts by result and reason",
+                ["result", "reason"],
+            )
+        )
+        self.request_phase_seconds: Histogram = register(
+            Histogram(
+                "chatserver_request_phase_seconds",
+                "Time spent by requests in each phase of their handling",
+                ["type", "phase"],
+            )
+        )
+        self.request_bytes: Histogram = register(
+            Histogram(
+                "chatserver_request_bytes",
+                "Size of the requests",
+                ["type"],
+                buckets=SIZE_BUCKETS,
+            )
+        )
+        self.response_bytes: Histogram = register(
+            Histogram(
+                "chatserver_response_bytes",
+                "Size of the responses",
+                ["type"],
+                buckets=SIZE_BUCKETS,
+            )
+        )
+        self.redis_round_trip_seconds: Histogram = register(
+            Histogram(
+                "chatserver_redis_round_trip_seconds",
+                "Round trip of the concurrency control calls to redis",
+                ["operation"],
+            )
+        )
+        self.event_loop_lag_seconds: Histogram = register(
+            Histogram(
+                "chatserver_event_loop_lag_seconds",
+                "How late the event loop runs a callback scheduled every "
+                "lag_interval seconds",
+            )
+        )
+        register(
+            Gauge(
+                "chatserver_log_records_dropped",
+                "Log records dropped because the log queue was full",
+                function=dropped_records,
+            )
+        )
+        self._lag_task: Optional[asyncio.Task] = None
+
+    def observe_redis_round_trip(self, operation: str, seconds: float) -> None:
+        self.redis_round_trip_seconds.labels(operation).observe(seconds)
+
+    async def _monitor_event_loop_lag(self, interval: float) -> None:
+        lag = self.event_loop_lag_seconds.labels()
+        while True:
+            expected = time.perf_counter() + interval
+            await asyncio.sleep(interval)
+            lag.observe(max(0.0, time.perf_counter() - expected))
+
+    def start(self, lag_interval: float = 0.5) -> None:
+        if self._lag_task is None:
+            self._lag_task = asyncio.create_task(
+                self._monitor_event_loop_lag(lag_interval)
+            )
+
+    async def stop(self) -> None:
+        if self._lag_task is not None:
+            self._lag_task.cancel()
+            await asyncio.gather(self._lag_task, return_exceptions=True)
+            self._lag_task = None
+
+
+class RequestTypeMetrics:
+    """
+    Metric values of one request type, looked up once so recording a request
+    does not build label tuples
+    """
+
+    def __init__(self, metrics: ChatServerMetrics, type_name: str) -> None:
+        phases = metrics.request_phase_seconds
+        self.decode = phases.labels(type_name, "decode")
+        self.policy = phases.labels(type_name, "policy")
+        self.store = phases.labels(type_name, "store")
+        self.generate = phases.labels(type_name, "generate")
+        self.send = phases.labels(type_name, "send")
+        self.request_bytes = metrics.request_bytes.labels(type_name)
+        self.response_bytes = metrics.response_bytes.labels(type_name)
@@ -0,0 +1,37 @@
+import pytest
+
+from chatserver.metrics import Counter, Gauge, Histogram, MetricsRegistry
+
+
+def test_render():
+    registry = MetricsRegistry()
+    counter = registry.register(Counter("requests_total", "Requests", ["type"]))
+    registry.register(Gauge("lag", "Lag", function=lambda: 0.25))
+    histogram = registry.register(
+        Histogram("latency_seconds", "Latency", ["type"], buckets=[0.1, 1])
+    )
+
+    counter.labels('say "hi"').inc()
+    counter.labels('say "hi"').inc(2)
+    text_latency = histogram.labels("text")
+    for value in [0.05, 0.1, 0.5, 3]:
+        text_latency.observe(value)
+
+    assert registry.render().splitlines() == [
+        "# HELP requests_total Requests",
+        "# TYPE requests_total counter",
+        'requests_total{type="say \\"hi\\""} 3',
+        "# HELP lag Lag",
+        "# TYPE lag gauge",
+        "lag 0.25",
+        "# HELP latency_seconds Latency",
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{type="text",le="0.1"} 2',
+        'latency_seconds_bucket{type="text",le="1"} 3',
+        'latency_seconds_bucket{type="text",le="+Inf"} 4',
+        'latency_seconds_sum{type="text"} 3.65',
+        'latency_seconds_count{type="text"} 4',
+    ]
+
+    with pytest.raises(ValueError):
+        counter.labels()
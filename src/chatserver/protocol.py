@@ -0,0 +1,170 @@
+import asyncio
+from typing import TYPE_CHECKING, Any, Optional, Set, Union
+
+from websockets import WebSocketServerProtocol
+from websockets.datastructures import Headers
+from websockets.exceptions import ConnectionClosed, ProtocolError
+from websockets.frames import OP_CONT, OP_TEXT, Frame
+from websockets.legacy.server import HTTPResponse
+from websockets.typing import Data
+
+from chatserver.admission_queue import AdmissionWaiter
+from chatserver.config import Config
+from chatserver.upload import SpooledBody, StreamedRequest
+from request import REQUEST_HEADER_SIZE
+
+if TYPE_CHECKING:
+    from chatserver.chat_bot import ChatBot
+
+
+class ChatBotServerProtocol(WebSocketServerProtocol):
+    """
+    Websocket protocol that lets the ChatBot validate and admit a client
+    during the HTTP handshake, before the connection is upgraded.
+
+    Binary messages are streamed: they are read as StreamedRequest whose body
+    is spooled fragment by fragment instead of being buffered until the
+    message is complete. A request rejected by the ChatBot as soon as its
+    header arrives is answered right away and its body is discarded
+    """
+
+    def __init__(
+        self,
+        *args: Any,
+        chatbot: "ChatBot",
+        max_frame_size: Optional[int] = None,
+        **kwargs: Any,
+    ) -> None:
+        super().__init__(*args, **kwargs)
+        self.chatbot = chatbot
+        # size of a fragment, max_size still limits the size of a whole message
+        self.max_frame_size = max_frame_size or Config.MAX_FRAME_SIZE
+        self.client_id: Optional[str] = None
+        self.time_zone: Optional[str] = None
+        self._background_tasks: Set[asyncio.Task] = set()
+        # True once a connection slot is held for this client
+        self.admitted = False
+        # place in the admission queue taken before the upgrade
+        self.admission_waiter: Optional[AdmissionWaiter] = None
+
+    async def process_request(
+        self, path: str, request_headers: Headers
+    ) -> Optional[HTTPResponse]:
+        return await self.chatbot.process_request(self, path, request_headers)
+
+    async def handshake(self, *args: Any, **kwargs: Any) -> str:
+        try:
+            return await super().handshake(*args, **kwargs)
+        except BaseException:
+            # the slot acquired in process_request would never be released
+            # because the connection handler does not run
+            if self.admitted:
+                self.admitted = False
+                await self.chatbot.concurrent_control.release_connection(
+                    self.client_id
+                )
+            if self.admission_waiter is not None:
+                self.chatbot.admission_queue.cancel(self.admission_waiter)
+                self.admission_waiter = None
+            raise
+
+    def _frame_limit(self, remaining: Optional[int]) -> int:
+        if remaining is None:
+            return self.max_frame_size
+        return min(self.max_frame_size, remaining)
+
+    async def _read_continuation(self, remaining: Optional[int]) -> Frame:
+        frame = await self.read_data_frame(max_size=self._frame_limit(remaining))
+        if frame is None:
+            raise ProtocolError("incomplete fragmented message")
+        if frame.opcode != OP_CONT:
+            raise ProtocolError("unexpected opcode")
+        return frame
+
+    async def read_message(self) -> Optional[Union[Data, StreamedRequest]]:
+        while True:
+            remaining = self.max_size
+            frame = await self.read_data_frame(max_size=self._frame_limit(remaining))
+
+            # A close frame was received.
+            if frame is None:
+                return None
+            if frame.opcode == OP_CONT:
+                raise ProtocolError("unexpected opcode")
+
+            if frame.opcode == OP_TEXT:
+                # text messages are only heartbeats, they are small
+                fragments = [frame.data]
+                while not frame.fin:
+                    if remaining is not None:
+                        remaining -= len(frame.data)
+                    frame = await self._read_continuation(remaining)
+                    fragments.append(frame.data)
+                return b"".join(fragments).decode("utf-8")
+
+            request = await self._read_request(frame, remaining)
+            if request is not None:
+                return request
+
+    async def _read_request(
+        self, frame: Frame, remaining: Optional[int]
+    ) -> Optional[StreamedRequest]:
+        """
+        Read the fragments of a request starting with frame,
+        return None if the request was rejected and its body discarded
+        """
+        header = bytearray()
+        body: Optional[SpooledBody] = SpooledBody(
+            self.chatbot.upload_budget, self.chatbot.upload_storage
+        )
+        try:
+            while True:
+                data = memoryview(frame.data)
+                if len(header) < REQUEST_HEADER_SIZE:
+                    missing = REQUEST_HEADER_SIZE - len(header)
+                    header += data[:missing]
+                    data = data[missing:]
+                    if len(header) == REQUEST_HEADER_SIZE and self.chatbot.reject_early(
+                        self, bytes(header)
+                    ):
+                        body.close()
+                        body = None
+                if data and body is not None:
+                    await body.write(data)
+                if frame.fin:
+                    break
+                if remaining is not None:
+                    remaining -= len(frame.data)
+                frame = await self._read_continuation(remaining)
+        except BaseException:
+            if body is not None:
+                body.close()
+            raise
+        if body is None:
+            return None
+        return StreamedRequest(bytes(header), body)
+
+    def send_in_background(self, message: Data) -> None:
+        """
+        Send a message without waiting, so reading is not blocked
+        by a client that does not read its responses
+        """
+
+        async def send() -> None:
+            try:
+                await self.send(message)
+            except ConnectionClosed:
+                pass
+
+        task = asyncio.create_task(send())
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+
+    def close_pending_requests(self) -> None:
+        """
+        Delete the bodies of the requests received but never handled
+        """
+        while self.messages:
+            message = self.messages.popleft()
+            if isinstance(message, StreamedRequest):
+                message.close()
@@ -0,0 +1,580 @@
+import asyncio
+import contextlib
+import logging
+import time
+from typing import Callable, Dict, List, Optional
+import redis.asyncio as redis
+from redis.asyncio.client import Pipeline
+from redis.commands.core import AsyncScript
+
+from chatserver.concurrency_control import AcquireResult, IConcurrencyControl
+from chatserver.config import Config
+
+logger = logging.getLogger("chatserver.concurrency_control")
+
+
+# Keys used by the scripts, all prefixed by the redis key:
+# {key}: hash of client_id -> number of connections on every node
+# {key}:total: total number of connections, kept in sync with the hash so
+#              admission never has to scan it
+# {key}:nodes: sorted set of node_id -> lease expiry time (ms, redis clock)
+# {key}:node:{node_id}: hash of client_id -> number of connections on that node
+# {key}:messages: number of in-flight message tokens leased by every node
+# {key}:message_leases: hash of node_id -> message tokens leased by that node
+# {key}:node_versions: hash of node_id -> number of changes of the connections
+#                      and message tokens of that node, so a node restores them
+#                      only if nothing changed since it compared them
+# {key}:released: pub/sub channel notified whenever connection slots are freed
+#
+# A node renews its lease in the background. When the lease of a node expires
+# (the node crashed), the next script run by any node subtracts the
+# connections and message tokens of the dead node from the shared counters.
+#
+# Only a single Redis server (or a primary with replicas) is supported: the
+# expired nodes are only known inside the scripts, so their {key}:node:{node_id}
+# hashes, like the {key}:messages, {key}:message_leases and {key}:node_versions
+# keys built by the helpers, are not declared in KEYS. Redis Cluster, and servers
+# enforcing script key checks, reject these scripts.
+LUA_HELPERS = """
+redis.replicate_commands()
+
+local function now_ms()
+    local time = redis.call('TIME')
+    return tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+end
+
+local function bump_node_version(key, node_id)
+    redis.call('HINCRBY', key .. ':node_versions', node_id, 1)
+end
+
+local function remove_node_connections(key, total_key, node_key)
+    local node_connections = redis.call('HGETALL', node_key)
+    local removed = 0
+    for i = 1, #node_connections, 2 do
+        local client_id = node_connections[i]
+        local count = tonumber(node_connections[i + 1])
+        if tonumber(redis.call('HINCRBY', key, client_id, -count)) <= 0 then
+            redis.call('HDEL', key, client_id)
+        end
+        removed = removed + count
+    end
+    redis.call('DEL', node_key)
+    if removed > 0 then
+        if tonumber(redis.call('DECRBY', total_key, removed)) < 0 then
+            redis.call('SET', total_key, 0)
+        end
+        redis.call('PUBLISH', key .. ':released', removed)
+    end
+end
+
+local function remove_node_message_tokens(key, node_id)
+    local message_leases_key = key .. ':message_leases'
+    local tokens = tonumber(redis.call('HGET', message_leases_key, node_id) or '0')
+    redis.call('HDEL', message_leases_key, node_id)
+    if tokens > 0 and tonumber(redis.call('DECRBY', key .. ':messages', tokens)) < 0 then
+        redis.call('SET', key .. ':messages', 0)
+    end
+end
+
+local function reap_expired_nodes(key, total_key, nodes_key, node_key_prefix, now)
+    local expired = redis.call('ZRANGEBYSCORE', nodes_key, '-inf', now, 'LIMIT', 0, 16)
+    for _, node_id in ipairs(expired) do
+        remove_node_connections(key, total_key, node_key_prefix .. node_id)
+        remove_node_message_tokens(key, node_id)
+        redis.call('ZREM', nodes_key, node_id)
+        bump_node_version(key, node_id)
+    end
+end
+"""
+
+# KEYS: key, total_key, nodes_key, node_key
+# ARGV: client_id, max_connections, max_connection_per_client,
+#       node_id, lease_ttl_ms, node_key_prefix
+ACQUIRE_CONNECTION_SCRIPT = LUA_HELPERS + """
+local key = KEYS[1]
+local total_key = KEYS[2]
+local nodes_key = KEYS[3]
+local node_key = KEYS[4]
+local client_id = ARGV[1]
+local max_connections = tonumber(ARGV[2])
+local max_connection_per_client = tonumber(ARGV[3])
+local node_id = ARGV[4]
+local lease_ttl = tonumber(ARGV[5])
+local node_key_prefix = ARGV[6]
+
+local now = now_ms()
+reap_expired_nodes(key, total_key, nodes_key, node_key_prefix, now)
+
+-- 0: the server is full, -1: the client is at its limit, 1: acquired
+local total_connections = tonumber(redis.call('GET', total_key) or '0')
+if total_connections >= max_connections then
+    return 0
+end
+
+local client_connections = tonumber(redis.call('HGET', key, client_id) or '0')
+if client_connections >= max_connection_per_client then
+    return -1
+end
+
+redis.call('HINCRBY', key, client_id, 1)
+redis.call('INCR', total_key)
+redis.call('HINCRBY', node_key, client_id, 1)
+redis.call('ZADD', nodes_key, now + lease_ttl, node_id)
+bump_node_version(key, node_id)
+return 1
+"""
+
+# KEYS: key, total_key, node_key
+# ARGV: client_id, node_id
+RELEASE_CONNECTION_SCRIPT = """
+local key = KEYS[1]
+local total_key = KEYS[2]
+local node_key = KEYS[3]
+local client_id = ARGV[1]
+local node_id = ARGV[2]
+
+-- the connection may already be gone if the lease of this node expired
+local node_connections = tonumber(redis.call('HGET', node_key, client_id) or '0')
+if node_connections <= 0 then
+    return 0
+end
+
+if node_connections == 1 then
+    redis.call('HDEL', node_key, client_id)
+else
+    redis.call('HINCRBY', node_key, client_id, -1)
+end
+if tonumber(redis.call('HINCRBY', key, client_id, -1)) <= 0 then
+    redis.call('HDEL', key, client_id)
+end
+if tonumber(redis.call('DECR', total_key)) < 0 then
+    redis.call('SET', total_key, 0)
+end
+redis.call('HINCRBY', key .. ':node_versions', node_id, 1)
+redis.call('PUBLISH', key .. ':released', 1)
+return 1
+"""
+
+# Renew the lease of a node and reclaim the connections of dead nodes.
+# Return the number of connections and message tokens redis holds for this node,
+# and its version, so the caller can detect that its lease expired and was
+# reaped while it was still alive.
+# KEYS: key, total_key, nodes_key, node_key
+# ARGV: node_id, lease_ttl_ms, node_key_prefix
+RENEW_LEASE_SCRIPT = LUA_HELPERS + """
+local key = KEYS[1]
+local total_key = KEYS[2]
+local nodes_key = KEYS[3]
+local node_key = KEYS[4]
+local node_id = ARGV[1]
+local lease_ttl = tonumber(ARGV[2])
+local node_key_prefix = ARGV[3]
+
+local now = now_ms()
+reap_expired_nodes(key, total_key, nodes_key, node_key_prefix, now)
+redis.call('ZADD', nodes_key, now + lease_ttl, node_id)
+
+local node_total = 0
+for _, count in ipairs(redis.call('HVALS', node_key)) do
+    node_total = node_total + tonumber(count)
+end
+local node_tokens = tonumber(redis.call('HGET', key .. ':message_leases', node_id) or '0')
+local version = tonumber(redis.call('HGET', key .. ':node_versions', node_id) or '0')
+return {node_total, node_tokens, version}
+"""
+
+# Replace the connections and message tokens redis holds for a node by the given ones,
+# unless the version of the node is no longer the expected one (-1 to always replace).
+# Return the number of connections put back, -1 if nothing was replaced.
+# KEYS: key, total_key, nodes_key, node_key
+# ARGV: node_id, lease_ttl_ms, expected_version, message_tokens,
+#       client_id_1, count_1, client_id_2, count_2...
+SYNC_NODE_SCRIPT = LUA_HELPERS + """
+local key = KEYS[1]
+local total_key = KEYS[2]
+local nodes_key = KEYS[3]
+local node_key = KEYS[4]
+local node_id = ARGV[1]
+local lease_ttl = tonumber(ARGV[2])
+local expected_version = tonumber(ARGV[3])
+local message_tokens = tonumber(ARGV[4])
+
+-- a connection or token acquired or released since the caller compared them
+local version = tonumber(redis.call('HGET', key .. ':node_versions', node_id) or '0')
+if expected_version >= 0 and version ~= expected_version then
+    return -1
+end
+bump_node_version(key, node_id)
+
+remove_node_connections(key, total_key, node_key)
+remove_node_message_tokens(key, node_id)
+
+if message_tokens > 0 then
+    redis.call('HSET', key .. ':message_leases', node_id, message_tokens)
+    redis.call('INCRBY', key .. ':messages', message_tokens)
+end
+
+local added = 0
+for i = 5, #ARGV, 2 do
+    local client_id = ARGV[i]
+    local count = tonumber(ARGV[i + 1])
+    redis.call('HINCRBY', node_key, client_id, count)
+    redis.call('HINCRBY', key, client_id, count)
+    added = added + count
+end
+if added > 0 then
+    redis.call('INCRBY', total_key, added)
+end
+if added > 0 or message_tokens > 0 then
+    redis.call('ZADD', nodes_key, now_ms() + lease_ttl, node_id)
+else
+    redis.call('ZREM', nodes_key, node_id)
+end
+return added
+"""
+
+# Lease up to `count` message tokens for a node, return the number granted.
+# KEYS: key, total_key, nodes_key
+# ARGV: count, max_messages, node_id, lease_ttl_ms, node_key_prefix
+LEASE_MESSAGE_TOKENS_SCRIPT = LUA_HELPERS + """
+local key = KEYS[1]
+local total_key = KEYS[2]
+local nodes_key = KEYS[3]
+local count = tonumber(ARGV[1])
+local max_messages = tonumber(ARGV[2])
+local node_id = ARGV[3]
+local lease_ttl = tonumber(ARGV[4])
+local node_key_prefix = ARGV[5]
+
+local now = now_ms()
+reap_expired_nodes(key, total_key, nodes_key, node_key_prefix, now)
+
+local leased = tonumber(redis.call('GET', key .. ':messages') or '0')
+local granted = math.min(count, max_messages - leased)
+if granted <= 0 then
+    return 0
+end
+
+redis.call('INCRBY', key .. ':messages', granted)
+redis.call('HINCRBY', key .. ':message_leases', node_id, granted)
+redis.call('ZADD', nodes_key, now + lease_ttl, node_id)
+bump_node_version(key, node_id)
+return granted
+"""
+
+# Give back message tokens leased by a node.
+# KEYS: key
+# ARGV: count, node_id
+RETURN_MESSAGE_TOKENS_SCRIPT = """
+local key = KEYS[1]
+local count = tonumber(ARGV[1])
+local node_id = ARGV[2]
+
+-- the tokens may already be gone if the lease of this node expired
+local leased = tonumber(redis.call('HGET', key .. ':message_leases', node_id) or '0')
+count = math.min(count, leased)
+if count <= 0 then
+    return 0
+end
+
+if count == leased then
+    redis.call('HDEL', key .. ':message_leases', node_id)
+else
+    redis.call('HINCRBY', key .. ':message_leases', node_id, -count)
+end
+if tonumber(redis.call('DECRBY', key .. ':messages', count)) < 0 then
+    redis.call('SET', key .. ':messages', 0)
+end
+redis.call('HINCRBY', key .. ':node_versions', node_id, 1)
+return count
+"""
+
+
+class RedisConcurrencyControl(IConcurrencyControl):
+    """
+    Connection and message counters shared by every server node through redis
+
+    Each node holds its connections under a lease renewed every lease_ttl / 3
+    seconds, so the slots of a crashed node are reclaimed after lease_ttl seconds.
+    Acquiring and releasing a connection still costs one round trip each.
+    The scripts need a single Redis server, Redis Cluster is not supported
+    """
+
+    def __init__(
+        self,
+        max_connections: int,
+        max_connection_per_client: int,
+        redis_key: Optional[str] = None,
+        node_id: Optional[str] = None,
+        lease_ttl: Optional[float] = None,
+        max_messages: Optional[int] = None,
+    ) -> None:
+        self.redis_client = redis.StrictRedis(host=Config.REDIS_HOST, port=Config.REDIS_PORT, db=0)
+        self.redis_key = redis_key if redis_key else "concurrency_control"
+        self.total_key = f"{self.redis_key}:total"
+        self.nodes_key = f"{self.redis_key}:nodes"
+        self.node_key_prefix = f"{self.redis_key}:node:"
+        self.node_id = node_id or Config.NODE_ID
+        self.node_key = f"{self.node_key_prefix}{self.node_id}"
+        self.lease_ttl = lease_ttl or Config.CONNECTION_LEASE_TTL
+        self.max_connections = max_connections
+        self.max_connections_per_client = max_connection_per_client
+        self.max_messages = max_messages or Config.MAX_MESSAGES
+        self.messages_key = f"{self.redis_key}:messages"
+        self.message_leases_key = f"{self.redis_key}:message_leases"
+        self.node_versions_key = f"{self.redis_key}:node_versions"
+        # connections and message tokens held by this node,
+        # used to restore them if our lease expired
+        self.node_connections: Dict[str, int] = {}
+        self.node_message_tokens = 0
+        # changes of the node started, and not yet applied to the counts above
+        self._node_changes = 0
+        self._node_changes_in_flight = 0
+        self.released_channel = f"{self.redis_key}:released"
+        self.release_listeners: List[Callable[[], None]] = []
+        self._renew_task: Optional[asyncio.Task] = None
+        self._release_subscriber_task: Optional[asyncio.Task] = None
+        # Scripts are registered once, later calls go through EVALSHA with the cached SHA
+        self._acquire_script = self.redis_client.register_script(
+            ACQUIRE_CONNECTION_SCRIPT
+        )
+        self._release_script = self.redis_client.register_script(
+            RELEASE_CONNECTION_SCRIPT
+        )
+        self._renew_script = self.redis_client.register_script(RENEW_LEASE_SCRIPT)
+        self._sync_node_script = self.redis_client.register_script(SYNC_NODE_SCRIPT)
+        self._lease_message_tokens_script = self.redis_client.register_script(
+            LEASE_MESSAGE_TOKENS_SCRIPT
+        )
+        self._return_message_tokens_script = self.redis_client.register_script(
+            RETURN_MESSAGE_TOKENS_SCRIPT
+        )
+
+    @property
+    def _lease_ttl_ms(self) -> int:
+        return int(self.lease_ttl * 1000)
+
+    async def _run_script(
+        self, operation: str, script: AsyncScript, keys: List[str], args: list
+    ):
+        start = time.perf_counter()
+        try:
+            return await script(keys=keys, args=args)
+        finally:
+            if self.round_trip_listener is not None:
+                self.round_trip_listener(operation, time.perf_counter() - start)
+
+    async def _get_hash_map(self, pipe: Optional[Pipeline] = None) -> dict:
+        client = pipe if pipe else self.redis_client
+        hash_map = await client.hgetall(self.redis_key)
+        return {
+            key.decode("utf-8"): value.decode("utf-8")
+            for key, value in hash_map.items()
+        }
+
+    async def get_connections(self) -> Dict[str, int]:
+        hash_map = await self._get_hash_map()
+        return {client_id: int(count) for client_id, count in hash_map.items()}
+
+    async def get_total_connections(self) -> int:
+        total = await self.redis_client.get(self.total_key)
+        return int(total) if total else 0
+
+    @contextlib.contextmanager
+    def _changing_node(self):
+        # renew_lease does not compare the counts while they change
+        self._node_changes += 1
+        self._node_changes_in_flight += 1
+        try:
+            yield
+        finally:
+            self._node_changes_in_flight -= 1
+
+    async def try_acquire_connection(self, client_id: str) -> AcquireResult:
+        with self._changing_node():
+            result = await self._run_script(
+                "acquire_connection",
+                self._acquire_script,
+                keys=[self.redis_key, self.total_key, self.nodes_key, self.node_key],
+                args=[
+                    client_id,
+                    self.max_connections,
+                    self.max_connections_per_client,
+                    self.node_id,
+                    self._lease_ttl_ms,
+                    self.node_key_prefix,
+                ],
+            )
+            result = AcquireResult(int(result))
+            if result == AcquireResult.ACQUIRED:
+                self.node_connections[client_id] = (
+                    self.node_connections.get(client_id, 0) + 1
+                )
+        return result
+
+    async def release_connection(self, client_id: str) -> None:
+        logger.debug("Released connection", extra={"client_id": client_id})
+        with self._changing_node():
+            client_connections = self.node_connections.get(client_id, 0)
+            if client_connections <= 1:
+                self.node_connections.pop(client_id, None)
+            else:
+                self.node_connections[client_id] = client_connections - 1
+            await self._run_script(
+                "release_connection",
+                self._release_script,
+                keys=[self.redis_key, self.total_key, self.node_key],
+                args=[client_id, self.node_id],
+            )
+
+    def add_release_listener(self, listener: Callable[[], None]) -> None:
+        self.release_listeners.append(listener)
+
+    async def _listen_for_releases(self) -> None:
+        while True:
+            pubsub = self.redis_client.pubsub()
+            try:
+                await pubsub.subscribe(self.released_channel)
+                # releases published while we were not subscribed are lost
+                self._notify_release()
+                async for message in pubsub.listen():
+                    if message["type"] == "message":
+                        self._notify_release()
+            except redis.RedisError as e:
+                logger.warning(
+                    "Release subscription of node %s failed: %s", self.node_id, e
+                )
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
+
+    def _notify_release(self) -> None:
+        for listener in self.release_listeners:
+            listener()
+
+    async def renew_lease(self) -> None:
+        """
+        Renew the lease of this node in one round trip, and put back its
+        connections if the lease expired in the meantime.
+        The counts are only compared when no change of the node was in flight
+        during the renewal, and only put back if the node did not change since
+        """
+        changes = self._node_changes
+        changing = self._node_changes_in_flight
+        node_total, node_tokens, version = await self._run_script(
+            "renew_lease",
+            self._renew_script,
+            keys=[self.redis_key, self.total_key, self.nodes_key, self.node_key],
+            args=[self.node_id, self._lease_ttl_ms, self.node_key_prefix],
+        )
+        if changing or self._node_changes != changes:
+            # compared at the next renewal
+            return
+        if (
+            int(node_total) != sum(self.node_connections.values())
+            or int(node_tokens) != self.node_message_tokens
+        ):
+            logger.warning("Lease of node %s is out of sync, restoring it", self.node_id)
+            await self._sync_node(
+                dict(self.node_connections), self.node_message_tokens, int(version)
+            )
+
+    async def _sync_node(
+        self, connections: Dict[str, int], message_tokens: int, version: int = -1
+    ) -> None:
+        args = [self.node_id, self._lease_ttl_ms, version, message_tokens]
+        for client_id, count in connections.items():
+            args.extend([client_id, count])
+        await self._run_script(
+            "sync_node",
+            self._sync_node_script,
+            keys=[self.redis_key, self.total_key, self.nodes_key, self.node_key],
+            args=args,
+        )
+
+    async def _renew_lease_forever(self) -> None:
+        while True:
+            await asyncio.sleep(self.lease_ttl / 3)
+            try:
+                await self.renew_lease()
+            except redis.RedisError as e:
+                logger.error("Can not renew lease of node %s: %s", self.node_id, e)
+
+    async def start(self) -> None:
+        if self._renew_task is None:
+            self._renew_task = asyncio.create_task(self._renew_lease_forever())
+        if self._release_subscriber_task is None:
+            self._release_subscriber_task = asyncio.create_task(
+                self._listen_for_releases()
+            )
+
+    async def stop(self) -> None:
+        tasks = [
+            task
+            for task in [self._renew_task, self._release_subscriber_task]
+            if task is not None
+        ]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._renew_task = None
+        self._release_subscriber_task = None
+        await self.clean_node_sessions()
+        # close the connections while the event loop is running
+        await self.redis_client.aclose()
+
+    async def lease_message_tokens(self, count: int) -> int:
+        with self._changing_node():
+            granted = await self._run_script(
+                "lease_message_tokens",
+                self._lease_message_tokens_script,
+                keys=[self.redis_key, self.total_key, self.nodes_key],
+                args=[
+                    count,
+                    self.max_messages,
+                    self.node_id,
+                    self._lease_ttl_ms,
+                    self.node_key_prefix,
+                ],
+            )
+            self.node_message_tokens += int(granted)
+        return int(granted)
+
+    async def return_message_tokens(self, count: int) -> None:
+        count = min(count, self.node_message_tokens)
+        if count <= 0:
+            return
+        with self._changing_node():
+            self.node_message_tokens -= count
+            await self._run_script(
+                "return_message_tokens",
+                self._return_message_tokens_script,
+                keys=[self.redis_key], args=[count, self.node_id]
+            )
+
+    async def get_leased_message_tokens(self) -> int:
+        leased = await self.redis_client.get(self.messages_key)
+        return int(leased) if leased else 0
+
+    async def clean_node_sessions(self) -> None:
+        self.node_connections.clear()
+        self.node_message_tokens = 0
+        await self._sync_node({}, 0)
+
+    async def clean_all_sessions(self) -> None:
+        self.node_connections.clear()
+        self.node_message_tokens = 0
+        node_ids = await self.redis_client.zrange(self.nodes_key, 0, -1)
+        node_keys = [
+            f"{self.node_key_prefix}{node_id.decode('utf-8')}" for node_id in node_ids
+        ]
+        await self.redis_client.delete(
+            self.redis_key,
+            self.total_key,
+            self.nodes_key,
+            self.node_key,
+            self.messages_key,
+            self.message_leases_key,
+            self.node_versions_key,
+            *node_keys,
+        )
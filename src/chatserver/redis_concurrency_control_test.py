@@ -0,0 +1,99 @@
+import asyncio
+
+import pytest
+
+from chatserver.redis_concurrency_control import RedisConcurrencyControl
+
+REDIS_KEY = "redis_concurrency_control_test"
+
+
+def new_node(node_id: str, lease_ttl: float = 10) -> RedisConcurrencyControl:
+    return RedisConcurrencyControl(
+        max_connections=2,
+        max_connection_per_client=1,
+        redis_key=REDIS_KEY,
+        node_id=node_id,
+        lease_ttl=lease_ttl,
+    )
+
+
+@pytest.mark.asyncio
+async def test_dead_node_connections_are_reclaimed():
+    dead_node = new_node("dead", lease_ttl=0.2)
+    alive_node = new_node("alive")
+    await alive_node.clean_all_sessions()
+
+    assert await dead_node.acquire_connection("1")
+    assert await dead_node.acquire_connection("2")
+    assert not await alive_node.acquire_connection("3")
+
+    # the dead node never renews its lease
+    await asyncio.sleep(0.3)
+    assert await alive_node.acquire_connection("3")
+    assert await alive_node.get_connections() == {"3": 1}
+    assert await alive_node.get_total_connections() == 1
+
+    # releasing a reaped connection must not free capacity twice
+    await dead_node.release_connection("1")
+    assert await alive_node.get_total_connections() == 1
+
+    await alive_node.clean_all_sessions()
+
+
+@pytest.mark.asyncio
+async def test_clean_node_sessions_keeps_other_nodes():
+    node_1 = new_node("node-1")
+    node_2 = new_node("node-2")
+    await node_1.clean_all_sessions()
+
+    assert await node_1.acquire_connection("1")
+    assert await node_2.acquire_connection("2")
+
+    # node 1 restarts
+    await node_1.clean_node_sessions()
+    assert await node_2.get_connections() == {"2": 1}
+    assert await node_2.get_total_connections() == 1
+
+    await node_1.clean_all_sessions()
+
+
+@pytest.mark.asyncio
+async def test_renew_lease_restores_expired_node():
+    node = new_node("node", lease_ttl=0.2)
+    other_node = new_node("other")
+    await node.clean_all_sessions()
+
+    assert await node.acquire_connection("1")
+    await asyncio.sleep(0.3)
+    await other_node.renew_lease()
+    assert await other_node.get_total_connections() == 0
+
+    # the node was only slow, its connection is still open
+    await node.renew_lease()
+    assert await other_node.get_connections() == {"1": 1}
+    assert await other_node.get_total_connections() == 1
+
+    await node.clean_all_sessions()
+
+
+@pytest.mark.asyncio
+async def test_renew_lease_keeps_changes_in_flight():
+    node = new_node("node")
+    await node.clean_all_sessions()
+    assert await node.acquire_connection("1")
+
+    # redis applied an acquire of the node whose reply is not processed yet
+    with node._changing_node():
+        node.node_connections.pop("1")
+        await node.renew_lease()
+        node.node_connections["1"] = 1
+    assert await node.get_connections() == {"1": 1}
+
+    # a connection acquired after the counts were compared is not dropped
+    version = int(await node.redis_client.hget(node.node_versions_key, "node"))
+    assert await node.acquire_connection("2")
+    await node._sync_node({"1": 1}, 0, version)
+    assert await node.get_connections() == {"1": 1, "2": 1}
+    assert await node.get_total_connections() == 2
+
+    await node.clean_all_sessions()
@@ -0,0 +1,101 @@
+import dataclasses
+from dataclasses import dataclass, field
+import mmap
+from typing import Dict, List, Optional
+import uuid
+
+from chatserver.config import Config
+from response import ResponsePayload, ResponseType
+from utils import Buffer, get_sample_file_path, get_sample_text
+
+
+@dataclass
+class PreEncodedResponsePayload(ResponsePayload):
+    """
+    ResponsePayload whose type, sizes and body were encoded once,
+    encoding it only writes the message_id in front
+    """
+
+    # encoded response without the message_id
+    encoded: List[Buffer] = field(default_factory=list)
+
+    def encode_buffers(self) -> List[Buffer]:
+        return [self.message_id.bytes + self.encoded[0], *self.encoded[1:]]
+
+
+class ResponseAssetCache:
+    """
+    Sample media of the responses, loaded once at startup.
+
+    The encoded body of every response type is built once. With use_mmap the
+    media files are memory-mapped and sent from the mapping instead of being
+    copied into the process memory
+    """
+
+    def __init__(self, use_mmap: Optional[bool] = None) -> None:
+        self.use_mmap = Config.RESPONSE_ASSETS_MMAP if use_mmap is None else use_mmap
+        self._mmaps: List[mmap.mmap] = []
+        self.text = get_sample_text()
+        self.audio = self._load("sample.mp3")
+        self.image = self._load("sample.jpg")
+        self.templates: Dict[int, PreEncodedResponsePayload] = {
+            type: self._build_template(type)
+            for type in [
+                ResponseType.TEXT,
+                ResponseType.TEXT_AUDIO,
+                ResponseType.TEXT_AUDIO_IMAGE,
+            ]
+        }
+
+    def _load(self, file_name: str) -> Buffer:
+        with open(get_sample_file_path(file_name), "rb") as f:
+            if not self.use_mmap:
+                return f.read()
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._mmaps.append(mapping)
+            return memoryview(mapping)
+
+    def _build_template(self, type: int) -> PreEncodedResponsePayload:
+        audio = None if type == ResponseType.TEXT else self.audio
+        image = self.image if type == ResponseType.TEXT_AUDIO_IMAGE else None
+        text_bytes = self.text.encode("utf-8")
+        audio_bytes_len = len(audio) if audio is not None else 0
+
+        header = b"".join(
+            [
+                type.to_bytes(1, byteorder="big"),
+                len(text_bytes).to_bytes(4, byteorder="big"),
+                audio_bytes_len.to_bytes(4, byteorder="big"),
+            ]
+        )
+        media = [buffer for buffer in [audio, image] if buffer is not None]
+        if self.use_mmap:
+            encoded = [header + text_bytes, *media]
+        else:
+            encoded = [header, b"".join([text_bytes, *media])]
+
+        return PreEncodedResponsePayload(
+            message_id=uuid.UUID(int=0),
+            type=type,
+            text=self.text,
+            audio=audio,
+            image=image,
+            error_message=None,
+            encoded=encoded,
+        )
+
+    def get_response_payload(
+        self, type: int, message_id: uuid.UUID
+    ) -> PreEncodedResponsePayload:
+        """
+        Sample response of the given type answering the request message_id
+        """
+        return dataclasses.replace(self.templates[type], message_id=message_id)
+
+    def close(self) -> None:
+        self.templates.clear()
+        self.audio = None
+        self.image = None
+        for mapping in self._mmaps:
+            mapping.close()
+        self._mmaps.clear()
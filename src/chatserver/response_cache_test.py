@@ -0,0 +1,31 @@
+import uuid
+
+import pytest
+
+from chatserver.response_cache import ResponseAssetCache
+from response import ResponsePayload, ResponseType, get_sample_response_payload
+
+
+@pytest.mark.parametrize("use_mmap", [False, True])
+@pytest.mark.parametrize(
+    "type",
+    [ResponseType.TEXT, ResponseType.TEXT_AUDIO, ResponseType.TEXT_AUDIO_IMAGE],
+)
+def test_pre_encoded_response(use_mmap, type) -> None:
+    cache = ResponseAssetCache(use_mmap=use_mmap)
+    message_id = uuid.uuid4()
+
+    resp = cache.get_response_payload(type, message_id)
+    expected = get_sample_response_payload(type, message_id)
+
+    encoded_resp = b"".join(resp.encode_buffers())
+    assert encoded_resp == expected.encode()
+
+    decoded_resp = ResponsePayload.decode(encoded_resp)
+    assert decoded_resp.message_id == message_id
+    assert decoded_resp.text == expected.text
+    assert decoded_resp.audio == expected.audio
+    assert decoded_resp.image == expected.image
+
+    del resp
+    cache.close()
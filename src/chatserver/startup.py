@@ -0,0 +1,31 @@
+import logging
+import time
+from typing import Optional
+
+logger = logging.getLogger("chatserver.startup")
+
+
+class StartupTimer:
+    """
+    Measure how long the server takes from started_at to listen and to
+    accept its first connection
+    """
+
+    def __init__(self, started_at: Optional[float] = None) -> None:
+        self.started_at = time.perf_counter() if started_at is None else started_at
+        # seconds after started_at, None until it happens
+        self.listening_after: Optional[float] = None
+        self.first_connection_after: Optional[float] = None
+
+    def listening(self) -> None:
+        self.listening_after = time.perf_counter() - self.started_at
+        logger.info("Listening %.1f ms after start", self.listening_after * 1000)
+
+    def connection_accepted(self) -> None:
+        if self.first_connection_after is not None:
+            return
+        self.first_connection_after = time.perf_counter() - self.started_at
+        logger.info(
+            "Time to first accepted connection: %.1f ms",
+            self.first_connection_after * 1000,
+        )
@@ -0,0 +1,113 @@
+import multiprocessing
+from multiprocessing.connection import wait
+import signal
+import time
+from typing import Callable, Dict, Optional
+
+
+class WorkerSupervisor:
+    """
+    Run target(worker_id) in worker processes and restart the ones that die.
+
+    A worker that dies soon after being started is restarted after a delay
+    doubling up to max_restart_delay, so a crashing worker does not spin
+    """
+
+    def __init__(
+        self,
+        workers: int,
+        target: Callable[[int], None],
+        restart_delay: float = 1,
+        max_restart_delay: float = 30,
+        stable_after: float = 10,
+    ) -> None:
+        self.workers = workers
+        self.target = target
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        # a worker running for stable_after seconds is restarted without delay
+        self.stable_after = stable_after
+        self.processes: Dict[int, multiprocessing.Process] = {}
+        self._started_at: Dict[int, float] = {}
+        self._delays: Dict[int, float] = {}
+        # worker_id -> time at which the worker is restarted
+        self._restarts: Dict[int, float] = {}
+        self._stopping = False
+
+    def _start_worker(self, worker_id: int) -> None:
+        process = multiprocessing.Process(
+            target=self._run_worker, args=(worker_id,), name=f"worker-{worker_id}"
+        )
+        process.start()
+        self.processes[worker_id] = process
+        self._started_at[worker_id] = time.monotonic()
+        print(f"Started worker {worker_id} (pid {process.pid})")
+
+    def _run_worker(self, worker_id: int) -> None:
+        # Ctrl+C reaches the whole process group, the supervisor stops the workers
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        self.target(worker_id)
+
+    def _on_worker_exit(self, worker_id: int) -> None:
+        process = self.processes.pop(worker_id)
+        if self._stopping:
+            return
+        now = time.monotonic()
+        if now - self._started_at[worker_id] >= self.stable_after:
+            delay = 0.0
+        else:
+            delay = max(self._delays.get(worker_id, 0) * 2, self.restart_delay)
+            delay = min(delay, self.max_restart_delay)
+        self._delays[worker_id] = delay
+        print(
+            f"Worker {worker_id} (pid {process.pid}) exited with code "
+            f"{process.exitcode}, restarting in {delay:.1f}s"
+        )
+        self._restarts[worker_id] = now + delay
+
+    def stop(self, *args) -> None:
+        self._stopping = True
+
+    def run(self) -> None:
+        """
+        Start the workers and supervise them until SIGINT or SIGTERM
+        """
+        previous_handlers = {
+            signum: signal.signal(signum, self.stop)
+            for signum in (signal.SIGTERM, signal.SIGINT)
+        }
+        for worker_id in range(self.workers):
+            self._start_worker(worker_id)
+
+        try:
+            while not self._stopping:
+                timeout: Optional[float] = 1
+                if self._restarts:
+                    timeout = max(0, min(self._restarts.values()) - time.monotonic())
+                    timeout = min(timeout, 1)
+                sentinels = {p.sentinel: i for i, p in self.processes.items()}
+                for sentinel in wait(list(sentinels), timeout):
+                    self.processes[sentinels[sentinel]].join()
+                    self._on_worker_exit(sentinels[sentinel])
+                now = time.monotonic()
+                for worker_id, restart_at in list(self._restarts.items()):
+                    if restart_at <= now and not self._stopping:
+                        del self._restarts[worker_id]
+                        self._start_worker(worker_id)
+        finally:
+            self._stop_workers()
+            for signum, handler in previous_handlers.items():
+                signal.signal(signum, handler)
+
+    def _stop_workers(self, timeout: float = 10) -> None:
+        print("Stopping workers")
+        for process in self.processes.values():
+            if process.is_alive():
+                process.terminate()
+        deadline = time.monotonic() + timeout
+        for process in self.processes.values():
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                process.kill()
+                process.join()
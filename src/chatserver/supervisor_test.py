@@ -0,0 +1,31 @@
+import os
+import threading
+import time
+
+from chatserver.supervisor import WorkerSupervisor
+
+
+def crashing_worker(path: str, worker_id: int) -> None:
+    with open(os.path.join(path, f"{worker_id}-{os.getpid()}"), "w"):
+        pass
+    os._exit(1)
+
+
+def test_dead_workers_are_restarted(tmp_path) -> None:
+    supervisor = WorkerSupervisor(
+        2,
+        lambda worker_id: crashing_worker(str(tmp_path), worker_id),
+        restart_delay=0.1,
+        max_restart_delay=0.2,
+    )
+    threading.Timer(1.5, supervisor.stop).start()
+
+    start = time.monotonic()
+    supervisor.run()
+
+    assert time.monotonic() - start < 5
+    starts = os.listdir(tmp_path)
+    for worker_id in range(2):
+        # restarted with a delay of 0.1, 0.2, 0.2... seconds
+        assert 3 <= sum(name.startswith(f"{worker_id}-") for name in starts) <= 9
+    assert not any(process.is_alive() for process in supervisor.processes.values())
@@ -0,0 +1,135 @@
+import asyncio
+import mmap
+import os
+from typing import Optional
+import uuid
+
+from chatserver.config import Config
+from file_storage import FileStorage, LocalFileStorage
+from request import RequestPayload
+from utils import Buffer
+
+
+class UploadMemoryBudget:
+    """
+    Bytes of request bodies the server keeps in memory, shared by all the
+    connections. A body that does not fit is written to disk instead
+    """
+
+    def __init__(self, max_bytes: Optional[int] = None) -> None:
+        self.max_bytes = (
+            Config.UPLOAD_MEMORY_BUDGET if max_bytes is None else max_bytes
+        )
+        self.used = 0
+
+    def try_reserve(self, size: int) -> bool:
+        if self.used + size > self.max_bytes:
+            return False
+        self.used += size
+        return True
+
+    def release(self, size: int) -> None:
+        self.used -= size
+
+
+def create_spool_storage() -> FileStorage:
+    """
+    Storage of the request bodies written to disk, it must be local because
+    the files are memory-mapped to read them
+    """
+    os.makedirs(Config.UPLOAD_SPOOL_DIR, exist_ok=True)
+    return LocalFileStorage(Config.UPLOAD_SPOOL_DIR)
+
+
+class SpooledBody:
+    """
+    Body of a request received in fragments.
+
+    The body stays in memory while the memory budget allows it, the first
+    fragment that does not fit moves it to a file of the spool storage.
+    Once finished, the body is read through a memoryview of the memory
+    buffer or of the memory-mapped file, without copying it
+    """
+
+    def __init__(self, budget: UploadMemoryBudget, storage: FileStorage) -> None:
+        self.budget = budget
+        self.storage = storage
+        self.size = 0
+        self._buffer: Optional[bytearray] = bytearray()
+        self._reserved = 0
+        self._file_name: Optional[str] = None
+        self._file = None
+        self._mmap: Optional[mmap.mmap] = None
+
+    @property
+    def in_memory(self) -> bool:
+        return self._file_name is None
+
+    async def write(self, data: Buffer) -> None:
+        self.size += len(data)
+        if self.in_memory:
+            if self.budget.try_reserve(len(data)):
+                self._reserved += len(data)
+                self._buffer.extend(data)
+                return
+            await self._spill()
+        await asyncio.to_thread(self._file.write, data)
+
+    async def _spill(self) -> None:
+        self._file_name = f"{uuid.uuid4().hex}.part"
+        self._file = self.storage.open_file(self._file_name, "w+b")
+        buffer, self._buffer = self._buffer, None
+        self.budget.release(self._reserved)
+        self._reserved = 0
+        await asyncio.to_thread(self._file.write, buffer)
+
+    def getbuffer(self) -> memoryview:
+        """
+        Memoryview of the whole body, call it once every fragment is written
+        """
+        if self.in_memory:
+            return memoryview(self._buffer)
+        if self.size == 0:
+            return memoryview(b"")
+        self._file.flush()
+        if self._mmap is None:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(self._mmap)
+
+    def close(self) -> None:
+        """
+        Give the memory back to the budget and delete the spooled file
+        """
+        self.budget.release(self._reserved)
+        self._reserved = 0
+        self._buffer = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self.storage.delete_file(self._file_name)
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # the request still has views of the body,
+                # the mapping is closed when they are garbage collected
+                pass
+            self._mmap = None
+
+
+class StreamedRequest:
+    """
+    Request read from a fragmented websocket message: the header of the
+    payload and its spooled body
+    """
+
+    def __init__(self, header: bytes, body: SpooledBody) -> None:
+        self.header = header
+        self.body = body
+
+    def decode(self) -> RequestPayload:
+        return RequestPayload.decode_parts(self.header, self.body.getbuffer())
+
+    def close(self) -> None:
+        self.body.close()
+
@@ -0,0 +1,68 @@
+import os
+
+import pytest
+
+from chatserver.upload import SpooledBody, StreamedRequest, UploadMemoryBudget
+from file_storage import LocalFileStorage
+from request import RequestType, get_sample_request_payload
+
+
+@pytest.mark.asyncio
+async def test_body_in_memory(tmp_path):
+    budget = UploadMemoryBudget(10)
+    body = SpooledBody(budget, LocalFileStorage(str(tmp_path)))
+
+    await body.write(b"hello")
+    await body.write(memoryview(b" you"))
+
+    assert body.in_memory
+    assert budget.used == 9
+    assert body.getbuffer() == b"hello you"
+    assert os.listdir(tmp_path) == []
+
+    body.close()
+    assert budget.used == 0
+
+
+@pytest.mark.asyncio
+async def test_body_spilled_to_disk(tmp_path):
+    budget = UploadMemoryBudget(10)
+    other = SpooledBody(budget, LocalFileStorage(str(tmp_path)))
+    await other.write(b"12345")
+    body = SpooledBody(budget, LocalFileStorage(str(tmp_path)))
+
+    await body.write(b"hello")
+    assert body.in_memory
+    # the budget is shared, the second fragment does not fit anymore
+    await body.write(b" world")
+
+    assert not body.in_memory
+    assert budget.used == 5
+    assert len(os.listdir(tmp_path)) == 1
+    view = body.getbuffer()
+    assert view == b"hello world"
+
+    body.close()
+    assert os.listdir(tmp_path) == []
+    # the view is still readable until it is released
+    assert view[:5] == b"hello"
+    other.close()
+    assert budget.used == 0
+
+
+@pytest.mark.asyncio
+async def test_streamed_request(tmp_path):
+    req = get_sample_request_payload(RequestType.VIDEO)
+    header, video = req.encode_buffers()
+    body = SpooledBody(UploadMemoryBudget(0), LocalFileStorage(str(tmp_path)))
+    for fragment in req.encode_fragments(2**16)[1:]:
+        await body.write(fragment)
+
+    streamed_req = StreamedRequest(header, body)
+    decoded_req = streamed_req.decode()
+
+    assert decoded_req.message_id == req.message_id
+    assert decoded_req.video == video
+    del decoded_req
+    streamed_req.close()
+    assert os.listdir(tmp_path) == []
@@ -2,23 +2,30 @@ import asyncio
 from datetime import datetime
 import os
 import sys
+from typing import Dict
+import uuid
 import pytz
 import websockets
+from chatserver import event_loop
 from chatserver.config import Config
-from file_storage import FileStorage, LocalFileStorage
+from file_storage import AsyncFileStorage, AsyncLocalFileStorage
 from request import get_sample_request_payload
 from request import RequestType
 from response import ResponsePayload, ResponseType
 import aioconsole
 
-client_file_storage: FileStorage = LocalFileStorage(
+client_file_storage: AsyncFileStorage = AsyncLocalFileStorage(
     os.path.abspath(
         os.path.join(os.path.dirname(__file__), "../../client_file_storage")
     )
 )
 
 
-def print_response(resp_payload: ResponsePayload) -> None:
+async def print_response(resp_payload: ResponsePayload) -> None:
+    """
+    Print the response, its media are written by the threads of the file storage
+    so the heartbeat and the other responses are not delayed
+    """
     if resp_payload.type == ResponseType.TEXT:
         print(f"Receive msg: {resp_payload.message_id}")
         print(f"message type: {resp_payload.type}")
@@ -28,7 +35,7 @@ def print_response(resp_payload: ResponsePayload) -> None:
         print(f"Receive msg: {resp_payload.message_id}")
         print(f"message type: {resp_payload.type}")
         print(f"text: {resp_payload.text}")
-        audio_file_path = client_file_storage.save_file(
+        audio_file_path = await client_file_storage.save_file(
             f"{str(resp_payload.message_id)}.mp3", resp_payload.audio
         )
         print(f"Audio: {audio_file_path}")
@@ -37,11 +44,13 @@ def print_response(resp_payload: ResponsePayload) -> None:
         print(f"Receive msg: {resp_payload.message_id}")
         print(f"message type: {resp_payload.type}")
         print(f"text: {resp_payload.text}")
-        image_file_path = client_file_storage.save_file(
-            f"{str(resp_payload.message_id)}.jpg", resp_payload.image
-        )
-        audio_file_path = client_file_storage.save_file(
-            f"{str(resp_payload.message_id)}.mp3", resp_payload.audio
+        image_file_path, audio_file_path = await asyncio.gather(
+            client_file_storage.save_file(
+                f"{str(resp_payload.message_id)}.jpg", resp_payload.image
+            ),
+            client_file_storage.save_file(
+                f"{str(resp_payload.message_id)}.mp3", resp_payload.audio
+            ),
         )
         print(f"Image: {image_file_path}")
         print(f"Audio: {audio_file_path}")
@@ -52,7 +61,40 @@ def print_response(resp_payload: ResponsePayload) -> None:
         print(f"error message: {resp_payload.error_message}")
 
 
-async def chat_handler(websocket: websockets.WebSocketClientProtocol):
+async def receive_responses(
+    websocket: websockets.WebSocketClientProtocol,
+    pending_requests: Dict[uuid.UUID, asyncio.Future],
+):
+    """
+    Responses can arrive in any order, match them with the pending requests
+    by message_id
+    """
+    # keep a reference to the tasks printing the unexpected responses
+    printing_tasks = set()
+    async for message in websocket:
+        resp_payload = ResponsePayload.decode(message)
+        future = pending_requests.pop(resp_payload.message_id, None)
+        if future is None:
+            print(f"Receive a response for an unknown request: {resp_payload.message_id}")
+            task = asyncio.create_task(print_response(resp_payload))
+            printing_tasks.add(task)
+            task.add_done_callback(printing_tasks.discard)
+            continue
+        future.set_result(resp_payload)
+
+
+async def wait_for_response(future: asyncio.Future):
+    resp_payload = await future
+    print()
+    await print_response(resp_payload)
+
+
+async def chat_handler(
+    websocket: websockets.WebSocketClientProtocol,
+    pending_requests: Dict[uuid.UUID, asyncio.Future],
+):
+    # keep a reference to the tasks waiting for a response
+    waiting_tasks = set()
     while True:
         print()
         input_type = int(
@@ -68,13 +110,18 @@ async def chat_handler(websocket: websockets.WebSocketClientProtocol):
             print("Invalid input")
             continue
         try:
-            request_encoded = req_payload.encode()
-            await websocket.send(request_encoded)
-            message = await websocket.recv()
-            resp_payload = ResponsePayload.decode(bytes(message))
-
-            print_response(resp_payload)
+            future = asyncio.get_running_loop().create_future()
+            pending_requests[req_payload.message_id] = future
+            # large media is sent in fragments the server can write to disk
+            # as they arrive
+            await websocket.send(req_payload.encode_fragments(Config.MAX_FRAME_SIZE))
+            print(f"Sent msg: {req_payload.message_id}")
+            # do not wait for the response, the next request can be sent right away
+            task = asyncio.create_task(wait_for_response(future))
+            waiting_tasks.add(task)
+            task.add_done_callback(waiting_tasks.discard)
         except Exception as e:
+            pending_requests.pop(req_payload.message_id, None)
             print(e)
 
 
@@ -111,15 +158,28 @@ async def main():
     try:
         async with websockets.connect(path) as websocket:
             first_msg = await websocket.recv()
+            # the server is full, wait for our turn
+            while first_msg.startswith("queued"):
+                _, position, estimated_wait = first_msg.split(" ")
+                print(
+                    f"Waiting for a connection slot, position: {position}, estimated wait: {estimated_wait}s"
+                )
+                first_msg = await websocket.recv()
             if first_msg != "connected":
                 print(f"Connection failed")
                 return
             print(f"Connected to {path}")
+            pending_requests: Dict[uuid.UUID, asyncio.Future] = {}
             keep_alive_task = asyncio.create_task(keep_alive(websocket))
-            chat_handler_task = asyncio.create_task(chat_handler(websocket))
+            receive_task = asyncio.create_task(
+                receive_responses(websocket, pending_requests)
+            )
+            chat_handler_task = asyncio.create_task(
+                chat_handler(websocket, pending_requests)
+            )
 
             done, pending = await asyncio.wait(
-                [keep_alive_task, chat_handler_task],
+                [keep_alive_task, receive_task, chat_handler_task],
                 return_when=asyncio.FIRST_COMPLETED,
             )
 
@@ -129,6 +189,12 @@ async def main():
             for task in done:
                 if task.exception():
                     print(f"Task completed with exception: {task.exception()}")
+    except websockets.InvalidStatusCode as e:
+        retry_after = e.headers.get("Retry-After")
+        if retry_after:
+            print(f"Connection failed: {e}, retry after {retry_after}s")
+        else:
+            print(f"Connection failed: {e}")
     except (
         websockets.ConnectionClosedError,
         websockets.InvalidURI,
@@ -138,4 +204,4 @@ async def main():
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    event_loop.run(main())
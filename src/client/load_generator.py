@@ -0,0 +1,439 @@
+"""
+Headless load generator: open many connections to the chat server and send
+requests with a configurable mix, then report latency percentiles, throughput,
+rejections and errors per request type.
+
+Run from the src folder, e.g.
+python client/load_generator.py --connections 1000 --duration 60 \
+    --mix text=8,audio=1,video=1 --rate 200 --json report.json
+"""
+
+import argparse
+import asyncio
+from collections import Counter
+from dataclasses import dataclass, field
+import json
+import math
+import os
+import random
+import sys
+import time
+from typing import Dict, List, Optional
+from urllib.parse import quote
+import uuid
+
+import websockets
+
+from chatserver import event_loop
+from chatserver.chatbot_reply_policy import REQUEST_TYPE_NAMES, REQUEST_TYPE_NAMES_BY_TYPE
+from chatserver.config import Config
+from request import RequestPayload, RequestType, get_sample_request_payload
+from response import ResponsePayload, ResponseType
+
+# error responses the server sends when it refuses to handle a request
+REJECTION_PREFIXES = ("We can not accept", "Too many messages")
+PERCENTILES = [50, 95, 99, 99.9]
+TIME_ZONES_PATH = os.path.join(os.path.dirname(__file__), "../../timezones.txt")
+
+
+def parse_weights(spec: str) -> Dict[str, float]:
+    """
+    Parse "a=2,b=1" into {"a": 2.0, "b": 1.0}, a name without weight has weight 1
+    """
+    weights = {}
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        name, _, weight = item.partition("=")
+        weights[name.strip()] = float(weight) if weight else 1.0
+    if not weights or any(weight < 0 for weight in weights.values()):
+        raise ValueError(f"Invalid weights: {spec}")
+    return weights
+
+
+def percentile(sorted_values: List[float], p: float) -> Optional[float]:
+    """
+    Nearest-rank percentile of already sorted values
+    """
+    if not sorted_values:
+        return None
+    # rounded so that 99.9 / 100 * 1000 is rank 999
+    rank = math.ceil(round(p * len(sorted_values) / 100, 9))
+    return sorted_values[max(rank, 1) - 1]
+
+
+@dataclass
+class LoadConfig:
+    url: str
+    connections: int = 100
+    duration: float = 10
+    # connections are opened evenly during the first ramp_up seconds
+    ramp_up: float = 0
+    # requests per second of all the connections, 0 keeps in_flight requests
+    # in flight on every connection instead
+    rate: float = 0
+    in_flight: int = 1
+    mix: Dict[int, float] = field(default_factory=lambda: {RequestType.TEXT: 1})
+    # connections use client ids picked from clients ids, with a Zipf
+    # distribution of exponent client_skew (0 is uniform)
+    clients: int = 100
+    client_skew: float = 0
+    time_zones: Dict[str, float] = field(default_factory=lambda: {"UTC": 1})
+    timeout: float = 30
+
+
+@dataclass
+class RequestTypeStats:
+    sent: int = 0
+    ok: int = 0
+    rejected: int = 0
+    errors: int = 0
+    error_kinds: Counter = field(default_factory=Counter)
+    # milliseconds, of the requests answered without error
+    latencies: List[float] = field(default_factory=list)
+
+    def merge(self, other: "RequestTypeStats") -> None:
+        self.sent += other.sent
+        self.ok += other.ok
+        self.rejected += other.rejected
+        self.errors += other.errors
+        self.error_kinds.update(other.error_kinds)
+        self.latencies.extend(other.latencies)
+
+    def to_dict(self, elapsed: float) -> dict:
+        latencies = sorted(self.latencies)
+        return {
+            "sent": self.sent,
+            "ok": self.ok,
+            "rejected": self.rejected,
+            "errors": self.errors,
+            "error_kinds": dict(self.error_kinds),
+            "throughput": self.ok / elapsed if elapsed else 0,
+            "latency_ms": {
+                f"p{p:g}": percentile(latencies, p) for p in PERCENTILES
+            },
+        }
+
+
+@dataclass
+class LoadReport:
+    elapsed: float = 0
+    connections_opened: int = 0
+    connections_queued: int = 0
+    # status code (or "queue" when the admission queue timed out) -> count
+    connections_rejected: Counter = field(default_factory=Counter)
+    connections_failed: Counter = field(default_factory=Counter)
+    types: Dict[str, RequestTypeStats] = field(
+        default_factory=lambda: {name: RequestTypeStats() for name in REQUEST_TYPE_NAMES}
+    )
+
+    def total(self) -> RequestTypeStats:
+        total = RequestTypeStats()
+        for stats in self.types.values():
+            total.merge(stats)
+        return total
+
+    def to_dict(self) -> dict:
+        return {
+            "elapsed": self.elapsed,
+            "connections": {
+                "opened": self.connections_opened,
+                "queued": self.connections_queued,
+                "rejected": dict(self.connections_rejected),
+                "failed": dict(self.connections_failed),
+            },
+            "requests": {
+                name: stats.to_dict(self.elapsed)
+                for name, stats in [*self.types.items(), ("all", self.total())]
+                if stats.sent
+            },
+        }
+
+    def summary(self) -> str:
+        report = self.to_dict()
+        connections = report["connections"]
+        lines = [
+            f"Duration: {self.elapsed:.1f}s",
+            f"Connections: {connections['opened']} opened "
+            f"({connections['queued']} after waiting in the queue), "
+            f"{sum(self.connections_rejected.values())} rejected "
+            f"{connections['rejected']}, "
+            f"{sum(self.connections_failed.values())} failed "
+            f"{connections['failed']}",
+            "",
+            f"{'type':<6} {'sent':>8} {'ok':>8} {'rejected':>8} {'errors':>8} "
+            f"{'ok/s':>9} "
+            + " ".join(f"{f'p{p:g} ms':>9}" for p in PERCENTILES),
+        ]
+        for name, stats in report["requests"].items():
+            latencies = " ".join(
+                f"{latency:9.1f}" if latency is not None else f"{'-':>9}"
+                for latency in stats["latency_ms"].values()
+            )
+            lines.append(
+                f"{name:<6} {stats['sent']:8} {stats['ok']:8} {stats['rejected']:8} "
+                f"{stats['errors']:8} {stats['throughput']:9.1f} {latencies}"
+            )
+        for name, stats in report["requests"].items():
+            if stats["error_kinds"]:
+                lines.append(f"{name} errors: {stats['error_kinds']}")
+        return "\n".join(lines)
+
+
+class LoadGenerator:
+    def __init__(self, config: LoadConfig) -> None:
+        self.config = config
+        self.report = LoadReport()
+        self.client_ids = [f"load-{i}" for i in range(config.clients)]
+        self.client_weights = [
+            1 / (rank**config.client_skew) for rank in range(1, config.clients + 1)
+        ]
+        self.types = list(config.mix)
+        self.type_weights = list(config.mix.values())
+        # the media of every type is encoded once, requests only get a new message_id
+        self.samples = {type: get_sample_request_payload(type) for type in self.types}
+
+    def _new_request(self) -> RequestPayload:
+        type = random.choices(self.types, self.type_weights)[0]
+        sample = self.samples[type]
+        return RequestPayload(
+            message_id=uuid.uuid4(),
+            type=type,
+            text=sample.text,
+            audio=sample.audio,
+            video=sample.video,
+        )
+
+    async def _send_request(
+        self,
+        websocket: websockets.WebSocketClientProtocol,
+        pending: Dict[uuid.UUID, asyncio.Future],
+    ) -> None:
+        req_payload = self._new_request()
+        stats = self.report.types[REQUEST_TYPE_NAMES_BY_TYPE[req_payload.type]]
+        future = asyncio.get_running_loop().create_future()
+        pending[req_payload.message_id] = future
+        stats.sent += 1
+        start = time.perf_counter()
+        try:
+            await websocket.send(req_payload.encode_fragments(Config.MAX_FRAME_SIZE))
+            resp_payload: ResponsePayload = await asyncio.wait_for(
+                future, self.config.timeout
+            )
+        except asyncio.TimeoutError:
+            stats.errors += 1
+            stats.error_kinds["timeout"] += 1
+            return
+        except websockets.ConnectionClosed:
+            stats.errors += 1
+            stats.error_kinds["connection closed"] += 1
+            return
+        finally:
+            pending.pop(req_payload.message_id, None)
+
+        if resp_payload.type != ResponseType.ERROR:
+            stats.ok += 1
+            stats.latencies.append((time.perf_counter() - start) * 1000)
+        elif resp_payload.error_message.startswith(REJECTION_PREFIXES):
+            stats.rejected += 1
+        else:
+            stats.errors += 1
+            stats.error_kinds[resp_payload.error_message] += 1
+
+    async def _receive_responses(
+        self,
+        websocket: websockets.WebSocketClientProtocol,
+        pending: Dict[uuid.UUID, asyncio.Future],
+    ) -> None:
+        try:
+            async for message in websocket:
+                if isinstance(message, str):
+                    continue
+                resp_payload = ResponsePayload.decode(message)
+                future = pending.get(resp_payload.message_id)
+                if future is not None and not future.done():
+                    future.set_result(resp_payload)
+        except websockets.ConnectionClosed:
+            pass
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(websockets.ConnectionClosedError(None, None))
+
+    async def _connect(self) -> Optional[websockets.WebSocketClientProtocol]:
+        client_id = random.choices(self.client_ids, self.client_weights)[0]
+        time_zone = random.choices(
+            list(self.config.time_zones), list(self.config.time_zones.values())
+        )[0]
+        url = f"{self.config.url}?client_id={quote(client_id)}&time_zone={quote(time_zone)}"
+        try:
+            websocket = await websockets.connect(
+                url, max_size=None, compression=None, open_timeout=self.config.timeout
+            )
+        except websockets.InvalidStatusCode as e:
+            self.report.connections_rejected[e.status_code] += 1
+            return None
+        except Exception as e:
+            self.report.connections_failed[type(e).__name__] += 1
+            return None
+
+        try:
+            first_msg = await websocket.recv()
+            queued = False
+            while first_msg.startswith("queued"):
+                queued = True
+                first_msg = await websocket.recv()
+        except websockets.ConnectionClosed:
+            # no slot was freed while waiting in the admission queue
+            self.report.connections_rejected["queue"] += 1
+            return None
+        self.report.connections_opened += 1
+        self.report.connections_queued += queued
+        return websocket
+
+    async def _run_connection(self, index: int, deadline: float) -> None:
+        if self.config.ramp_up:
+            await asyncio.sleep(index * self.config.ramp_up / self.config.connections)
+        websocket = await self._connect()
+        if websocket is None:
+            return
+
+        pending: Dict[uuid.UUID, asyncio.Future] = {}
+        receive_task = asyncio.create_task(self._receive_responses(websocket, pending))
+        try:
+            if self.config.rate:
+                await self._send_at_rate(websocket, pending, deadline)
+            else:
+                await asyncio.gather(
+                    *[
+                        self._send_one_by_one(websocket, pending, deadline)
+                        for _ in range(self.config.in_flight)
+                    ]
+                )
+        finally:
+            await websocket.close()
+            await receive_task
+
+    async def _send_one_by_one(self, websocket, pending, deadline: float) -> None:
+        while time.monotonic() < deadline and not websocket.closed:
+            await self._send_request(websocket, pending)
+
+    async def _send_at_rate(self, websocket, pending, deadline: float) -> None:
+        """
+        Send requests at exponentially distributed intervals, without waiting
+        for the responses
+        """
+        rate = self.config.rate / self.config.connections
+        tasks = set()
+        while not websocket.closed:
+            await asyncio.sleep(random.expovariate(rate))
+            if time.monotonic() >= deadline:
+                break
+            task = asyncio.create_task(self._send_request(websocket, pending))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        await asyncio.gather(*tasks)
+
+    async def run(self) -> LoadReport:
+        start = time.monotonic()
+        deadline = start + self.config.ramp_up + self.config.duration
+        await asyncio.gather(
+            *[
+                self._run_connection(index, deadline)
+                for index in range(self.config.connections)
+            ]
+        )
+        self.report.elapsed = time.monotonic() - start
+        return self.report
+
+
+def raise_open_files_limit() -> None:
+    """
+    Every connection needs a file descriptor
+    """
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--url", default=f"ws://{Config.SERVER_HOST}:{Config.SERVER_PORT}"
+    )
+    parser.add_argument("--connections", type=int, default=100)
+    parser.add_argument("--duration", type=float, default=10, help="seconds")
+    parser.add_argument(
+        "--ramp-up", type=float, default=0, help="seconds to open all the connections"
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=0,
+        help="requests per second of all the connections, "
+        "0 keeps --in-flight requests in flight on every connection",
+    )
+    parser.add_argument("--in-flight", type=int, default=1)
+    parser.add_argument(
+        "--mix", default="text=1", help="weights of the request types, e.g. text=8,audio=1,video=1"
+    )
+    parser.add_argument(
+        "--clients", type=int, help="number of distinct client ids, default --connections"
+    )
+    parser.add_argument(
+        "--client-skew",
+        type=float,
+        default=0,
+        help="Zipf exponent of the client id distribution, 0 is uniform",
+    )
+    parser.add_argument(
+        "--time-zones",
+        help="weights of the client time zones, e.g. Asia/Tokyo=2,UTC=1, "
+        "default the time zones of timezones.txt",
+    )
+    parser.add_argument("--timeout", type=float, default=30, help="seconds per request")
+    parser.add_argument("--json", help="write the report as JSON to this file, - for stdout")
+    args = parser.parse_args()
+
+    mix = {}
+    for name, weight in parse_weights(args.mix).items():
+        if name not in REQUEST_TYPE_NAMES:
+            parser.error(f"Unknown request type: {name}")
+        mix[REQUEST_TYPE_NAMES[name]] = weight
+    if args.time_zones:
+        time_zones = parse_weights(args.time_zones)
+    else:
+        with open(TIME_ZONES_PATH) as f:
+            time_zones = {line.strip(): 1.0 for line in f if line.strip()}
+
+    config = LoadConfig(
+        url=args.url,
+        connections=args.connections,
+        duration=args.duration,
+        ramp_up=args.ramp_up,
+        rate=args.rate,
+        in_flight=args.in_flight,
+        mix=mix,
+        clients=args.clients or args.connections,
+        client_skew=args.client_skew,
+        time_zones=time_zones,
+        timeout=args.timeout,
+    )
+    raise_open_files_limit()
+    report = event_loop.run(LoadGenerator(config).run())
+
+    if args.json == "-":
+        json.dump(report.to_dict(), sys.stdout, indent=2)
+        print()
+    else:
+        print(report.summary())
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(report.to_dict(), f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
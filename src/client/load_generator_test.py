@@ -0,0 +1,69 @@
+import pytest
+
+from chatserver.chat_bot import ChatBot
+from chatserver.chat_server import serve_chatbot
+from chatserver.config import Config
+from load_generator import LoadConfig, LoadGenerator, parse_weights, percentile
+from request import RequestType
+
+
+def test_parse_weights():
+    assert parse_weights("text=8,audio=1,video") == {
+        "text": 8.0,
+        "audio": 1.0,
+        "video": 1.0,
+    }
+    with pytest.raises(ValueError):
+        parse_weights("")
+    with pytest.raises(ValueError):
+        parse_weights("text=-1")
+
+
+def test_percentile():
+    values = list(range(1, 1001))
+    assert percentile(values, 50) == 500
+    assert percentile(values, 99) == 990
+    assert percentile(values, 99.9) == 999
+    assert percentile([3], 0) == 3
+    assert percentile([], 50) is None
+
+
+@pytest.mark.asyncio
+async def test_load_generator(monkeypatch, tmp_path):
+    monkeypatch.setattr(Config, "UPLOAD_SPOOL_DIR", str(tmp_path / "uploads"))
+    monkeypatch.setattr(Config, "MEDIA_STORAGE_DIR", str(tmp_path / "media"))
+    monkeypatch.setattr(Config, "CONCURRENCY_BACKEND", "memory")
+    monkeypatch.setattr(Config, "MAX_CONNECTIONS", 4)
+    monkeypatch.setattr(Config, "MAX_CONNECTION_PER_CLIENT", 4)
+    monkeypatch.setattr(Config, "ADMISSION_QUEUE_MAX_LENGTH", 0)
+    monkeypatch.setattr(Config, "REPLY_POLICY", "text=0-24;audio=")
+    chatbot = ChatBot()
+    server = await serve_chatbot(chatbot, "localhost", 0, Config.MAX_REQUEST_SIZE)
+    port = server.sockets[0].getsockname()[1]
+
+    config = LoadConfig(
+        url=f"ws://localhost:{port}",
+        connections=5,
+        duration=0.5,
+        in_flight=2,
+        mix={RequestType.TEXT: 1, RequestType.AUDIO: 1},
+        clients=5,
+        time_zones={"Asia/Tokyo": 1, "UTC": 1},
+        timeout=5,
+    )
+    report = await LoadGenerator(config).run()
+    server.close()
+    await server.wait_closed()
+
+    assert report.connections_opened == 4
+    assert report.connections_rejected == {503: 1}
+    text, audio = report.types["text"], report.types["audio"]
+    assert text.sent == text.ok == len(text.latencies) > 0
+    assert audio.sent == audio.rejected > 0
+    assert text.errors == audio.errors == 0
+
+    summary = report.to_dict()
+    assert summary["requests"]["all"]["sent"] == text.sent + audio.sent
+    assert summary["requests"]["text"]["latency_ms"]["p50"] > 0
+    assert "video" not in summary["requests"]
+    assert "text" in report.summary()
@@ -1,5 +1,44 @@
 import abc
+import asyncio
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import mmap
 import os
+import sqlite3
+import threading
+from typing import AsyncIterable, AsyncIterator, BinaryIO, Iterable
+import uuid
+
+from utils import Buffer
+
+
+def write_file_atomically(file_path, chunks: Iterable[Buffer]) -> None:
+    """
+    Write the chunks to a temporary file renamed to file_path once complete,
+    readers see the previous file or the new one, never a part of it
+    """
+    temp_path = _temp_path(file_path)
+    try:
+        with open(temp_path, "wb") as file:
+            for chunk in chunks:
+                file.write(chunk)
+        os.replace(temp_path, file_path)
+    except BaseException:
+        _remove(temp_path)
+        raise
+
+
+def _temp_path(file_path):
+    directory, name = os.path.split(file_path)
+    return os.path.join(directory, f".{name}.{uuid.uuid4().hex}.tmp")
+
+
+def _remove(file_path):
+    try:
+        os.remove(file_path)
+    except FileNotFoundError:
+        pass
 
 
 class FileStorage(abc.ABC):
@@ -19,6 +58,13 @@ class FileStorage(abc.ABC):
     def delete_file(self, file_name):
         pass
 
+    @abc.abstractmethod
+    def open_file(self, file_name, mode="rb") -> BinaryIO:
+        """
+        Open the file to read or write it in chunks instead of all at once
+        """
+        pass
+
 
 class LocalFileStorage(FileStorage):
     def __init__(self, storage_path):
@@ -26,9 +72,8 @@ class LocalFileStorage(FileStorage):
 
     def save_file(self, file_name, data) -> str:
         file_path = self._get_file_path(file_name)
-        with open(file_path, "wb") as file:
-            file.write(data)
-            return file_path
+        write_file_atomically(file_path, [data])
+        return file_path
 
     def get_file(self, file_name):
         file_path = self._get_file_path(file_name)
@@ -40,5 +85,270 @@ class LocalFileStorage(FileStorage):
         if os.path.exists(file_path):
             os.remove(file_path)
 
+    def open_file(self, file_name, mode="rb") -> BinaryIO:
+        return open(self._get_file_path(file_name), mode)
+
+    def _get_file_path(self, file_name):
+        return os.path.join(self.storage_path, file_name)
+
+
+class ContentAddressedFileStorage(FileStorage):
+    """
+    Files named by the SHA-256 of their content, stored once however many
+    times they are saved.
+
+    save_file returns the stable URL base_url/<digest><extension>, the other
+    methods accept that URL or its last part. The file is written at
+    <digest[:2]>/<digest[2:4]>/<name> so no directory gets too large.
+    A SQLite index counts the references of every file, delete_file removes
+    one and the file is deleted with its last reference
+    """
+
+    INDEX = "index.db"
+
+    def __init__(self, storage_path, base_url="/media"):
+        self.storage_path = storage_path
+        self.base_url = base_url.rstrip("/")
+        os.makedirs(os.path.join(storage_path, "tmp"), exist_ok=True)
+        # saves happen in threads sharing the connection of the index
+        self._lock = threading.Lock()
+        self._index = sqlite3.connect(
+            os.path.join(storage_path, self.INDEX),
+            check_same_thread=False,
+            isolation_level=None,
+        )
+        self._index.execute("PRAGMA journal_mode=WAL")
+        self._index.execute("PRAGMA synchronous=NORMAL")
+        self._index.execute(
+            "CREATE TABLE IF NOT EXISTS files "
+            "(name TEXT PRIMARY KEY, size INTEGER NOT NULL, refs INTEGER NOT NULL)"
+        )
+
+    def save_file(self, file_name, data) -> str:
+        """
+        Store data if no file has the same content and return its URL,
+        file_name only gives the extension
+        """
+        name = hashlib.sha256(data).hexdigest() + os.path.splitext(file_name)[1]
+        if self.add_reference(name):
+            return self.url(name)
+        file_path = self._get_file_path(name)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        # a file is complete or absent, even if the process stops while writing it
+        temp_path = os.path.join(self.storage_path, "tmp", uuid.uuid4().hex)
+        with open(temp_path, "wb") as file:
+            file.write(data)
+        with self._transaction():
+            os.replace(temp_path, file_path)
+            self._index.execute(
+                "INSERT INTO files (name, size, refs) VALUES (?, ?, 1) "
+                "ON CONFLICT (name) DO UPDATE SET refs = refs + 1",
+                (name, len(data)),
+            )
+        return self.url(name)
+
+    def add_reference(self, file_name) -> bool:
+        """
+        Count one more reference of a stored file, False if it is not stored
+        """
+        with self._lock:
+            cursor = self._index.execute(
+                "UPDATE files SET refs = refs + 1 WHERE name = ?",
+                (self._name(file_name),),
+            )
+        return cursor.rowcount == 1
+
+    def references(self, file_name) -> int:
+        row = self._index.execute(
+            "SELECT refs FROM files WHERE name = ?", (self._name(file_name),)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def get_file(self, file_name):
+        with self.open_file(file_name) as file:
+            return file.read()
+
+    def delete_file(self, file_name):
+        name = self._name(file_name)
+        with self._transaction():
+            row = self._index.execute(
+                "UPDATE files SET refs = refs - 1 WHERE name = ? RETURNING refs",
+                (name,),
+            ).fetchone()
+            if row is None or row[0] > 0:
+                return
+            self._index.execute("DELETE FROM files WHERE name = ?", (name,))
+            file_path = self._get_file_path(name)
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+    def open_file(self, file_name, mode="rb") -> BinaryIO:
+        if mode != "rb":
+            raise ValueError("Content-addressed files can only be opened with rb")
+        return open(self._get_file_path(self._name(file_name)), mode)
+
+    def usage(self) -> dict:
+        """
+        Bytes stored, and bytes that would be stored without deduplication
+        """
+        files, stored, referenced = self._index.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(size * refs), 0) "
+            "FROM files"
+        ).fetchone()
+        return {"files": files, "stored_bytes": stored, "referenced_bytes": referenced}
+
+    def url(self, file_name) -> str:
+        return f"{self.base_url}/{self._name(file_name)}"
+
+    def close(self):
+        self._index.close()
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """
+        Hold the write lock of the index, which is shared with the other
+        processes, while the index and the files are changed together
+        """
+        with self._lock:
+            self._index.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self._index.execute("ROLLBACK")
+                raise
+            self._index.execute("COMMIT")
+
+    def _name(self, file_name):
+        # a URL or a name, never a path out of the storage
+        name = file_name.rsplit("/", 1)[-1]
+        if not name or name.startswith("."):
+            raise ValueError(f"Invalid file name: {file_name}")
+        return name
+
+    def _get_file_path(self, name):
+        return os.path.join(self.storage_path, name[:2], name[2:4], name)
+
+
+class AsyncFileStorage(abc.ABC):
+    """
+    File storage used from the event loop, its I/O never blocks the loop
+    """
+
+    @abc.abstractmethod
+    async def save_file(self, file_name, data: Buffer) -> str:
+        pass
+
+    @abc.abstractmethod
+    async def save_stream(self, file_name, chunks: AsyncIterable[Buffer]) -> str:
+        """
+        Write the chunks as they come, the file appears once they are all written
+        """
+        pass
+
+    @abc.abstractmethod
+    async def read_range(self, file_name, offset=0, size=None) -> memoryview:
+        """
+        size bytes from offset, up to the end of the file when size is None
+        """
+        pass
+
+    @abc.abstractmethod
+    async def map_file(self, file_name) -> memoryview:
+        """
+        Read-only view of the whole file, without reading it in memory
+        """
+        pass
+
+    @abc.abstractmethod
+    async def delete_file(self, file_name):
+        pass
+
+    async def iter_file(
+        self, file_name, chunk_size=2**20
+    ) -> AsyncIterator[memoryview]:
+        offset = 0
+        while True:
+            chunk = await self.read_range(file_name, offset, chunk_size)
+            if not chunk:
+                return
+            yield chunk
+            offset += len(chunk)
+
+
+class AsyncLocalFileStorage(AsyncFileStorage):
+    """
+    Local files written and read by a pool of max_workers threads.
+    Files are written to a temporary file renamed once complete
+    """
+
+    def __init__(self, storage_path, max_workers=4):
+        self.storage_path = storage_path
+        os.makedirs(storage_path, exist_ok=True)
+        self._executor = ThreadPoolExecutor(
+            max_workers, thread_name_prefix="file-storage"
+        )
+
+    async def _run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, function, *args
+        )
+
+    async def save_file(self, file_name, data: Buffer) -> str:
+        file_path = self._get_file_path(file_name)
+        await self._run(write_file_atomically, file_path, [data])
+        return file_path
+
+    async def save_stream(self, file_name, chunks: AsyncIterable[Buffer]) -> str:
+        file_path = self._get_file_path(file_name)
+        temp_path = _temp_path(file_path)
+        file = await self._run(open, temp_path, "wb")
+        try:
+            async for chunk in chunks:
+                await self._run(file.write, chunk)
+            await self._run(file.close)
+            await self._run(os.replace, temp_path, file_path)
+        except BaseException:
+            file.close()
+            _remove(temp_path)
+            raise
+        return file_path
+
+    def _read_range(self, file_path, offset, size) -> memoryview:
+        with open(file_path, "rb") as file:
+            end = os.fstat(file.fileno()).st_size
+            if size is not None:
+                end = min(end, offset + size)
+            # read straight into the buffer of the returned view
+            view = memoryview(bytearray(max(0, end - offset)))
+            file.seek(offset)
+            read = 0
+            while read < len(view):
+                count = file.readinto(view[read:])
+                if not count:
+                    break
+                read += count
+            return view[:read]
+
+    async def read_range(self, file_name, offset=0, size=None) -> memoryview:
+        return await self._run(
+            self._read_range, self._get_file_path(file_name), offset, size
+        )
+
+    def _map_file(self, file_path) -> memoryview:
+        with open(file_path, "rb") as file:
+            if os.fstat(file.fileno()).st_size == 0:
+                return memoryview(b"")
+            # the mapping is closed when the last view of it is released
+            return memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+
+    async def map_file(self, file_name) -> memoryview:
+        return await self._run(self._map_file, self._get_file_path(file_name))
+
+    async def delete_file(self, file_name):
+        await self._run(_remove, self._get_file_path(file_name))
+
+    def close(self):
+        self._executor.shutdown()
+
     def _get_file_path(self, file_name):
         return os.path.join(self.storage_path, file_name)
@@ -0,0 +1,119 @@
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import os
+
+import pytest
+
+from file_storage import AsyncLocalFileStorage, ContentAddressedFileStorage
+
+
+def test_content_addressed_storage(tmp_path):
+    storage = ContentAddressedFileStorage(
+        str(tmp_path), base_url="https://cdn.example/media/"
+    )
+    digest = hashlib.sha256(b"clip").hexdigest()
+
+    url = storage.save_file("a.mp3", b"clip")
+    assert url == f"https://cdn.example/media/{digest}.mp3"
+    assert storage.save_file("b.mp3", memoryview(b"clip")) == url
+    assert os.path.exists(tmp_path / digest[:2] / digest[2:4] / f"{digest}.mp3")
+    assert storage.get_file(url) == b"clip"
+    assert storage.references(url) == 2
+    assert storage.usage() == {"files": 1, "stored_bytes": 4, "referenced_bytes": 8}
+
+    # the index survives a restart
+    storage.close()
+    storage = ContentAddressedFileStorage(
+        str(tmp_path), base_url="https://cdn.example/media"
+    )
+    assert storage.add_reference(f"{digest}.mp3")
+    assert not storage.add_reference("unknown.mp3")
+
+    storage.delete_file(url)
+    storage.delete_file(url)
+    assert storage.get_file(url) == b"clip"
+    storage.delete_file(url)
+    assert storage.references(url) == 0
+    assert not os.path.exists(tmp_path / digest[:2] / digest[2:4] / f"{digest}.mp3")
+    storage.close()
+
+
+def test_storage_shared_by_workers(tmp_path):
+    # every worker has its own connection to the index
+    workers = [ContentAddressedFileStorage(str(tmp_path)) for _ in range(4)]
+    digest = hashlib.sha256(b"clip").hexdigest()
+    name = f"{digest}.mp3"
+
+    with ThreadPoolExecutor(8) as executor:
+        list(
+            executor.map(lambda i: workers[i % 4].save_file(name, b"clip"), range(100))
+        )
+        assert workers[0].references(name) == 100
+        list(executor.map(lambda i: workers[i % 4].delete_file(name), range(99)))
+    assert workers[0].references(name) == 1
+    assert workers[0].get_file(name) == b"clip"
+
+    workers[1].delete_file(name)
+    assert workers[0].references(name) == 0
+    assert not os.path.exists(tmp_path / digest[:2] / digest[2:4] / name)
+    for worker in workers:
+        worker.close()
+
+
+def test_invalid_access(tmp_path):
+    storage = ContentAddressedFileStorage(str(tmp_path))
+    url = storage.save_file("image.jpg", b"image")
+
+    with pytest.raises(ValueError):
+        storage.open_file(url, "wb")
+    with pytest.raises(ValueError):
+        storage.get_file("..")
+    storage.close()
+
+
+@pytest.mark.asyncio
+async def test_async_streaming_storage(tmp_path):
+    storage = AsyncLocalFileStorage(str(tmp_path))
+
+    async def chunks():
+        for i in range(4):
+            yield bytes([i]) * 1000
+
+    path = await storage.save_stream("stream.bin", chunks())
+    assert os.listdir(tmp_path) == ["stream.bin"]
+    with open(path, "rb") as file:
+        assert file.read() == b"".join(bytes([i]) * 1000 for i in range(4))
+
+    view = await storage.read_range("stream.bin", 900, 200)
+    assert isinstance(view, memoryview)
+    assert view == b"\x00" * 100 + b"\x01" * 100
+    assert await storage.read_range("stream.bin", 3900) == b"\x03" * 100
+    assert await storage.read_range("stream.bin", 5000) == b""
+
+    mapped = await storage.map_file("stream.bin")
+    assert mapped[2000:2003] == b"\x02" * 3
+    mapped.release()
+
+    chunk_sizes = [len(chunk) async for chunk in storage.iter_file("stream.bin", 1500)]
+    assert chunk_sizes == [1500, 1500, 1000]
+
+    await storage.delete_file("stream.bin")
+    assert os.listdir(tmp_path) == []
+    storage.close()
+
+
+@pytest.mark.asyncio
+async def test_async_write_is_atomic(tmp_path):
+    storage = AsyncLocalFileStorage(str(tmp_path))
+    await storage.save_file("file.bin", b"old")
+
+    async def failing_chunks():
+        yield b"new"
+        raise ConnectionError("client gone")
+
+    with pytest.raises(ConnectionError):
+        await storage.save_stream("file.bin", failing_chunks())
+    # the previous file is intact and the partial one is removed
+    assert os.listdir(tmp_path) == ["file.bin"]
+    assert await storage.read_range("file.bin") == b"old"
+    storage.close()
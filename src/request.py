@@ -1,8 +1,12 @@
-from typing import Optional
+from typing import List, Optional
 from dataclasses import dataclass
 import uuid
 
-from utils import get_sample_audio, get_sample_text, get_sample_video
+from utils import Buffer, get_sample_audio, get_sample_text, get_sample_video
+
+
+# message_id (16 bytes) and type (1 byte), the rest of the payload is the body
+REQUEST_HEADER_SIZE = 17
 
 
 class RequestType:
@@ -24,33 +28,60 @@ class RequestPayload:
     message_id: uuid.UUID
     type: int
     text: Optional[str]
-    audio: Optional[bytes]
-    video: Optional[bytes]
+    audio: Optional[Buffer]
+    video: Optional[Buffer]
 
     def encode(self) -> bytes:
         """
         Encodes the request payload into bytes.
         """
-        return b"".join(
-            [
-                self.message_id.bytes,
-                self.type.to_bytes(1, byteorder="big"),
-                self.text.encode("utf-8") if self.text else b"",
-                self.audio or b"",
-                self.video or b"",
-            ]
-        )
+        return b"".join(self.encode_buffers())
+
+    def encode_buffers(self) -> List[Buffer]:
+        """
+        Encodes the request payload into a list of buffers that can be sent as
+        the fragments of one websocket message, the media is not copied
+        """
+        header = self.message_id.bytes + self.type.to_bytes(1, byteorder="big")
+        body = self.text.encode("utf-8") if self.text else self.audio or self.video
+        return [header, body] if body else [header]
+
+    def encode_fragments(self, fragment_size: int) -> List[Buffer]:
+        """
+        Encodes the request payload into fragments of at most fragment_size
+        bytes, the header is always in the first fragment
+        """
+        fragments = []
+        for buffer in self.encode_buffers():
+            view = memoryview(buffer)
+            for start in range(0, len(view), fragment_size):
+                fragments.append(view[start : start + fragment_size])
+        return fragments
 
     @staticmethod
-    def decode(payload: bytes) -> "RequestPayload":
+    def decode(payload: Buffer) -> "RequestPayload":
         """
         Decodes the request payload from bytes.
+        audio and video are memoryview slices of the payload, not copies
+        """
+        payload = memoryview(payload)
+        return RequestPayload.decode_parts(
+            payload[:REQUEST_HEADER_SIZE], payload[REQUEST_HEADER_SIZE:]
+        )
+
+    @staticmethod
+    def decode_parts(header: Buffer, body: Buffer) -> "RequestPayload":
+        """
+        Decodes the request payload from its header and body received separately
         """
-        message_id = uuid.UUID(bytes=payload[:16])
-        type = int.from_bytes(payload[16:17], byteorder="big")
+        header = memoryview(header)
+        if len(header) != REQUEST_HEADER_SIZE:
+            raise ValueError("Invalid request header")
+        message_id = uuid.UUID(bytes=bytes(header[:16]))
+        type = header[16]
 
         if type == RequestType.TEXT:
-            text = payload[17:].decode("utf-8")
+            text = str(body, "utf-8")
             return RequestPayload(
                 message_id=message_id, type=type, text=text, audio=None, video=None
             )
@@ -59,7 +90,7 @@ class RequestPayload:
                 message_id=message_id,
                 type=type,
                 text=None,
-                audio=payload[17:],
+                audio=body,
                 video=None,
             )
         elif type == RequestType.VIDEO:
@@ -68,7 +99,7 @@ class RequestPayload:
                 type=type,
                 text=None,
                 audio=None,
-                video=payload[17:],
+                video=body,
             )
         else:
             raise ValueError("Invalid request type")
@@ -50,3 +50,29 @@ def test_video_request_encode() -> None:
 
     assert req.audio == None
     assert decoded_req.audio == None
+
+
+def test_request_decode_does_not_copy_media() -> None:
+    req = get_sample_request_payload(RequestType.VIDEO)
+
+    encoded_req = req.encode()
+
+    decoded_req = RequestPayload.decode(encoded_req)
+
+    assert isinstance(decoded_req.video, memoryview)
+    assert decoded_req.video.obj is encoded_req
+    assert decoded_req.video == req.video
+
+
+def test_request_encode_buffers() -> None:
+    for type in [RequestType.TEXT, RequestType.AUDIO, RequestType.VIDEO]:
+        req = get_sample_request_payload(type)
+
+        buffers = req.encode_buffers()
+
+        assert b"".join(buffers) == req.encode()
+        # the media is sent as it is, without being copied into a new buffer
+        assert req.text is not None or buffers[1] is (req.audio or req.video)
+
+        decoded_req = RequestPayload.decode(bytearray().join(buffers))
+        assert decoded_req == req
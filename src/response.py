@@ -1,9 +1,9 @@
 import os
-from typing import Optional
+from typing import List, Optional
 from dataclasses import dataclass
 import uuid
 
-from utils import get_sample_audio, get_sample_image, get_sample_text
+from utils import Buffer, get_sample_audio, get_sample_image, get_sample_text
 
 
 class ResponseType:
@@ -18,19 +18,29 @@ class ResponsePayload:
     message_id: uuid.UUID
     type: int
     text: str
-    audio: Optional[bytes]
-    image: Optional[bytes]
+    audio: Optional[Buffer]
+    image: Optional[Buffer]
     error_message: Optional[str] = None
 
     def encode(self) -> bytes:
+        return b"".join(self.encode_buffers())
+
+    def encode_buffers(self) -> List[Buffer]:
+        """
+        Encode the response payload into a list of buffers that can be sent
+        one after the other (e.g. as fragments of a websocket message)
+        without joining them first, the media is not copied
+        """
         if self.type == ResponseType.ERROR:
-            return b"".join(
-                [
-                    self.message_id.bytes,
-                    self.type.to_bytes(1, byteorder="big"),
-                    self.error_message.encode("utf-8") if self.error_message else b"",
-                ]
-            )
+            return [
+                b"".join(
+                    [
+                        self.message_id.bytes,
+                        self.type.to_bytes(1, byteorder="big"),
+                        self.error_message.encode("utf-8") if self.error_message else b"",
+                    ]
+                )
+            ]
         text_bytes = self.text.encode("utf-8")
         text_bytes_len = len(text_bytes)
         audio_bytes_len = len(self.audio) if self.audio else 0
@@ -52,22 +62,23 @@ class ResponsePayload:
                 audio_bytes_len.to_bytes(4, byteorder="big"),
             ]
         )
-        body = b"".join(
-            [
-                text_bytes,
-                self.audio or b"",
-                self.image or b"",
-            ]
-        )
-        return header + body
+        return [
+            buffer
+            for buffer in [header + text_bytes, self.audio, self.image]
+            if buffer
+        ]
 
     @staticmethod
-    def decode(payload: bytes) -> "ResponsePayload":
-        message_id = uuid.UUID(bytes=payload[:16])
-        type = int.from_bytes(payload[16:17], byteorder="big")
+    def decode(payload: Buffer) -> "ResponsePayload":
+        """
+        audio and image are memoryview slices of the payload, not copies
+        """
+        payload = memoryview(payload)
+        message_id = uuid.UUID(bytes=bytes(payload[:16]))
+        type = payload[16]
 
         if type == ResponseType.ERROR:
-            error_message = payload[17:].decode("utf-8")
+            error_message = str(payload[17:], "utf-8")
             return ResponsePayload(
                 message_id=message_id,
                 type=type,
@@ -79,7 +90,7 @@ class ResponsePayload:
         text_bytes_len = int.from_bytes(payload[17:21], byteorder="big")
         audio_bytes_len = int.from_bytes(payload[21:25], byteorder="big")
 
-        text = payload[25 : 25 + text_bytes_len].decode("utf-8")
+        text = str(payload[25 : 25 + text_bytes_len], "utf-8")
         audio = payload[25 + text_bytes_len : 25 + text_bytes_len + audio_bytes_len]
         image = payload[25 + text_bytes_len + audio_bytes_len :]
 
@@ -92,12 +103,15 @@ class ResponsePayload:
         )
 
 
-def get_sample_response_payload(type: int) -> ResponsePayload:
+def get_sample_response_payload(
+    type: int, message_id: Optional[uuid.UUID] = None
+) -> ResponsePayload:
     """
     Just a helper function to generate a sample response payload based on the type\n
     if type is TEXT, it will return a response with only text\n
     if type is TEXT_AUDIO, it will return a response with text and audio\n
-    if type is TEXT_AUDIO_IMAGE, it will return a response with text, audio, and image
+    if type is TEXT_AUDIO_IMAGE, it will return a response with text, audio, and image\n
+    message_id is the id of the request being answered, a new id is generated if not given
     """
     audio = None if type == ResponseType.TEXT else get_sample_audio()
     image = (
@@ -106,7 +120,7 @@ def get_sample_response_payload(type: int) -> ResponsePayload:
         else get_sample_image()
     )
     return ResponsePayload(
-        message_id=uuid.uuid4(),
+        message_id=message_id or uuid.uuid4(),
         type=type,
         text=get_sample_text(),
         audio=audio,
@@ -115,12 +129,14 @@ def get_sample_response_payload(type: int) -> ResponsePayload:
     )
 
 
-def get_error_payload(error_msg: str) -> ResponsePayload:
+def get_error_payload(
+    error_msg: str, message_id: Optional[uuid.UUID] = None
+) -> ResponsePayload:
     """
     Just a helper function to generate a error response payload
     """
     return ResponsePayload(
-        message_id=uuid.uuid4(),
+        message_id=message_id or uuid.uuid4(),
         type=ResponseType.ERROR,
         text="",
         audio=None,
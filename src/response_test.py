@@ -75,3 +75,31 @@ def test_response_encode_error() -> None:
     assert decoded_resp.audio == None
 
     assert resp.error_message == decoded_resp.error_message
+
+
+def test_response_decode_does_not_copy_media() -> None:
+    resp = get_sample_response_payload(ResponseType.TEXT_AUDIO_IMAGE)
+
+    encoded_resp = resp.encode()
+
+    decoded_resp = ResponsePayload.decode(encoded_resp)
+
+    assert isinstance(decoded_resp.audio, memoryview)
+    assert isinstance(decoded_resp.image, memoryview)
+    assert decoded_resp.audio.obj is encoded_resp
+    assert decoded_resp.image.obj is encoded_resp
+
+
+def test_response_encode_buffers() -> None:
+    resp = get_sample_response_payload(ResponseType.TEXT_AUDIO_IMAGE)
+
+    buffers = resp.encode_buffers()
+
+    assert b"".join(buffers) == resp.encode()
+    # the media is sent as it is, without being copied into a new buffer
+    assert buffers[1] is resp.audio
+    assert buffers[2] is resp.image
+
+    # a decoded response can be encoded again without copying its media
+    decoded_resp = ResponsePayload.decode(resp.encode())
+    assert b"".join(decoded_resp.encode_buffers()) == resp.encode()
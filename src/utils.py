@@ -1,26 +1,31 @@
 import os
+from typing import Union
 
+# any bytes-like object, decoded payloads keep memoryview slices of the message
+# instead of copying the media out of it
+Buffer = Union[bytes, bytearray, memoryview]
 
-def get_sample_image() -> bytes:
-    sample_image_path = os.path.abspath(
-        os.path.join(os.path.dirname(__file__), "../sample", "sample.jpg")
+
+def get_sample_file_path(file_name: str) -> str:
+    return os.path.abspath(
+        os.path.join(os.path.dirname(__file__), "../sample", file_name)
     )
+
+
+def get_sample_image() -> bytes:
+    sample_image_path = get_sample_file_path("sample.jpg")
     with open(sample_image_path, "rb") as f:
         return f.read()
 
 
 def get_sample_audio() -> bytes:
-    sample_audio_path = os.path.abspath(
-        os.path.join(os.path.dirname(__file__), "../sample", "sample.mp3")
-    )
+    sample_audio_path = get_sample_file_path("sample.mp3")
     with open(sample_audio_path, "rb") as f:
         return f.read()
 
 
 def get_sample_video() -> bytes:
-    sample_audio_path = os.path.abspath(
-        os.path.join(os.path.dirname(__file__), "../sample", "sample.mp4")
-    )
+    sample_audio_path = get_sample_file_path("sample.mp4")
     with open(sample_audio_path, "rb") as f:
         return f.read()
 